@@ -3,6 +3,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
 from twitter.cache import USER_PROFILE_PATTERN
+from utils.local_cache import LocalCache
 from utils.memcached_helper import MemcachedHelper
 
 cache = caches['testing'] if settings.TESTING else caches['default']
@@ -14,19 +15,78 @@ class UserService:
     def get_user_through_cache(cls, user_id):
         return MemcachedHelper.get_object_through_cache(User ,user_id)
 
+    @classmethod
+    def get_users_through_cache(cls, user_ids):
+        return MemcachedHelper.get_objects_through_cache(User, user_ids)
+
     @classmethod
     def get_profile_through_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        profile = cache.get(key)
+        # fetched before in the same request
+        profile = LocalCache.get(key)
         if profile is not None:
             return profile
 
-        profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
+        profile = cache.get(key)
+        if profile is None:
+            profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
+            cache.set(key, profile)
+        LocalCache.set(key, profile)
 
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        # user_id => profile, one get_many and one query for the cache misses
+        keys = {
+            user_id: USER_PROFILE_PATTERN.format(user_id=user_id)
+            for user_id in user_ids
+        }
+        cached = LocalCache.get_many(keys.values())
+        missing_keys = [key for key in keys.values() if key not in cached]
+        if missing_keys:
+            memcached = cache.get_many(missing_keys)
+            LocalCache.set_many(memcached)
+            cached.update(memcached)
+        profiles = {
+            user_id: cached[key]
+            for user_id, key in keys.items()
+            if key in cached
+        }
+
+        missing_user_ids = [user_id for user_id in keys if user_id not in profiles]
+        if missing_user_ids:
+            loaded = {
+                profile.user_id: profile
+                for profile in UserProfile.objects.filter(user_id__in=missing_user_ids)
+            }
+            for user_id in missing_user_ids:
+                if user_id not in loaded:
+                    loaded[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+            loaded_profiles = {keys[user_id]: profile for user_id, profile in loaded.items()}
+            cache.set_many(loaded_profiles)
+            LocalCache.set_many(loaded_profiles)
+            profiles.update(loaded)
+
+        return profiles
+
+    @classmethod
+    def prefetch_profiles(cls, users):
+        # user.profile reads the prefetched profile (see accounts.models)
+        users = [user for user in users if not hasattr(user, '_cached_user_profile')]
+        profiles = cls.get_profiles_through_cache([user.id for user in users])
+        for user in users:
+            setattr(user, '_cached_user_profile', profiles[user.id])
+
+    @classmethod
+    def prefetch_users(cls, instances, id_attr='user_id', cache_attr='_cached_user'):
+        # users of a page and their profiles in one batch
+        users = MemcachedHelper.prefetch_objects(instances, User, id_attr, cache_attr)
+        cls.prefetch_profiles(users)
+        return users
+
     @classmethod
     def invalidate_profile_cache(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        LocalCache.delete(key)
\ No newline at end of file
@@ -1,9 +1,12 @@
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.serializers import PrefetchListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -23,8 +26,20 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, instances):
+        UserService.prefetch_users(instances)
+        # has_liked of the whole page in one query
+        self._liked_object_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            ContentType.objects.get_for_model(Comment),
+            [comment.id for comment in instances],
+        )
 
     def get_has_liked(self, obj):
+        if hasattr(self, '_liked_object_ids'):
+            return obj.id in self._liked_object_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_likes_count(self, obj):
@@ -2,23 +2,32 @@ from utils.redis_helper import RedisHelper
 
 def incr_comments_count(sender, instance, created, **kwargs):
     from django.db.models import F
+    from gatekeeper.models import GateKeeper
     from tweets.models import Tweet
 
     if not created:
         return
 
-    # .update will not trigger post_save listener
-    # update count in Tweet table
-    Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') + 1)
+    if GateKeeper.is_switch_on('switch_count_write_behind'):
+        # only a redis delta, written to db in batch by flush_count_deltas_task
+        RedisHelper.incr_count_delta(Tweet, instance.tweet_id, 'comments_count', 1)
+    else:
+        # .update will not trigger post_save listener
+        # update count in Tweet table
+        Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') + 1)
     # update count in redis
     RedisHelper.incr_count(instance.tweet, 'comments_count')
 
 def decr_comments_count(sender, instance, **kwargs):
     from django.db.models import F
+    from gatekeeper.models import GateKeeper
     from tweets.models import Tweet
 
-    # .update will not trigger post_save listener
-    # update count in Tweet table
-    Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') - 1)
+    if GateKeeper.is_switch_on('switch_count_write_behind'):
+        RedisHelper.incr_count_delta(Tweet, instance.tweet_id, 'comments_count', -1)
+    else:
+        # .update will not trigger post_save listener
+        # update count in Tweet table
+        Tweet.objects.filter(id=instance.tweet_id).update(comments_count=F('comments_count') - 1)
     # update count in redis
     RedisHelper.decr_count(instance.tweet, 'comments_count')
\ No newline at end of file
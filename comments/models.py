@@ -41,6 +41,9 @@ class Comment(models.Model):
 
     @property
     def cached_user(self):
+        # set by the list serializer prefetch
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 pre_delete.connect(decr_comments_count, sender=Comment)
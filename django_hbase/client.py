@@ -1,14 +1,125 @@
+from contextlib import contextmanager
 from django.conf import settings
+from happybase.pool import NoConnectionsAvailable
+from thriftpy2.thrift import TException
 
 import happybase
+import socket
+import threading
+import time
 
 
 class HBaseClient:
-    conn = None
+    # one pool per process, every thread checks out its own thrift connection
+    pool = None
+    _pool_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    # connections checked out of the pool, nested calls are not counted
+    _in_use = 0
+    stats = {
+        'checkouts': 0,
+        'timeouts': 0,
+        'reconnects': 0,
+        'max_in_use': 0,
+    }
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
+    def get_pool(cls):
+        if cls.pool is not None:
+            return cls.pool
+
+        with cls._pool_lock:
+            # another thread may have created the pool while we were waiting
+            if cls.pool is None:
+                cls.pool = happybase.ConnectionPool(
+                    size=settings.HBASE_POOL_SIZE,
+                    host=settings.HBASE_HOST,
+                    timeout=settings.HBASE_CONNECTION_TIMEOUT,
+                )
+        return cls.pool
+
+    @classmethod
+    @contextmanager
+    def connection(cls, timeout=None):
+        """
+        with HBaseClient.connection() as conn:
+            conn.table('twitter_followings').row(row_key)
+
+        nested calls in the same thread reuse the same connection, a broken
+        thrift transport is replaced by the pool before the error is re-raised.
+        """
+        if timeout is None:
+            timeout = settings.HBASE_POOL_TIMEOUT
+        pool = cls.get_pool()
+        try:
+            with pool.connection(timeout=timeout) as conn:
+                # the pool hands the same connection to nested calls of a thread
+                outermost = not getattr(conn, 'checked_out', False)
+                if outermost:
+                    conn.checked_out = True
+                    cls._record_checkout()
+                    cls._health_check(conn)
+                try:
+                    yield conn
+                except (TException, socket.error):
+                    cls._incr_stat('reconnects')
+                    raise
+                finally:
+                    if outermost:
+                        conn.checked_out = False
+                        conn.last_used_at = time.time()
+                        cls._record_return()
+        except NoConnectionsAvailable:
+            cls._incr_stat('timeouts')
+            raise
+
+    @classmethod
+    def _health_check(cls, conn):
+        # a connection idle for a long time may have been closed by the
+        # thrift server, ping it before handing it out and reconnect if needed
+        last_used_at = getattr(conn, 'last_used_at', None)
+        if last_used_at is None:
+            return
+        if time.time() - last_used_at < settings.HBASE_POOL_HEALTH_CHECK_INTERVAL:
+            return
+        try:
+            conn.tables()
+        except (TException, socket.error):
+            cls._incr_stat('reconnects')
+            # a new socket on the same transport, the thrift client keeps working
+            conn.close()
+            conn.open()
+
+    @classmethod
+    def _record_checkout(cls):
+        with cls._stats_lock:
+            cls._in_use += 1
+            cls.stats['checkouts'] += 1
+            cls.stats['max_in_use'] = max(cls.stats['max_in_use'], cls._in_use)
+
+    @classmethod
+    def _record_return(cls):
+        with cls._stats_lock:
+            cls._in_use -= 1
+
+    @classmethod
+    def _incr_stat(cls, name):
+        with cls._stats_lock:
+            cls.stats[name] += 1
+
+    @classmethod
+    def get_in_use(cls):
+        # counted here, happybase has no public api for the pool queue
+        with cls._stats_lock:
+            return cls._in_use
+
+    @classmethod
+    def get_pool_stats(cls):
+        # used to size HBASE_POOL_SIZE per worker: if max_in_use keeps hitting
+        # size or timeouts grows, the pool is too small
+        with cls._stats_lock:
+            stats = dict(cls.stats)
+        stats['size'] = settings.HBASE_POOL_SIZE
+        stats['in_use'] = cls.get_in_use()
+        stats['available'] = stats['size'] - stats['in_use']
+        return stats
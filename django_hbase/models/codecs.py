@@ -0,0 +1,116 @@
+from .exceptions import BadRowKeyError
+from .fields import IntegerField, TimestampField
+
+import struct
+
+# signed 64 bits ints are shifted into the unsigned range, so that byte order
+# is the same as numeric order (negative values sort before positive ones)
+SIGN_OFFSET = 1 << 63
+
+
+class StringRowKeyCodec:
+    """
+    {key1: 1} => b"0000000000000001"
+    {key1: 1, key2: 2} => b"0000000000000001:0000000000000002"
+    the original format, tables created before the binary codec use it
+    """
+
+    def __init__(self, fields, salt_buckets=0):
+        if salt_buckets:
+            raise BadRowKeyError('salt is only supported by the binary row key codec')
+        self.fields = fields
+
+    def serialize(self, data, is_prefix=False):
+        values = []
+        for key, field in self.fields:
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                break
+            value = field.serialize(value)
+            if ':' in value:
+                raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
+            values.append(value)
+        return bytes(':'.join(values), encoding='utf-8')
+
+    def deserialize(self, row_key):
+        if isinstance(row_key, bytes):
+            row_key = row_key.decode('utf-8')
+
+        # zip stops at the shorter one, so a prefix only fills the first keys
+        return {
+            key: field.deserialize(value)
+            for (key, field), value in zip(self.fields, row_key.split(':'))
+        }
+
+
+class BinaryRowKeyCodec:
+    """
+    {key1: 1, key2: 2} => 16 bytes, every field is 8 bytes big-endian
+    - reverse=True stores the field byte reversed (little-endian), sequential
+      ids are spread over regions but can not be range scanned, same trade-off
+      as reverse=True in the string codec
+    - salt_buckets=N prepends 1 byte (first field % N), rows of the same first
+      field stay together so prefix scans on it still work
+    only integer and timestamp fields can be used in a binary row key
+    """
+    field_size = 8
+
+    def __init__(self, fields, salt_buckets=0):
+        for key, field in fields:
+            if not isinstance(field, (IntegerField, TimestampField)):
+                raise BadRowKeyError(f"{key} can not be used in a binary row key")
+        if not 0 <= salt_buckets <= 256:
+            raise BadRowKeyError('salt_buckets should be between 0 and 256')
+
+        self.fields = fields
+        self.keys = [key for key, field in fields]
+        self.salt_buckets = salt_buckets
+        self.offset = 1 if salt_buckets else 0
+        self.structs = [
+            struct.Struct('<Q' if field.reverse else '>Q')
+            for key, field in fields
+        ]
+        # without reversed fields a full row key is parsed in one struct call
+        self.row_key_struct = None
+        if not any(field.reverse for key, field in fields):
+            self.row_key_struct = struct.Struct('>' + 'Q' * len(fields))
+
+    def serialize(self, data, is_prefix=False):
+        values = []
+        for key, packer in zip(self.keys, self.structs):
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                break
+            try:
+                values.append(packer.pack(value + SIGN_OFFSET))
+            except struct.error:
+                raise BadRowKeyError(f"{key} should be a 64 bits integer: {value}")
+        if values and self.salt_buckets:
+            values.insert(0, bytes((data[self.keys[0]] % self.salt_buckets, )))
+        return b''.join(values)
+
+    def deserialize(self, row_key):
+        count = (len(row_key) - self.offset) // self.field_size
+        if count == len(self.keys) and self.row_key_struct is not None:
+            values = self.row_key_struct.unpack_from(row_key, self.offset)
+            return {
+                key: value - SIGN_OFFSET
+                for key, value in zip(self.keys, values)
+            }
+
+        data = {}
+        for index in range(min(count, len(self.keys))):
+            offset = self.offset + index * self.field_size
+            value = self.structs[index].unpack_from(row_key, offset)[0]
+            data[self.keys[index]] = value - SIGN_OFFSET
+        return data
+
+
+ROW_KEY_CODECS = {
+    'string': StringRowKeyCodec,
+    'binary': BinaryRowKeyCodec,
+}
@@ -1,3 +1,6 @@
+import struct
+
+
 class HBaseField:
     field_type = None
 
@@ -5,6 +8,18 @@ class HBaseField:
         self.reverse = reverse
         self.column_family = column_family
 
+    def serialize(self, value):
+        value = str(value)
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        # value can be str (from row key) or bytes (from column value)
+        if self.reverse:
+            value = value[::-1]
+        return value
+
 
 class IntegerField(HBaseField):
     field_type = 'int'
@@ -12,9 +27,42 @@ class IntegerField(HBaseField):
     def __init__(self, *args, **kwargs):
         super(IntegerField, self).__init__(*args, **kwargs)
 
+    def serialize(self, value):
+        # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
+        # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
+        value = str(value).rjust(16, '0')
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        if self.reverse:
+            value = value[::-1]
+        return int(value)
+
 
 class TimestampField(HBaseField):
     field_type = 'timestamp'
 
     def __init__(self, *args, **kwargs):
         super(TimestampField, self).__init__( *args, **kwargs)
+
+    def deserialize(self, value):
+        if self.reverse:
+            value = value[::-1]
+        return int(value)
+
+
+class CounterField(HBaseField):
+    # hbase atomic counters are stored as 8 bytes big-endian signed long,
+    # only use it for column keys and update it with counter_inc / counter_set
+    field_type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super(CounterField, self).__init__(*args, **kwargs)
+
+    def serialize(self, value):
+        return struct.pack('>q', value)
+
+    def deserialize(self, value):
+        return struct.unpack('>q', value)[0]
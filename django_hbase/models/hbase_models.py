@@ -1,19 +1,72 @@
-from .exceptions import BadRowKeyError, EmptyColumnError
-from .fields import HBaseField, IntegerField, TimestampField
+from .codecs import ROW_KEY_CODECS
+from .exceptions import EmptyColumnError
+from .fields import HBaseField
+from contextlib import contextmanager
 from django.conf import settings
 from django_hbase.client import HBaseClient
 
 
 class HBaseModel:
+    # field metadata, computed once per subclass in __init_subclass__
+    _fields = {}
+    _row_key_fields = []
+    _row_key_codec = None
+    _column_fields = []
+    _column_key_hash = {}
+    _column_families = set()
 
     class Meta:
         table_name = None
         row_key = ()
+        # 'string' (default) or 'binary', see django_hbase.models.codecs
+        row_key_codec = 'string'
+        # binary codec only, prepend a salt byte to spread hot row keys
+        row_key_salt_buckets = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._prepare_fields()
+
+    @classmethod
+    def _prepare_fields(cls):
+        fields = {
+            key: value
+            for key, value in cls.__dict__.items()
+            if isinstance(value, HBaseField)
+        }
+        cls._fields = fields
+        cls._row_key_fields = [
+            (key, fields[key])
+            for key in cls.Meta.row_key
+            if key in fields
+        ]
+        codec_class = ROW_KEY_CODECS[getattr(cls.Meta, 'row_key_codec', 'string')]
+        cls._row_key_codec = codec_class(
+            cls._row_key_fields,
+            salt_buckets=getattr(cls.Meta, 'row_key_salt_buckets', 0),
+        )
+        cls._column_fields = [
+            (key, field, '{}:{}'.format(field.column_family, key))
+            for key, field in fields.items()
+            if field.column_family
+        ]
+        # b'cf:to_user_id' => ('to_user_id', field), so init_from_row does not
+        # need to decode and split every column key
+        cls._column_key_hash = {
+            column_key.encode('utf-8'): (key, field)
+            for key, field, column_key in cls._column_fields
+        }
+        cls._column_families = {
+            field.column_family
+            for key, field, column_key in cls._column_fields
+        }
 
     @classmethod
+    @contextmanager
     def get_table(cls):
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+        # the table is only usable while the pooled connection is checked out
+        with HBaseClient.connection() as conn:
+            yield conn.table(cls.get_table_name())
 
     @property
     def row_key(self):
@@ -21,28 +74,21 @@ class HBaseModel:
 
     @classmethod
     def get_field_hash(cls):
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        return cls._fields
 
     def __init__(self, **kwargs):
-        for key, field in self.get_field_hash().items():
-            value = kwargs.get(key)
-            setattr(self, key, value)
+        for key in self._fields:
+            setattr(self, key, kwargs.get(key))
 
     @classmethod
     def init_from_row(cls, row_key, row_data):
         if not row_data:
             return None
         data = cls.deserialize_row_key(row_key)
+        column_key_hash = cls._column_key_hash
         for column_key, column_value in row_data.items():
-            # remove column family
-            column_key = column_key.decode('utf-8')
-            key = column_key[column_key.find(':') + 1:]
-            data[key] = cls.deserialize_field(key, column_value)
+            key, field = column_key_hash[column_key]
+            data[key] = field.deserialize(column_value)
         return cls(**data)
 
     @classmethod
@@ -52,22 +98,9 @@ class HBaseModel:
         {key1: val1} => b"val1"
         {key1: val1, key2: val2} => b"val1:val2"
         {key1: val1, key2: val2, key3: val3} => b"val1:val2:val3"
+        (with the string codec, the binary codec packs each value in 8 bytes)
         """
-        field_hash = cls.get_field_hash()
-        values = []
-        for key, field in field_hash.items():
-            if field.column_family:
-                continue
-            value = data.get(key)
-            if value is None:
-                if not is_prefix:
-                    raise BadRowKeyError(f"{key} is missing in row key")
-                break
-            value = cls.serialize_field(field, value)
-            if ':' in value:
-                raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
-            values.append(value)
-        return bytes(':'.join(values), encoding='utf-8')
+        return cls._row_key_codec.serialize(data, is_prefix=is_prefix)
 
     @classmethod
     def deserialize_row_key(cls, row_key):
@@ -76,54 +109,24 @@ class HBaseModel:
         "val1:val2" => {'key1': val1, 'key2': val2, 'key3': None}
         "val1:val2:val3" => {'key1': val1, 'key2': val2, 'key3': val3}
         """
-        data = {}
-        if isinstance(row_key, bytes):
-            row_key = row_key.decode('utf-8')
-
-        # val1:val2 => val1:val2: 方便每次 find(':') 都能找到一个 val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
-                break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
-        return data
+        return cls._row_key_codec.deserialize(row_key)
 
     @classmethod
     def serialize_field(cls, field, value):
-        value = str(value)
-        if isinstance(field, IntegerField):
-            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
-            # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
-        if field.reverse:
-            value = value[::-1]
-        return value
+        return field.serialize(value)
 
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(value)
-        return value
+        return cls._fields[key].deserialize(value)
 
     @classmethod
     def serialize_row_data(cls, data):
         row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
-            if not field.column_family:
-                continue
-            column_key = '{}:{}'.format(field.column_family, key)
+        for key, field, column_key in cls._column_fields:
             column_value = data.get(key)
             if column_value is None:
                 continue
-            row_data[column_key] = cls.serialize_field(field, column_value)
+            row_data[column_key] = field.serialize(column_value)
         return row_data
 
     def save(self, batch=None):
@@ -135,16 +138,29 @@ class HBaseModel:
         if batch:
             batch.put(self.row_key, row_data)
         else:
-            table = self.get_table()
-            table.put(self.row_key, row_data)
+            with self.get_table() as table:
+                table.put(self.row_key, row_data)
 
     @classmethod
     def get(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row = table.row(row_key)
+        with cls.get_table() as table:
+            row = table.row(row_key)
         return cls.init_from_row(row_key, row)
 
+    @classmethod
+    def get_many(cls, keys):
+        """
+        [{key1: val1, key2: val2}, ...] => [instance or None, ...]
+        one table.rows() round trip, results are in the same order as keys
+        """
+        row_keys = [cls.serialize_row_key(key) for key in keys]
+        if not row_keys:
+            return []
+        with cls.get_table() as table:
+            rows = dict(table.rows(row_keys))
+        return [cls.init_from_row(row_key, rows.get(row_key)) for row_key in row_keys]
+
     @classmethod
     def create(cls, batch=None, **kwargs):
         instance = cls(**kwargs)
@@ -152,15 +168,25 @@ class HBaseModel:
         return instance
 
     @classmethod
-    def batch_create(cls, batch_data):
-        table = cls.get_table()
-        batch = table.batch()
-        results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
+    def batch_create(cls, batch_data, batch_size=None):
+        # with batch_size, happybase sends the batch every batch_size puts
+        # instead of one unbounded request at the end
+        with cls.get_table() as table:
+            batch = table.batch(batch_size=batch_size)
+            results = []
+            for data in batch_data:
+                results.append(cls.create(batch=batch, **data))
+            batch.send()
         return results
 
+    @classmethod
+    def batch_delete(cls, keys, batch_size=None):
+        with cls.get_table() as table:
+            batch = table.batch(batch_size=batch_size)
+            for key in keys:
+                batch.delete(cls.serialize_row_key(key))
+            batch.send()
+
     @classmethod
     def get_table_name(cls):
         if not cls.Meta.table_name:
@@ -173,23 +199,22 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You can not drop table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
 
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        with HBaseClient.connection() as conn:
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            column_families = {
+                column_family: dict()
+                for column_family in cls._column_families
+            }
+            conn.create_table(cls.get_table_name(), column_families)
 
     # <HOMEWORK> 实现一个 get_or_create 的方法，返回 (instance, created)
 
@@ -205,24 +230,92 @@ class HBaseModel:
 
     @classmethod
     def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+        return list(cls.iter_filter(
+            start=start,
+            stop=stop,
+            prefix=prefix,
+            limit=limit,
+            reverse=reverse,
+        ))
+
+    @classmethod
+    def iter_filter(
+        cls,
+        start=None,
+        stop=None,
+        prefix=None,
+        limit=None,
+        reverse=False,
+        batch_size=1000,
+        columns=None,
+        keys_only=False,
+    ):
+        """
+        yield instances one by one instead of building a list, memory stays
+        constant however many rows match. rows are fetched from the region
+        servers batch_size at a time.
+        - columns: only fetch these column fields, e.g. ['to_user_id']
+        - keys_only: only fetch row keys, column fields are left as None
+        break out of the loop (or close() the generator) to stop the scan early,
+        the pooled connection is held until then.
+        """
         # serialize tuple to str
         row_start = cls.serialize_row_key_from_tuple(start)
         row_stop = cls.serialize_row_key_from_tuple(stop)
         row_prefix = cls.serialize_row_key_from_tuple(prefix)
 
-        # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse)
+        scan_columns = None
+        if columns is not None:
+            scan_columns = [cls.get_column_key(key) for key in columns]
+        scan_filter = None
+        if keys_only:
+            # the region servers strip the column values, only row keys travel
+            scan_filter = b'KeyOnlyFilter() AND FirstKeyOnlyFilter()'
 
-        # deserialize to instance list
-        results = []
-        for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+        with cls.get_table() as table:
+            rows = table.scan(
+                row_start,
+                row_stop,
+                row_prefix,
+                columns=scan_columns,
+                filter=scan_filter,
+                batch_size=batch_size,
+                limit=limit,
+                reverse=reverse,
+            )
+            try:
+                for row_key, row_data in rows:
+                    if keys_only:
+                        yield cls(**cls.deserialize_row_key(row_key))
+                    else:
+                        yield cls.init_from_row(row_key, row_data)
+            finally:
+                # closes the scanner on the thrift server on early termination
+                rows.close()
+
+    @classmethod
+    def get_column_key(cls, key):
+        return '{}:{}'.format(cls._fields[key].column_family, key)
+
+    @classmethod
+    def counter_inc(cls, key, value=1, **kwargs):
+        # atomic on the region server, returns the new value
+        row_key = cls.serialize_row_key(kwargs)
+        with cls.get_table() as table:
+            return table.counter_inc(row_key, cls.get_column_key(key), value)
+
+    @classmethod
+    def counter_dec(cls, key, value=1, **kwargs):
+        return cls.counter_inc(key, -value, **kwargs)
+
+    @classmethod
+    def counter_set(cls, key, value, **kwargs):
+        row_key = cls.serialize_row_key(kwargs)
+        with cls.get_table() as table:
+            table.counter_set(row_key, cls.get_column_key(key), value)
 
     @classmethod
     def delete(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
+        with cls.get_table() as table:
+            return table.delete(row_key)
@@ -2,11 +2,15 @@ from accounts.api.serializers import UserSerializerForFriendship
 from accounts.services import UserService
 from friendships.models import Friendship
 from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from utils.serializers import PrefetchListSerializer
 
 
 class FollowingUserIdSetMixin:
+    # which user id of a friendship the current user may have followed
+    user_id_attr = None
 
     @property
     def following_user_id_set(self):
@@ -16,21 +20,53 @@ class FollowingUserIdSetMixin:
 
         if hasattr(self, '_cached_following_user_id_set'):
             return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
-            self.context['request'].user.id
-        )
+        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            # only check the users on this page, with one batched get
+            user_id_set = FriendshipService.get_followed_user_id_set(
+                self.context['request'].user.id,
+                [getattr(obj, self.user_id_attr) for obj in self.page_instances],
+            )
+        else:
+            user_id_set = FriendshipService.get_following_user_id_set(
+                self.context['request'].user.id
+            )
         setattr(self, '_cached_following_user_id_set', user_id_set)
 
         return user_id_set
 
+    def prefetch(self, instances):
+        # users of the page in one batch, kept on the serializer like the
+        # following user id set
+        users = UserService.get_users_through_cache(
+            [getattr(obj, self.user_id_attr) for obj in instances],
+        )
+        UserService.prefetch_profiles(users)
+        self._prefetched_users = {user.id: user for user in users}
+
+    def get_cached_user(self, user_id):
+        if user_id in getattr(self, '_prefetched_users', {}):
+            return self._prefetched_users[user_id]
+        return UserService.get_user_through_cache(user_id)
+
+    @property
+    def page_instances(self):
+        # many=True wraps this serializer in a ListSerializer holding the page
+        if isinstance(self.parent, serializers.ListSerializer):
+            return self.parent.instance
+        return [self.instance]
+
 
 class FollowerSerializer(serializers.Serializer, FollowingUserIdSetMixin):
+    user_id_attr = 'from_user_id'
     user = serializers.SerializerMethodField()
     has_followed = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = PrefetchListSerializer
+
     def get_user(self, obj):
-        user = UserService.get_user_through_cache(obj.from_user_id)
+        user = self.get_cached_user(obj.from_user_id)
         # .data is required due to SerializerMethodField
         return UserSerializerForFriendship(user).data
 
@@ -43,12 +79,16 @@ class FollowerSerializer(serializers.Serializer, FollowingUserIdSetMixin):
 
 
 class FollowingSerializer(serializers.Serializer, FollowingUserIdSetMixin):
+    user_id_attr = 'to_user_id'
     user = serializers.SerializerMethodField()
     has_followed = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = PrefetchListSerializer
+
     def get_user(self, obj):
-        user = UserService.get_user_through_cache(obj.to_user_id)
+        user = self.get_cached_user(obj.to_user_id)
         return UserSerializerForFriendship(user).data
 
     # current user checks if he followed user A's followers
@@ -0,0 +1,16 @@
+from django.conf import settings
+
+RECONCILE_COUNTS_BATCH_SIZE = 1000 if not settings.TESTING else 3
+# max mutations sent to hbase in one request by bulk follow / unfollow
+FRIENDSHIP_BATCH_SIZE = 100 if not settings.TESTING else 2
+# follower ids read per query / hbase scan batch when streaming followers
+FOLLOWER_IDS_BATCH_SIZE = 1000 if not settings.TESTING else 2
+
+
+class BulkFriendshipStatus:
+    FOLLOWED = 'followed'
+    UNFOLLOWED = 'unfollowed'
+    ALREADY_FOLLOWED = 'already_followed'
+    NOT_FOLLOWED = 'not_followed'
+    # can not follow or unfollow yourself
+    INVALID = 'invalid'
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from friendships.models import HBaseFollowing, HBaseFriendship
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Build the HBaseFriendship (from_user_id, to_user_id) index from HBaseFollowing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        start = time.time()
+        count = 0
+        with HBaseFriendship.get_table() as table:
+            # happybase sends the batch every batch_size puts and on exit
+            with table.batch(batch_size=batch_size) as batch:
+                followings = HBaseFollowing.iter_filter(batch_size=batch_size)
+                for following in followings:
+                    # put is idempotent, re-running the backfill is safe
+                    HBaseFriendship.create(
+                        batch=batch,
+                        from_user_id=following.from_user_id,
+                        to_user_id=following.to_user_id,
+                        created_at=following.created_at,
+                    )
+                    count += 1
+                    if count % (batch_size * 10) == 0:
+                        self.stdout.write('{} friendships indexed'.format(count))
+
+        self.stdout.write(self.style.SUCCESS('{} friendships indexed in {:.1f}s'.format(
+            count,
+            time.time() - start,
+        )))
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django_hbase.models.codecs import BinaryRowKeyCodec, StringRowKeyCodec
+from friendships.models import HBaseFollowing
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Measure HBaseModel row (de)serialization and row key codec throughput, no HBase needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = self.build_rows(options['rows'])
+        total = options['rows'] * options['repeat']
+
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            for row_key, row_data in rows:
+                HBaseFollowing.init_from_row(row_key, row_data)
+        self.report('init_from_row', total, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            for row_key, row_data in rows:
+                HBaseFollowing.deserialize_row_key(row_key)
+        self.report('deserialize_row_key', total, time.perf_counter() - start)
+
+        instances = [HBaseFollowing.init_from_row(*row) for row in rows]
+        start = time.perf_counter()
+        for _ in range(options['repeat']):
+            for instance in instances:
+                instance.row_key
+                HBaseFollowing.serialize_row_data(instance.__dict__)
+        self.report('serialize_row_key + row_data', total, time.perf_counter() - start)
+
+        # compare row key codecs on the same (from_user_id, created_at) keys
+        data_list = [HBaseFollowing.deserialize_row_key(row_key) for row_key, _ in rows]
+        codecs = [
+            ('string', StringRowKeyCodec(HBaseFollowing._row_key_fields)),
+            ('binary', BinaryRowKeyCodec(HBaseFollowing._row_key_fields)),
+            ('binary+salt', BinaryRowKeyCodec(HBaseFollowing._row_key_fields, salt_buckets=16)),
+        ]
+        for name, codec in codecs:
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                row_keys = [codec.serialize(data) for data in data_list]
+            self.report('{} encode'.format(name), total, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(options['repeat']):
+                for row_key in row_keys:
+                    codec.deserialize(row_key)
+            self.report('{} decode'.format(name), total, time.perf_counter() - start)
+            self.stdout.write('{} key size: {} bytes'.format(name, len(row_keys[0])))
+
+    def build_rows(self, count):
+        # rows look like what happybase returns from table.scan()
+        rows = []
+        now = int(time.time() * 1000000)
+        for i in range(count):
+            data = {'from_user_id': 12345, 'created_at': now + i, 'to_user_id': i}
+            row_data = {
+                column_key.encode('utf-8'): value.encode('utf-8')
+                for column_key, value in HBaseFollowing.serialize_row_data(data).items()
+            }
+            rows.append((HBaseFollowing.serialize_row_key(data), row_data))
+        return rows
+
+    def report(self, name, total, seconds):
+        self.stdout.write('{}: {:.0f} rows/sec'.format(name, total / seconds))
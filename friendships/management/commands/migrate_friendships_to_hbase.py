@@ -0,0 +1,470 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Count, Max, Min, Q
+from django_hbase.client import HBaseClient
+from friendships.models import (
+    Friendship,
+    HBaseFollower,
+    HBaseFollowing,
+    HBaseFriendship,
+    HBaseFriendshipCount,
+)
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from utils.redis_client import RedisClient
+from utils.time_helpers import datetime_to_microseconds
+
+import time
+
+# set of finished range starts, a new run skips them
+CHECKPOINT_PATTERN = 'friendship_migration:{range_size}:done_ranges'
+
+
+def init_worker():
+    # forked workers must not share the sockets of the parent process
+    connections.close_all()
+    HBaseClient.pool = None
+    RedisClient.conn = None
+
+
+def migrate_range(start_id, stop_id, batch_size, checkpoint_key):
+    # MySQL does not stream results, the id range keeps each query small
+    rows = Friendship.objects.filter(
+        id__gte=start_id,
+        id__lt=stop_id,
+    ).order_by('id').values_list('from_user_id', 'to_user_id', 'created_at')
+
+    friendships = []
+    count = 0
+    for from_user_id, to_user_id, created_at in rows.iterator(chunk_size=batch_size):
+        # the user has been deleted
+        if from_user_id is None or to_user_id is None:
+            continue
+        # same created_at as the double write, rerunning a range rewrites
+        # the same row keys instead of creating duplicates
+        friendships.append({
+            'from_user_id': from_user_id,
+            'to_user_id': to_user_id,
+            'created_at': datetime_to_microseconds(created_at),
+        })
+        if len(friendships) == batch_size:
+            FriendshipService.write_friendships_to_hbase(friendships, batch_size)
+            count += len(friendships)
+            friendships = []
+    if friendships:
+        FriendshipService.write_friendships_to_hbase(friendships, batch_size)
+        count += len(friendships)
+
+    RedisClient.get_connection().sadd(checkpoint_key, start_id)
+    return start_id, count
+
+
+def set_counts_range(start_id, stop_id):
+    # the copy does not touch the hbase counters, they are set from the
+    # MySQL counts once all the rows are copied. a follow double written
+    # between the count and counter_set can leave one off, verify reports it
+    followings_counts = dict(Friendship.objects.filter(
+        from_user_id__gte=start_id,
+        from_user_id__lt=stop_id,
+        to_user_id__isnull=False,
+    ).values('from_user_id').annotate(count=Count('id')).values_list('from_user_id', 'count'))
+    followers_counts = dict(Friendship.objects.filter(
+        to_user_id__gte=start_id,
+        to_user_id__lt=stop_id,
+        from_user_id__isnull=False,
+    ).values('to_user_id').annotate(count=Count('id')).values_list('to_user_id', 'count'))
+
+    user_ids = set(followings_counts) | set(followers_counts)
+    for user_id in user_ids:
+        HBaseFriendshipCount.counter_set(
+            'followings_count',
+            followings_counts.get(user_id, 0),
+            user_id=user_id,
+        )
+        HBaseFriendshipCount.counter_set(
+            'followers_count',
+            followers_counts.get(user_id, 0),
+            user_id=user_id,
+        )
+    return start_id, len(user_ids)
+
+
+MISSING = 'missing'
+STALE = 'stale'
+
+
+def diff_sorted(expected, actual):
+    """
+    merge two streams of tuples sorted the same way, yields (MISSING, item)
+    for items only in expected and (STALE, item) for items only in actual
+    """
+    expected, actual = iter(expected), iter(actual)
+    expected_item, actual_item = next(expected, None), next(actual, None)
+    while expected_item is not None or actual_item is not None:
+        if actual_item is None or (expected_item is not None and expected_item < actual_item):
+            yield MISSING, expected_item
+            expected_item = next(expected, None)
+        elif expected_item is None or actual_item < expected_item:
+            yield STALE, actual_item
+            actual_item = next(actual, None)
+        else:
+            expected_item, actual_item = next(expected, None), next(actual, None)
+
+
+def diff_user(user_id):
+    """
+    compare the MySQL friendships of a user with the three hbase tables row by
+    row, both sides are streamed in the same order so memory stays constant.
+    yields (MISSING or STALE, hbase model, friendship dict)
+    """
+    followings = Friendship.objects.filter(from_user_id=user_id, to_user_id__isnull=False)
+    followers = Friendship.objects.filter(to_user_id=user_id, from_user_id__isnull=False)
+
+    # HBaseFollowing, row key (from_user_id, created_at)
+    for status, (created_at, to_user_id) in diff_sorted(
+        (
+            (datetime_to_microseconds(created_at), to_user_id)
+            for created_at, to_user_id in followings.order_by(
+                'created_at', 'to_user_id',
+            ).values_list('created_at', 'to_user_id').iterator()
+        ),
+        (
+            (following.created_at, following.to_user_id)
+            for following in HBaseFollowing.iter_filter(prefix=(user_id, ))
+        ),
+    ):
+        yield status, HBaseFollowing, {
+            'from_user_id': user_id,
+            'to_user_id': to_user_id,
+            'created_at': created_at,
+        }
+
+    # HBaseFriendship index, row key (from_user_id, to_user_id)
+    for status, (to_user_id, created_at) in diff_sorted(
+        (
+            (to_user_id, datetime_to_microseconds(created_at))
+            for to_user_id, created_at in followings.order_by(
+                'to_user_id',
+            ).values_list('to_user_id', 'created_at').iterator()
+        ),
+        (
+            (friendship.to_user_id, friendship.created_at)
+            for friendship in HBaseFriendship.iter_filter(prefix=(user_id, ))
+        ),
+    ):
+        yield status, HBaseFriendship, {
+            'from_user_id': user_id,
+            'to_user_id': to_user_id,
+            'created_at': created_at,
+        }
+
+    # HBaseFollower, row key (to_user_id, created_at)
+    for status, (created_at, from_user_id) in diff_sorted(
+        (
+            (datetime_to_microseconds(created_at), from_user_id)
+            for created_at, from_user_id in followers.order_by(
+                'created_at', 'from_user_id',
+            ).values_list('created_at', 'from_user_id').iterator()
+        ),
+        (
+            (follower.created_at, follower.from_user_id)
+            for follower in HBaseFollower.iter_filter(prefix=(user_id, ))
+        ),
+    ):
+        yield status, HBaseFollower, {
+            'from_user_id': from_user_id,
+            'to_user_id': user_id,
+            'created_at': created_at,
+        }
+
+
+def get_mysql_friendships(user_id, friendships):
+    # the diff is not atomic with live double writes, the rows are read again
+    # right before a fix so that a follow/unfollow in between is not undone
+    from_user_ids = [f['from_user_id'] for f in friendships if f['to_user_id'] == user_id]
+    to_user_ids = [f['to_user_id'] for f in friendships if f['from_user_id'] == user_id]
+    rows = Friendship.objects.filter(
+        Q(from_user_id=user_id, to_user_id__in=to_user_ids) |
+        Q(to_user_id=user_id, from_user_id__in=from_user_ids)
+    ).values_list('from_user_id', 'to_user_id', 'created_at')
+    return {
+        (from_user_id, to_user_id): datetime_to_microseconds(created_at)
+        for from_user_id, to_user_id, created_at in rows
+    }
+
+
+def delete_stale_rows(user_id, stale, batch_size):
+    mysql_friendships = get_mysql_friendships(user_id, [friendship for model, friendship in stale])
+    keys = {HBaseFollowing: [], HBaseFollower: [], HBaseFriendship: []}
+    for model, friendship in stale:
+        created_at = mysql_friendships.get((friendship['from_user_id'], friendship['to_user_id']))
+        if model is HBaseFriendship:
+            # the index of a pair still in MySQL is rewritten by the missing
+            # rows pass, deleting it here would race with that write
+            if created_at is None:
+                keys[model].append(friendship)
+        elif created_at != friendship['created_at']:
+            keys[model].append(friendship)
+    for model, model_keys in keys.items():
+        if model_keys:
+            model.batch_delete(model_keys, batch_size=batch_size)
+
+
+def write_missing_rows(user_id, missing, batch_size):
+    mysql_friendships = get_mysql_friendships(user_id, missing)
+    friendships = {}
+    for friendship in missing:
+        pair = (friendship['from_user_id'], friendship['to_user_id'])
+        if mysql_friendships.get(pair) == friendship['created_at']:
+            # one friendship can be missing in all three tables
+            friendships[pair + (friendship['created_at'], )] = friendship
+    if friendships:
+        FriendshipService.write_friendships_to_hbase(list(friendships.values()), batch_size)
+
+
+def fix_user(user_id, status, fixer, batch_size):
+    rows = []
+    for row_status, model, friendship in diff_user(user_id):
+        if row_status != status:
+            continue
+        rows.append((model, friendship) if status == STALE else friendship)
+        if len(rows) == batch_size:
+            fixer(user_id, rows, batch_size)
+            rows = []
+    if rows:
+        fixer(user_id, rows, batch_size)
+
+
+def verify_user(user_id, fix=False, batch_size=1000):
+    """
+    report only unless fix is set, returns None if the user matches, else
+    (user_id, missing rows, stale rows, MySQL counts, hbase counts)
+    with fix, stale hbase rows are deleted, missing ones are written from
+    MySQL and the hbase counters are recounted
+    """
+    summary = {MISSING: 0, STALE: 0}
+    for status, model, friendship in diff_user(user_id):
+        summary[status] += 1
+    expected = (
+        Friendship.objects.filter(from_user_id=user_id, to_user_id__isnull=False).count(),
+        Friendship.objects.filter(to_user_id=user_id, from_user_id__isnull=False).count(),
+    )
+    actual = (
+        FriendshipService.get_friendship_count_from_hbase(user_id, 'followings_count'),
+        FriendshipService.get_friendship_count_from_hbase(user_id, 'followers_count'),
+    )
+    if not summary[MISSING] and not summary[STALE] and actual == expected:
+        return None
+
+    if fix:
+        # stale rows are deleted first, a stale row can have the row key of
+        # a missing one (same created_at, another user)
+        if summary[STALE]:
+            fix_user(user_id, STALE, delete_stale_rows, batch_size)
+        if summary[MISSING]:
+            fix_user(user_id, MISSING, write_missing_rows, batch_size)
+        FriendshipService.reconcile_friendship_counts(user_id)
+    return user_id, summary[MISSING], summary[STALE], expected, actual
+
+
+def verify_range(start_id, stop_id, fix, batch_size):
+    # users with at least one friendship in MySQL, either side
+    user_ids = set(Friendship.objects.filter(
+        from_user_id__gte=start_id,
+        from_user_id__lt=stop_id,
+    ).values_list('from_user_id', flat=True).distinct())
+    user_ids.update(Friendship.objects.filter(
+        to_user_id__gte=start_id,
+        to_user_id__lt=stop_id,
+    ).values_list('to_user_id', flat=True).distinct())
+    return verify_users(sorted(user_ids), fix, batch_size)
+
+
+def verify_users(user_ids, fix, batch_size):
+    mismatches = []
+    for user_id in user_ids:
+        mismatch = verify_user(user_id, fix, batch_size)
+        if mismatch is not None:
+            mismatches.append(mismatch)
+    return mismatches
+
+
+def iter_hbase_user_ids():
+    # the rows of a user are contiguous in every table, so a user id is
+    # yielded once per table
+    for model, key in (
+        (HBaseFollowing, 'from_user_id'),
+        (HBaseFriendship, 'from_user_id'),
+        (HBaseFollower, 'to_user_id'),
+        (HBaseFriendshipCount, 'user_id'),
+    ):
+        last_user_id = None
+        for instance in model.iter_filter(keys_only=True):
+            user_id = getattr(instance, key)
+            if user_id != last_user_id:
+                yield user_id
+                last_user_id = user_id
+
+
+def get_hbase_only_user_ids(batch_size):
+    # users with rows in hbase but none in MySQL, e.g. the deleted users,
+    # the user id ranges of the MySQL pass never visit them
+    hbase_only_user_ids = set()
+    user_ids = set()
+    for user_id in iter_hbase_user_ids():
+        if user_id not in hbase_only_user_ids:
+            user_ids.add(user_id)
+        if len(user_ids) == batch_size:
+            hbase_only_user_ids.update(user_ids - get_mysql_user_ids(user_ids))
+            user_ids = set()
+    if user_ids:
+        hbase_only_user_ids.update(user_ids - get_mysql_user_ids(user_ids))
+    return sorted(hbase_only_user_ids)
+
+
+def get_mysql_user_ids(user_ids):
+    mysql_user_ids = set(Friendship.objects.filter(
+        from_user_id__in=user_ids,
+    ).values_list('from_user_id', flat=True).distinct())
+    mysql_user_ids.update(Friendship.objects.filter(
+        to_user_id__in=user_ids,
+    ).values_list('to_user_id', flat=True).distinct())
+    return mysql_user_ids
+
+
+class Command(BaseCommand):
+    help = 'Copy MySQL friendships to HBase by primary key ranges, then verify them per user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--range-size', type=int, default=10000)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--reset', action='store_true', help='ignore the checkpoint')
+        parser.add_argument('--verify-only', action='store_true', help='skip the copy')
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='delete stale hbase rows, write missing ones and recount the hbase counters',
+        )
+
+    def handle(self, *args, **options):
+        if not options['verify_only']:
+            # new follows/unfollows go to both MySQL and HBase from now on,
+            # until switch_friendship_to_hbase is turned on
+            GateKeeper.set('switch_friendship_double_write', 'percent', 100)
+            self.stdout.write('switch_friendship_double_write is on')
+            self.migrate(options)
+        self.verify(options)
+
+    def migrate(self, options):
+        range_size = options['range_size']
+        checkpoint_key = CHECKPOINT_PATTERN.format(range_size=range_size)
+        conn = RedisClient.get_connection()
+        if options['reset']:
+            conn.delete(checkpoint_key)
+
+        bounds = Friendship.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('no friendship to migrate')
+            return
+
+        done = set(int(start_id) for start_id in conn.smembers(checkpoint_key))
+        # aligned to range_size so the ranges are the same in every run
+        first = bounds['min_id'] // range_size * range_size
+        ranges = [
+            (start_id, start_id + range_size)
+            for start_id in range(first, bounds['max_id'] + 1, range_size)
+            if start_id not in done
+        ]
+        self.stdout.write('{} ranges to migrate, {} done before'.format(len(ranges), len(done)))
+
+        start = time.time()
+        total = 0
+        results = self.run_in_pool(options['workers'], [
+            (migrate_range, start_id, stop_id, options['batch_size'], checkpoint_key)
+            for start_id, stop_id in ranges
+        ])
+        for index, (start_id, count) in enumerate(results):
+            total += count
+            self.stdout.write('[{}/{}] range {} done, {} friendships, {:.0f} friendships/sec'.format(
+                index + 1,
+                len(ranges),
+                start_id,
+                count,
+                total / max(time.time() - start, 1e-6),
+            ))
+        self.stdout.write(self.style.SUCCESS('{} friendships migrated in {:.1f}s'.format(
+            total,
+            time.time() - start,
+        )))
+        self.set_counts(options)
+
+    def set_counts(self, options):
+        range_size = options['range_size']
+        bounds = User.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            return
+
+        start = time.time()
+        first = bounds['min_id'] // range_size * range_size
+        users = 0
+        for start_id, count in self.run_in_pool(options['workers'], [
+            (set_counts_range, start_id, start_id + range_size)
+            for start_id in range(first, bounds['max_id'] + 1, range_size)
+        ]):
+            users += count
+        self.stdout.write(self.style.SUCCESS('HBase counters of {} users set in {:.1f}s'.format(
+            users,
+            time.time() - start,
+        )))
+
+    def verify(self, options):
+        range_size = options['range_size']
+        batch_size = options['batch_size']
+        fix = options['fix']
+        jobs = []
+        bounds = User.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is not None:
+            first = bounds['min_id'] // range_size * range_size
+            jobs = [
+                (verify_range, start_id, start_id + range_size, fix, batch_size)
+                for start_id in range(first, bounds['max_id'] + 1, range_size)
+            ]
+        hbase_only_user_ids = get_hbase_only_user_ids(batch_size)
+        self.stdout.write('{} users only in HBase'.format(len(hbase_only_user_ids)))
+        jobs += [
+            (verify_users, hbase_only_user_ids[index:index + range_size], fix, batch_size)
+            for index in range(0, len(hbase_only_user_ids), range_size)
+        ]
+
+        mismatches = 0
+        for range_mismatches in self.run_in_pool(options['workers'], jobs):
+            for user_id, missing, stale, expected, actual in range_mismatches:
+                mismatches += 1
+                self.stdout.write(self.style.WARNING(
+                    'user {}: {} rows missing in HBase, {} stale rows in HBase, '
+                    'MySQL (followings, followers) = {}, HBase = {}{}'.format(
+                        user_id,
+                        missing,
+                        stale,
+                        expected,
+                        actual,
+                        ', fixed' if fix else '',
+                    )
+                ))
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS('all users match'))
+        elif fix:
+            self.stdout.write(self.style.WARNING('{} users fixed, run --verify-only again to check'.format(mismatches)))
+        else:
+            self.stdout.write(self.style.ERROR('{} users do not match, rerun with --fix to repair HBase'.format(mismatches)))
+
+    def run_in_pool(self, workers, jobs):
+        # the parent connections must not be inherited by forked workers
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = [executor.submit(*job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
@@ -37,3 +37,39 @@ class HBaseFollower(models.HBaseModel):
     class Meta:
         row_key = ('to_user_id', 'created_at')
         table_name = 'twitter_followers'
+
+
+class HBaseFriendship(models.HBaseModel):
+    """
+    存储 from_user_id 是否 follow 了 to_user_id，row_key 为 from_user_id + to_user_id
+    是 HBaseFollowing 的二级索引，可以支持查询：
+     - A 是否关注了 B，一次 get 即可，不需要 scan A 关注的所有人
+     - A 关注 B 的时间，unfollow 时用来找到 HBaseFollowing/HBaseFollower 的 row_key
+    """
+    # row key
+    from_user_id = models.IntegerField(reverse=True)
+    to_user_id = models.IntegerField()
+    # column key
+    created_at = models.TimestampField(column_family='cf')
+
+    class Meta:
+        row_key = ('from_user_id', 'to_user_id')
+        table_name = 'twitter_friendships'
+
+
+class HBaseFriendshipCount(models.HBaseModel):
+    """
+    存储每个用户的粉丝数和关注数，follow/unfollow 时用 hbase 原子计数器更新
+    row_key 和 HBaseFollowing/HBaseFollower 的前缀编码一致
+    可以支持查询：
+     - A 有多少粉丝，A 关注了多少人，一次 get 即可，不需要 scan
+    """
+    # row key
+    user_id = models.IntegerField(reverse=True)
+    # column key
+    followers_count = models.CounterField(column_family='cf')
+    followings_count = models.CounterField(column_family='cf')
+
+    class Meta:
+        row_key = ('user_id', )
+        table_name = 'twitter_friendship_counts'
@@ -1,10 +1,22 @@
 from django.conf import settings
 from django.core.cache import caches
+from django.db.models import Q
+from friendships.constants import (
+    BulkFriendshipStatus,
+    FOLLOWER_IDS_BATCH_SIZE,
+    FRIENDSHIP_BATCH_SIZE,
+)
 from friendships.models import Friendship
-from friendships.models import HBaseFollower, HBaseFollowing
+from friendships.models import (
+    HBaseFollower,
+    HBaseFollowing,
+    HBaseFriendship,
+    HBaseFriendshipCount,
+)
 from gatekeeper.models import GateKeeper
 from time import time
 from twitter.cache import FOLLOWINGS_PATTERN
+from utils.time_helpers import datetime_to_microseconds
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -36,8 +48,48 @@ class FriendshipService:
 
     @classmethod
     def get_follower_ids(cls, tweet_user_id):
-        friendships = Friendship.objects.filter(to_user_id=tweet_user_id)
-        return [friendship.from_user_id for friendship in friendships]
+        return list(cls.iter_follower_ids(tweet_user_id))
+
+    @classmethod
+    def iter_follower_ids(cls, to_user_id, batch_size=FOLLOWER_IDS_BATCH_SIZE):
+        """
+        yield follower ids batch_size at a time, no Friendship objects are
+        created and memory stays constant however many followers
+        """
+        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            followers = HBaseFollower.iter_filter(
+                prefix=(to_user_id, ),
+                batch_size=batch_size,
+                columns=['from_user_id'],
+            )
+            for follower in followers:
+                yield follower.from_user_id
+            return
+
+        # keyset pagination on (created_at, id) to follow the (to_user,
+        # created_at) index, innodb appends the primary key to it. each batch
+        # is an index range scan starting after the last row, unlike a
+        # growing OFFSET
+        queryset = Friendship.objects.filter(to_user_id=to_user_id).order_by('created_at', 'id')
+        last_created_at, last_id = None, None
+        while True:
+            batch_queryset = queryset
+            if last_created_at is not None:
+                batch_queryset = queryset.filter(
+                    created_at__gte=last_created_at,
+                ).filter(
+                    Q(created_at__gt=last_created_at) | Q(id__gt=last_id),
+                )
+            rows = list(batch_queryset.values_list(
+                'created_at',
+                'id',
+                'from_user_id',
+            )[:batch_size])
+            for _, _, from_user_id in rows:
+                yield from_user_id
+            if len(rows) < batch_size:
+                return
+            last_created_at, last_id, _ = rows[-1]
 
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
@@ -69,23 +121,43 @@ class FriendshipService:
 
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             # crate friendship in MySQL
-            return Friendship.objects.create(
+            friendship = Friendship.objects.create(
                 from_user_id=from_user_id,
                 to_user_id=to_user_id
             )
+            if cls.is_double_write_on():
+                # same created_at as MySQL, so the migration rewrites the same row keys
+                cls.follow_in_hbase(
+                    from_user_id,
+                    to_user_id,
+                    datetime_to_microseconds(friendship.created_at),
+                )
+            return friendship
+
+        return cls.follow_in_hbase(from_user_id, to_user_id, int(time() * 1000000))
 
-        # create friendship in HBase
-        now = int(time() * 1000000)
+    @classmethod
+    def follow_in_hbase(cls, from_user_id, to_user_id, created_at):
+        # HBaseFriendship is written last and deleted first, so whenever the
+        # index says A follows B, both HBaseFollower and HBaseFollowing exist
         HBaseFollower.create(
             to_user_id=to_user_id,
-            created_at=now,
+            created_at=created_at,
             from_user_id=from_user_id
         )
-        return HBaseFollowing.create(
+        following = HBaseFollowing.create(
             from_user_id = from_user_id,
-            created_at = now,
+            created_at = created_at,
             to_user_id = to_user_id
         )
+        HBaseFriendship.create(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=created_at,
+        )
+        HBaseFriendshipCount.counter_inc('followings_count', user_id=from_user_id)
+        HBaseFriendshipCount.counter_inc('followers_count', user_id=to_user_id)
+        return following
 
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -99,25 +171,176 @@ class FriendshipService:
                 from_user_id=from_user_id,
                 to_user_id=to_user_id
             ).delete()
+            if cls.is_double_write_on():
+                cls.unfollow_in_hbase(from_user_id, to_user_id)
             return deleted
 
-        # delete friendship in HBase
+        return cls.unfollow_in_hbase(from_user_id, to_user_id)
+
+    @classmethod
+    def unfollow_in_hbase(cls, from_user_id, to_user_id):
         instance = cls.get_follow_instance_from_hbase(from_user_id, to_user_id)
         if instance == None:
             return 0
 
+        HBaseFriendship.delete(from_user_id=from_user_id, to_user_id=to_user_id)
         HBaseFollower.delete(to_user_id=to_user_id, created_at=instance.created_at)
         HBaseFollowing.delete(from_user_id=from_user_id, created_at=instance.created_at)
+        # two concurrent unfollows may both decrease, reconcile_friendship_counts
+        # fixes this kind of drift
+        HBaseFriendshipCount.counter_dec('followings_count', user_id=from_user_id)
+        HBaseFriendshipCount.counter_dec('followers_count', user_id=to_user_id)
         return 1
 
     @classmethod
-    def get_follow_instance_from_hbase(cls, from_user_id, to_user_id):
-        friendships = HBaseFollowing.filter(prefix=(from_user_id, ))
+    def is_double_write_on(cls):
+        # turned on while migrate_friendships_to_hbase copies the MySQL rows,
+        # MySQL stays the source of truth until switch_friendship_to_hbase is on
+        return GateKeeper.is_switch_on('switch_friendship_double_write')
+
+    @classmethod
+    def bulk_follow(cls, from_user_id, to_user_ids, batch_size=FRIENDSHIP_BATCH_SIZE):
+        """
+        follow many users at once, e.g. onboarding suggestions or migrations
+        returns {'results': {to_user_id: BulkFriendshipStatus}, 'seconds', 'per_second'}
+        """
+        start = time()
+        # keep the input order, drop duplicates
+        to_user_ids = list(dict.fromkeys(to_user_ids))
+        followed_user_id_set = cls.get_followed_user_id_set(from_user_id, to_user_ids)
+
+        results = {}
+        new_user_ids = []
+        for to_user_id in to_user_ids:
+            if to_user_id == from_user_id:
+                results[to_user_id] = BulkFriendshipStatus.INVALID
+            elif to_user_id in followed_user_id_set:
+                results[to_user_id] = BulkFriendshipStatus.ALREADY_FOLLOWED
+            else:
+                results[to_user_id] = BulkFriendshipStatus.FOLLOWED
+                new_user_ids.append(to_user_id)
+
+        if new_user_ids:
+            if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+                friendships = cls._bulk_follow_in_mysql(from_user_id, new_user_ids, batch_size)
+                if cls.is_double_write_on():
+                    cls._bulk_follow_in_hbase(from_user_id, [
+                        {
+                            'from_user_id': from_user_id,
+                            'to_user_id': friendship.to_user_id,
+                            'created_at': datetime_to_microseconds(friendship.created_at),
+                        }
+                        for friendship in friendships
+                    ], batch_size)
+            else:
+                # created_at is part of the HBaseFollowing row key, keep them one
+                # microsecond apart so the rows of this bulk don't overwrite each other
+                now = int(time() * 1000000)
+                cls._bulk_follow_in_hbase(from_user_id, [
+                    {'from_user_id': from_user_id, 'to_user_id': to_user_id, 'created_at': now + index}
+                    for index, to_user_id in enumerate(new_user_ids)
+                ], batch_size)
+
+        return cls._get_bulk_results(results, start)
+
+    @classmethod
+    def _bulk_follow_in_mysql(cls, from_user_id, to_user_ids, batch_size):
+        friendships = Friendship.objects.bulk_create([
+            Friendship(from_user_id=from_user_id, to_user_id=to_user_id)
+            for to_user_id in to_user_ids
+        ], batch_size=batch_size, ignore_conflicts=True)
+        # bulk_create won't trigger post_save signal
+        cls.invalidate_following_cache(from_user_id)
+        return friendships
+
+    @classmethod
+    def _bulk_follow_in_hbase(cls, from_user_id, friendships, batch_size):
+        cls.write_friendships_to_hbase(friendships, batch_size)
+        HBaseFriendshipCount.counter_inc('followings_count', len(friendships), user_id=from_user_id)
+        for friendship in friendships:
+            HBaseFriendshipCount.counter_inc('followers_count', user_id=friendship['to_user_id'])
+
+    @classmethod
+    def write_friendships_to_hbase(cls, friendships, batch_size=FRIENDSHIP_BATCH_SIZE):
+        # friendships: [{'from_user_id', 'to_user_id', 'created_at'}, ...]
+        # same order as follow(), the index is written last. counters are not
+        # touched, callers update or reconcile them.
+        HBaseFollower.batch_create(friendships, batch_size=batch_size)
+        HBaseFollowing.batch_create(friendships, batch_size=batch_size)
+        HBaseFriendship.batch_create(friendships, batch_size=batch_size)
+
+    @classmethod
+    def bulk_unfollow(cls, from_user_id, to_user_ids, batch_size=FRIENDSHIP_BATCH_SIZE):
+        start = time()
+        to_user_ids = list(dict.fromkeys(to_user_ids))
+        results = {}
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            followed_user_id_set = cls.get_followed_user_id_set(from_user_id, to_user_ids)
+            # delete() sends pre_delete per row, which invalidates the following cache
+            Friendship.objects.filter(
+                from_user_id=from_user_id,
+                to_user_id__in=followed_user_id_set,
+            ).delete()
+            if cls.is_double_write_on():
+                cls._bulk_unfollow_in_hbase(from_user_id, to_user_ids, batch_size)
+        else:
+            followed_user_id_set = cls._bulk_unfollow_in_hbase(from_user_id, to_user_ids, batch_size)
+
+        for to_user_id in to_user_ids:
+            if to_user_id == from_user_id:
+                results[to_user_id] = BulkFriendshipStatus.INVALID
+            elif to_user_id in followed_user_id_set:
+                results[to_user_id] = BulkFriendshipStatus.UNFOLLOWED
+            else:
+                results[to_user_id] = BulkFriendshipStatus.NOT_FOLLOWED
+
+        return cls._get_bulk_results(results, start)
+
+    @classmethod
+    def _bulk_unfollow_in_hbase(cls, from_user_id, to_user_ids, batch_size):
+        # returns the set of user ids which were followed
+        friendships = [
+            friendship
+            for friendship in HBaseFriendship.get_many([
+                {'from_user_id': from_user_id, 'to_user_id': to_user_id}
+                for to_user_id in to_user_ids
+            ])
+            if friendship is not None
+        ]
+        if not friendships:
+            return set()
+
+        # same order as unfollow(), the index is deleted first
+        HBaseFriendship.batch_delete([
+            {'from_user_id': from_user_id, 'to_user_id': friendship.to_user_id}
+            for friendship in friendships
+        ], batch_size=batch_size)
+        HBaseFollower.batch_delete([
+            {'to_user_id': friendship.to_user_id, 'created_at': friendship.created_at}
+            for friendship in friendships
+        ], batch_size=batch_size)
+        HBaseFollowing.batch_delete([
+            {'from_user_id': from_user_id, 'created_at': friendship.created_at}
+            for friendship in friendships
+        ], batch_size=batch_size)
+        HBaseFriendshipCount.counter_dec('followings_count', len(friendships), user_id=from_user_id)
         for friendship in friendships:
-            if friendship.to_user_id == to_user_id:
-                return friendship
+            HBaseFriendshipCount.counter_dec('followers_count', user_id=friendship.to_user_id)
+        return set(friendship.to_user_id for friendship in friendships)
+
+    @classmethod
+    def _get_bulk_results(cls, results, start):
+        seconds = time() - start
+        return {
+            'results': results,
+            'seconds': seconds,
+            'per_second': len(results) / seconds if seconds > 0 else 0,
+        }
 
-        return None
+    @classmethod
+    def get_follow_instance_from_hbase(cls, from_user_id, to_user_id):
+        # point lookup on the (from_user_id, to_user_id) index, no prefix scan
+        return HBaseFriendship.get(from_user_id=from_user_id, to_user_id=to_user_id)
 
     @classmethod
     def has_followed(cls, from_user_id, to_user_id):
@@ -133,10 +356,59 @@ class FriendshipService:
         friendship = cls.get_follow_instance_from_hbase(from_user_id, to_user_id)
         return friendship != None
 
+    @classmethod
+    def get_followed_user_id_set(cls, from_user_id, to_user_ids):
+        # which of to_user_ids are followed by from_user_id, one query for all
+        if not to_user_ids:
+            return set()
+
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return set(Friendship.objects.filter(
+                from_user_id=from_user_id,
+                to_user_id__in=to_user_ids,
+            ).values_list('to_user_id', flat=True))
+
+        friendships = HBaseFriendship.get_many([
+            {'from_user_id': from_user_id, 'to_user_id': to_user_id}
+            for to_user_id in to_user_ids
+        ])
+        return set(
+            friendship.to_user_id
+            for friendship in friendships
+            if friendship is not None
+        )
+
     @classmethod
     def get_following_count(cls, from_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             return Friendship.objects.filter(from_user_id=from_user_id).count()
 
-        friendships = HBaseFollowing.filter(prefix=(from_user_id,))
-        return len(friendships)
\ No newline at end of file
+        return cls.get_friendship_count_from_hbase(from_user_id, 'followings_count')
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return Friendship.objects.filter(to_user_id=to_user_id).count()
+
+        return cls.get_friendship_count_from_hbase(to_user_id, 'followers_count')
+
+    @classmethod
+    def get_friendship_count_from_hbase(cls, user_id, attr):
+        # maintained by follow/unfollow, never scans
+        counts = HBaseFriendshipCount.get(user_id=user_id)
+        if counts is None or getattr(counts, attr) is None:
+            return 0
+        return getattr(counts, attr)
+
+    @classmethod
+    def reconcile_friendship_counts(cls, user_id):
+        # recount from the row key ranges, only row keys are streamed back
+        followings_count = sum(
+            1 for _ in HBaseFollowing.iter_filter(prefix=(user_id, ), keys_only=True)
+        )
+        followers_count = sum(
+            1 for _ in HBaseFollower.iter_filter(prefix=(user_id, ), keys_only=True)
+        )
+        HBaseFriendshipCount.counter_set('followings_count', followings_count, user_id=user_id)
+        HBaseFriendshipCount.counter_set('followers_count', followers_count, user_id=user_id)
+        return followings_count, followers_count
\ No newline at end of file
@@ -0,0 +1,36 @@
+from celery import shared_task
+from django.contrib.auth.models import User
+from friendships.constants import RECONCILE_COUNTS_BATCH_SIZE
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_friendship_counts_main_task():
+    # counters only exist in hbase
+    if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+        return 'friendships are not in hbase, nothing to reconcile'
+
+    user_ids = User.objects.order_by('id').values_list('id', flat=True)
+    batch_ids = []
+    batches = 0
+    for user_id in user_ids.iterator():
+        batch_ids.append(user_id)
+        if len(batch_ids) == RECONCILE_COUNTS_BATCH_SIZE:
+            reconcile_friendship_counts_batch_task.delay(batch_ids)
+            batch_ids = []
+            batches += 1
+    if batch_ids:
+        reconcile_friendship_counts_batch_task.delay(batch_ids)
+        batches += 1
+
+    return '{} reconcile batches created'.format(batches)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_friendship_counts_batch_task(user_ids):
+    for user_id in user_ids:
+        FriendshipService.reconcile_friendship_counts(user_id)
+
+    return '{} users reconciled'.format(len(user_ids))
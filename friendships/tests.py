@@ -1,7 +1,25 @@
+from django.conf import settings
+from django_hbase.client import HBaseClient
 from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.models import Friendship, HBaseFollowing, HBaseFollower
+from django_hbase.models.codecs import BinaryRowKeyCodec
+from friendships.constants import BulkFriendshipStatus
+from friendships.management.commands.migrate_friendships_to_hbase import (
+    get_hbase_only_user_ids,
+    set_counts_range,
+    verify_user,
+    verify_users,
+)
+from friendships.models import (
+    Friendship,
+    HBaseFollower,
+    HBaseFollowing,
+    HBaseFriendship,
+    HBaseFriendshipCount,
+)
 from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
 from testing.testcases import TestCase
+from utils.time_helpers import datetime_to_microseconds
 
 import time
 
@@ -36,6 +54,219 @@ class FriendshipServiceTests(TestCase):
         user_id_set = FriendshipService.get_following_user_id_set(user4.id)
         self.assertEqual(user_id_set, set([self.user2.id, self.user3.id, user5.id]))
 
+    def test_hbase_friendship_index(self):
+        GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
+        self.assertEqual(FriendshipService.has_followed(self.user1.id, self.user2.id), False)
+
+        following = FriendshipService.follow(self.user1.id, self.user2.id)
+        friendship = HBaseFriendship.get(from_user_id=self.user1.id, to_user_id=self.user2.id)
+        self.assertEqual(friendship.created_at, following.created_at)
+        self.assertEqual(FriendshipService.has_followed(self.user1.id, self.user2.id), True)
+        self.assertEqual(FriendshipService.has_followed(self.user2.id, self.user1.id), False)
+
+        self.assertEqual(FriendshipService.unfollow(self.user1.id, self.user2.id), 1)
+        self.assertEqual(
+            HBaseFriendship.get(from_user_id=self.user1.id, to_user_id=self.user2.id),
+            None,
+        )
+        self.assertEqual(HBaseFollowing.filter(prefix=(self.user1.id, )), [])
+        self.assertEqual(HBaseFollower.filter(prefix=(self.user2.id, )), [])
+        self.assertEqual(FriendshipService.has_followed(self.user1.id, self.user2.id), False)
+        self.assertEqual(FriendshipService.unfollow(self.user1.id, self.user2.id), 0)
+
+    def test_get_followed_user_id_set_in_mysql(self):
+        self._test_get_followed_user_id_set()
+
+    def test_get_followed_user_id_set_in_hbase(self):
+        GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
+        self._test_get_followed_user_id_set()
+
+    def _test_get_followed_user_id_set(self):
+        user4 = self.create_user('testuser4')
+        FriendshipService.follow(user4.id, self.user1.id)
+        FriendshipService.follow(user4.id, self.user3.id)
+        user_id_set = FriendshipService.get_followed_user_id_set(
+            user4.id,
+            [self.user1.id, self.user2.id, self.user3.id],
+        )
+        self.assertEqual(user_id_set, set([self.user1.id, self.user3.id]))
+        self.assertEqual(FriendshipService.get_followed_user_id_set(user4.id, []), set())
+
+    def test_bulk_follow_in_mysql(self):
+        self._test_bulk_follow()
+
+    def test_bulk_follow_in_hbase(self):
+        GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
+        self._test_bulk_follow()
+        # rows of the same bulk have distinct row keys
+        FriendshipService.bulk_follow(self.user1.id, [self.user2.id, self.user3.id])
+        self.assertEqual(len(HBaseFollowing.filter(prefix=(self.user1.id, ))), 2)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(self.user2.id, ))), 1)
+
+    def _test_bulk_follow(self):
+        user4 = self.create_user('testuser4')
+        FriendshipService.follow(self.user1.id, self.user2.id)
+        to_user_ids = [self.user1.id, self.user2.id, self.user3.id, user4.id, self.user3.id]
+        # batch size is 2 when testing, so writes are split in several batches
+        response = FriendshipService.bulk_follow(self.user1.id, to_user_ids)
+        self.assertEqual(response['results'], {
+            self.user1.id: BulkFriendshipStatus.INVALID,
+            self.user2.id: BulkFriendshipStatus.ALREADY_FOLLOWED,
+            self.user3.id: BulkFriendshipStatus.FOLLOWED,
+            user4.id: BulkFriendshipStatus.FOLLOWED,
+        })
+        self.assertEqual(FriendshipService.get_following_count(self.user1.id), 3)
+        self.assertEqual(FriendshipService.get_follower_count(user4.id), 1)
+        self.assertEqual(FriendshipService.has_followed(self.user1.id, user4.id), True)
+
+        response = FriendshipService.bulk_unfollow(self.user1.id, [self.user2.id, user4.id])
+        self.assertEqual(response['results'], {
+            self.user2.id: BulkFriendshipStatus.UNFOLLOWED,
+            user4.id: BulkFriendshipStatus.UNFOLLOWED,
+        })
+        response = FriendshipService.bulk_unfollow(self.user1.id, [self.user2.id, self.user3.id])
+        self.assertEqual(response['results'], {
+            self.user2.id: BulkFriendshipStatus.NOT_FOLLOWED,
+            self.user3.id: BulkFriendshipStatus.UNFOLLOWED,
+        })
+        self.assertEqual(FriendshipService.get_following_count(self.user1.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(user4.id), 0)
+        self.assertEqual(FriendshipService.has_followed(self.user1.id, self.user3.id), False)
+
+    def test_double_write(self):
+        GateKeeper.set('switch_friendship_double_write', 'percent', 100)
+        friendship = FriendshipService.follow(self.user1.id, self.user2.id)
+        self.assertEqual(isinstance(friendship, Friendship), True)
+        instance = HBaseFriendship.get(from_user_id=self.user1.id, to_user_id=self.user2.id)
+        self.assertEqual(instance.created_at, datetime_to_microseconds(friendship.created_at))
+        self.assertEqual(
+            HBaseFollowing.get(from_user_id=self.user1.id, created_at=instance.created_at).to_user_id,
+            self.user2.id,
+        )
+
+        self.assertEqual(FriendshipService.unfollow(self.user1.id, self.user2.id), 1)
+        self.assertEqual(Friendship.objects.count(), 0)
+        self.assertEqual(
+            HBaseFriendship.get(from_user_id=self.user1.id, to_user_id=self.user2.id),
+            None,
+        )
+
+    def test_verify_migrated_friendships(self):
+        FriendshipService.follow(self.user1.id, self.user2.id)
+        friendship = FriendshipService.follow(self.user1.id, self.user3.id)
+        created_at = datetime_to_microseconds(friendship.created_at)
+        # only user1 -> user3 was copied, user2 -> user3 is not in MySQL
+        FriendshipService.write_friendships_to_hbase([
+            {'from_user_id': self.user1.id, 'to_user_id': self.user3.id, 'created_at': created_at},
+            {'from_user_id': self.user2.id, 'to_user_id': self.user3.id, 'created_at': created_at + 1},
+        ])
+
+        # (user_id, missing rows, stale rows, MySQL counts, hbase counts)
+        self.assertEqual(verify_user(self.user1.id), (self.user1.id, 2, 0, (2, 0), (0, 0)))
+        self.assertEqual(verify_user(self.user2.id), (self.user2.id, 1, 2, (0, 1), (0, 0)))
+        self.assertEqual(verify_user(self.user3.id), (self.user3.id, 0, 1, (0, 1), (0, 0)))
+        # report only, nothing was changed
+        self.assertNotEqual(HBaseFriendship.get(from_user_id=self.user2.id, to_user_id=self.user3.id), None)
+        self.assertEqual(FriendshipService.get_friendship_count_from_hbase(self.user1.id, 'followings_count'), 0)
+
+        for user in [self.user1, self.user2, self.user3]:
+            self.assertNotEqual(verify_user(user.id, fix=True, batch_size=2), None)
+        for user in [self.user1, self.user2, self.user3]:
+            self.assertEqual(verify_user(user.id), None)
+        self.assertEqual(HBaseFriendship.get(from_user_id=self.user2.id, to_user_id=self.user3.id), None)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(self.user3.id, ))), 1)
+        self.assertEqual(FriendshipService.get_friendship_count_from_hbase(self.user1.id, 'followings_count'), 2)
+
+        # users only in hbase are not visited by the MySQL user id ranges
+        FriendshipService.write_friendships_to_hbase([
+            {'from_user_id': 10 ** 9, 'to_user_id': 10 ** 9 + 1, 'created_at': created_at},
+        ])
+        self.assertEqual(get_hbase_only_user_ids(batch_size=2), [10 ** 9, 10 ** 9 + 1])
+        self.assertEqual(len(verify_users([10 ** 9, 10 ** 9 + 1], True, 2)), 2)
+        self.assertEqual(verify_users([10 ** 9, 10 ** 9 + 1], False, 2), [])
+        self.assertEqual(HBaseFollowing.filter(prefix=(10 ** 9, )), [])
+
+    def test_set_counts_after_migration(self):
+        FriendshipService.follow(self.user1.id, self.user2.id)
+        FriendshipService.follow(self.user1.id, self.user3.id)
+        FriendshipService.follow(self.user2.id, self.user3.id)
+        FriendshipService.write_friendships_to_hbase([
+            {
+                'from_user_id': friendship.from_user_id,
+                'to_user_id': friendship.to_user_id,
+                'created_at': datetime_to_microseconds(friendship.created_at),
+            }
+            for friendship in Friendship.objects.all()
+        ])
+        # the copy leaves the counters alone
+        self.assertEqual(verify_user(self.user3.id), (self.user3.id, 0, 0, (0, 2), (0, 0)))
+
+        # a double written follow already incremented a counter
+        HBaseFriendshipCount.counter_inc('followers_count', user_id=self.user2.id)
+        start_id = min(self.user1.id, self.user2.id, self.user3.id)
+        stop_id = max(self.user1.id, self.user2.id, self.user3.id) + 1
+        self.assertEqual(set_counts_range(start_id, stop_id), (start_id, 3))
+        for user in [self.user1, self.user2, self.user3]:
+            self.assertEqual(verify_user(user.id), None)
+        self.assertEqual(FriendshipService.get_friendship_count_from_hbase(self.user1.id, 'followings_count'), 2)
+        self.assertEqual(FriendshipService.get_friendship_count_from_hbase(self.user2.id, 'followers_count'), 1)
+
+    def test_friendship_counts_in_mysql(self):
+        self._test_friendship_counts()
+
+    def test_friendship_counts_in_hbase(self):
+        GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
+        self._test_friendship_counts()
+
+        # counters drifted, reconcile recounts from the row key ranges
+        HBaseFriendshipCount.counter_set('followers_count', 100, user_id=self.user3.id)
+        self.assertEqual(FriendshipService.get_follower_count(self.user3.id), 100)
+        FriendshipService.reconcile_friendship_counts(self.user3.id)
+        self.assertEqual(FriendshipService.get_follower_count(self.user3.id), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.user3.id), 0)
+
+    def _test_friendship_counts(self):
+        self.assertEqual(FriendshipService.get_following_count(self.user1.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 0)
+
+        FriendshipService.follow(self.user1.id, self.user2.id)
+        FriendshipService.follow(self.user1.id, self.user3.id)
+        FriendshipService.follow(self.user3.id, self.user2.id)
+        self.assertEqual(FriendshipService.get_following_count(self.user1.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(self.user1.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 2)
+
+        FriendshipService.unfollow(self.user3.id, self.user2.id)
+        # unfollow twice only decreases once
+        FriendshipService.unfollow(self.user3.id, self.user2.id)
+        self.assertEqual(FriendshipService.get_following_count(self.user3.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(self.user2.id), 1)
+
+    def test_iter_follower_ids_in_mysql(self):
+        self._test_iter_follower_ids()
+
+    def test_iter_follower_ids_in_hbase(self):
+        GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
+        self._test_iter_follower_ids()
+
+    def _test_iter_follower_ids(self):
+        self.assertEqual(list(FriendshipService.iter_follower_ids(self.user1.id)), [])
+
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            FriendshipService.follow(follower.id, self.user1.id)
+        FriendshipService.follow(self.user2.id, self.user3.id)
+
+        # FOLLOWER_IDS_BATCH_SIZE = 2 if TESTING, read in 3 batches
+        follower_ids = FriendshipService.iter_follower_ids(self.user1.id)
+        self.assertEqual(next(follower_ids), followers[0].id)
+        self.assertEqual(
+            list(follower_ids),
+            [follower.id for follower in followers[1:]],
+        )
+        follower_ids = FriendshipService.iter_follower_ids(self.user1.id, batch_size=5)
+        self.assertEqual(len(list(follower_ids)), 5)
+
 
 class HBaseTests(TestCase):
 
@@ -142,3 +373,120 @@ class HBaseTests(TestCase):
         self.assertEqual(len(results), 2)
         self.assertEqual(results[0].to_user_id, 3)
         self.assertEqual(results[1].to_user_id, 2)
+
+    def test_connection_pool(self):
+        with HBaseClient.connection() as conn:
+            # nested checkout in the same thread reuses the same connection
+            with HBaseClient.connection() as nested_conn:
+                self.assertEqual(conn is nested_conn, True)
+            stats = HBaseClient.get_pool_stats()
+            self.assertEqual(stats['size'], settings.HBASE_POOL_SIZE)
+            self.assertEqual(stats['in_use'], 1)
+            self.assertEqual(stats['available'], settings.HBASE_POOL_SIZE - 1)
+
+        stats = HBaseClient.get_pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['max_in_use'] >= 1, True)
+
+        # models check out connections transparently
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts)
+        instance = HBaseFollowing.get(from_user_id=1, created_at=ts)
+        self.assertEqual(instance.to_user_id, 2)
+        self.assertEqual(HBaseClient.get_pool_stats()['in_use'], 0)
+
+    def test_field_metadata(self):
+        # computed once at class creation, in declaration order
+        self.assertEqual(
+            list(HBaseFollowing.get_field_hash().keys()),
+            ['from_user_id', 'created_at', 'to_user_id'],
+        )
+        self.assertEqual(
+            [key for key, field in HBaseFollowing._row_key_fields],
+            ['from_user_id', 'created_at'],
+        )
+        self.assertEqual(HBaseFollowing._column_families, {'cf'})
+
+        ts = self.ts_now
+        row_key = HBaseFollowing.serialize_row_key({'from_user_id': 123, 'created_at': ts})
+        self.assertEqual(row_key, bytes('3210000000000000:{}'.format(ts), encoding='utf-8'))
+        instance = HBaseFollowing.init_from_row(row_key, {b'cf:to_user_id': b'0000000000000034'})
+        self.assertEqual(instance.from_user_id, 123)
+        self.assertEqual(instance.created_at, ts)
+        self.assertEqual(instance.to_user_id, 34)
+
+    def test_iter_filter(self):
+        for to_user_id in range(2, 7):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+        HBaseFollowing.create(from_user_id=2, to_user_id=1, created_at=self.ts_now)
+
+        # lazily yields the same results as filter()
+        followings = HBaseFollowing.iter_filter(prefix=(1, ), batch_size=2)
+        self.assertEqual(
+            [following.to_user_id for following in followings],
+            [following.to_user_id for following in HBaseFollowing.filter(prefix=(1, ))],
+        )
+
+        # early termination
+        followings = HBaseFollowing.iter_filter(prefix=(1, ))
+        self.assertEqual(next(followings).to_user_id, 2)
+        self.assertEqual(next(followings).to_user_id, 3)
+        followings.close()
+        self.assertEqual(HBaseClient.get_pool_stats()['in_use'], 0)
+
+        # column projection
+        followings = list(HBaseFollowing.iter_filter(prefix=(1, ), columns=['to_user_id']))
+        self.assertEqual(len(followings), 5)
+        self.assertEqual(followings[0].to_user_id, 2)
+
+        # only row keys
+        followings = list(HBaseFollowing.iter_filter(prefix=(1, ), keys_only=True))
+        self.assertEqual(len(followings), 5)
+        self.assertEqual(followings[0].from_user_id, 1)
+        self.assertEqual(followings[0].to_user_id, None)
+
+    def test_binary_row_key_codec(self):
+        fields = HBaseFollower._row_key_fields
+        codec = BinaryRowKeyCodec([(key, field) for key, field in fields if not field.reverse])
+        # order preserving, including negative values
+        values = [-(1 << 40), -1, 0, 1, 255, 256, 1 << 40]
+        row_keys = [codec.serialize({'created_at': value}) for value in values]
+        self.assertEqual(sorted(row_keys), row_keys)
+        self.assertEqual(len(row_keys[0]), 8)
+        for value, row_key in zip(values, row_keys):
+            self.assertEqual(codec.deserialize(row_key), {'created_at': value})
+
+        # reversed field + salt, full key and prefix
+        codec = BinaryRowKeyCodec(fields, salt_buckets=16)
+        ts = self.ts_now
+        row_key = codec.serialize({'to_user_id': 35, 'created_at': ts})
+        self.assertEqual(len(row_key), 17)
+        self.assertEqual(row_key[0], 35 % 16)
+        self.assertEqual(codec.deserialize(row_key), {'to_user_id': 35, 'created_at': ts})
+        prefix = codec.serialize({'to_user_id': 35}, is_prefix=True)
+        self.assertEqual(row_key.startswith(prefix), True)
+        self.assertEqual(codec.deserialize(prefix), {'to_user_id': 35})
+
+        try:
+            codec.serialize({'to_user_id': 35})
+            exception_raised = False
+        except BadRowKeyError as e:
+            exception_raised = True
+            self.assertEqual(str(e), 'created_at is missing in row key')
+        self.assertEqual(exception_raised, True)
+
+    def test_get_many(self):
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts)
+        HBaseFollowing.create(from_user_id=1, to_user_id=3, created_at=ts + 1)
+
+        instances = HBaseFollowing.get_many([
+            {'from_user_id': 1, 'created_at': ts + 1},
+            {'from_user_id': 1, 'created_at': ts + 2},
+            {'from_user_id': 1, 'created_at': ts},
+        ])
+        self.assertEqual(len(instances), 3)
+        self.assertEqual(instances[0].to_user_id, 3)
+        self.assertEqual(instances[1], None)
+        self.assertEqual(instances[2].to_user_id, 2)
+        self.assertEqual(HBaseFollowing.get_many([]), [])
@@ -5,6 +5,8 @@ from likes.models import Like
 from comments.models import Comment
 from tweets.models import Tweet
 from accounts.api.serializers import UserSerializerForLike
+from accounts.services import UserService
+from utils.serializers import PrefetchListSerializer
 
 
 class LikeSerializer(serializers.ModelSerializer):
@@ -13,6 +15,10 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, instances):
+        UserService.prefetch_users(instances)
 
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
@@ -214,6 +214,7 @@ class LikeApiTest(TestCase):
             'content_type': 'tweet',
             'object_id': tweet.id
         })
+        self.run_on_commit_callbacks()
         response = self.user1_client.get(url, {'tweet_id': tweet.id})
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['has_liked'], False)
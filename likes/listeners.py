@@ -3,46 +3,53 @@ from utils.redis_helper import RedisHelper
 def incr_likes_count(sender, instance, created, **kwargs):
     from django.db.models import F
     from comments.models import Comment
+    from gatekeeper.models import GateKeeper
     from tweets.models import Tweet
+    from likes.services import LikeService
     # only creating new likes will update likes_count
     if not created:
         return
 
+    LikeService.add_to_liked_set(instance)
+
     model_class = instance.content_object.__class__.__name__
-    if model_class != 'Tweet':
-        Comment.objects.filter(
+    model_class = Tweet if model_class == 'Tweet' else Comment
+    if GateKeeper.is_switch_on('switch_count_write_behind'):
+        # only a redis delta, written to db in batch by flush_count_deltas_task
+        RedisHelper.incr_count_delta(model_class, instance.object_id, 'likes_count', 1)
+    else:
+        # F has row lock to solve concurrent issues (many likes at the same time).
+        # .update will not trigger post_save listener
+        # update count in Tweet/Comment table
+        model_class.objects.filter(
             id=instance.object_id
         ).update(likes_count=F('likes_count') + 1)
-        RedisHelper.incr_count(instance.content_object, 'likes_count')
-        return
-
-    # F has row lock to solve concurrent issues (many likes at the same time).
-    # .update will not trigger post_save listener
-    # update count in Tweet table
-    Tweet.objects.filter(
-        id=instance.object_id
-    ).update(likes_count=F('likes_count') + 1)
     # update count in redis
     RedisHelper.incr_count(instance.content_object, 'likes_count')
 
 def decr_likes_count(sender, instance, **kwargs):
     from django.db.models import F
     from comments.models import Comment
+    from gatekeeper.models import GateKeeper
     from tweets.models import Tweet
 
     model_class = instance.content_object.__class__.__name__
-    if model_class != 'Tweet':
-        Comment.objects.filter(
+    model_class = Tweet if model_class == 'Tweet' else Comment
+    if GateKeeper.is_switch_on('switch_count_write_behind'):
+        RedisHelper.incr_count_delta(model_class, instance.object_id, 'likes_count', -1)
+    else:
+        # F has row lock to solve concurrent issues (i.e. many likes at the same time).
+        # .update will not trigger post_save listener
+        # update count in Tweet/Comment table
+        model_class.objects.filter(
             id=instance.object_id
         ).update(likes_count=F('likes_count') - 1)
-        RedisHelper.decr_count(instance.content_object, 'likes_count')
-        return
-
-    # F has row lock to solve concurrent issues (i.e. many likes at the same time).
-    # .update will not trigger post_save listener
-    # update count in Tweet table
-    Tweet.objects.filter(
-        id=instance.object_id
-    ).update(likes_count=F('likes_count') - 1)
     # update count in redis
-    RedisHelper.decr_count(instance.content_object, 'likes_count')
\ No newline at end of file
+    RedisHelper.decr_count(instance.content_object, 'likes_count')
+
+def remove_from_liked_set(sender, instance, **kwargs):
+    from django.db import transaction
+    from likes.services import LikeService
+    # only once the delete is committed: a liked set loaded before that still
+    # reads the like from DB, the SREM must come after the load's DB read
+    transaction.on_commit(lambda: LikeService.remove_from_liked_set(instance))
@@ -2,8 +2,8 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import pre_delete, post_save
-from likes.listeners import decr_likes_count, incr_likes_count
+from django.db.models.signals import post_delete, pre_delete, post_save
+from likes.listeners import decr_likes_count, incr_likes_count, remove_from_liked_set
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -36,7 +36,11 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
+        # set by the list serializer prefetch
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 pre_delete.connect(decr_likes_count, sender=Like)
+post_delete.connect(remove_from_liked_set, sender=Like)
 post_save.connect(incr_likes_count, sender=Like)
\ No newline at end of file
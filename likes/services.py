@@ -1,16 +1,177 @@
 from likes.models import Like
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from twitter.cache import USER_LIKES_PATTERN
+from utils.redis_client import RedisClient
+
+import redis
+
+# every cached liked set has this member, so a user without likes is cached
+# too (redis deletes empty sets)
+LIKED_SET_PLACEHOLDER = ''
+# the user has more than REDIS_LIKED_SET_LIMIT likes, the set is not used
+LIKED_SET_OVERFLOW = 'overflow'
+# the set is being loaded from DB, likes/unlikes update it in the meantime
+# but it is not read until the load replaces it
+LIKED_SET_LOADING = 'loading'
+LIKED_SET_LOADING_TTL = 60
+
+# only update a cached set, a missing one is loaded from DB when needed.
+# an overflowed set only has the overflow marker, nothing is added to it.
+# while loading, an update always adds a new member so that the WATCH of
+# the load fires, even for an SREM of a member that is not in the set
+UPDATE_LIKED_SET_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('sismember', KEYS[1], ARGV[4]) == 1 then
+    redis.call('sadd', KEYS[1], 'update:' .. redis.call('scard', KEYS[1]))
+    return 0
+end
+if ARGV[1] == 'sadd' and redis.call('sismember', KEYS[1], ARGV[3]) == 1 then
+    return 0
+end
+return redis.call(ARGV[1], KEYS[1], ARGV[2])
+"""
 
 
 class LikeService:
 
+    @classmethod
+    def get_liked_set_member(cls, content_type_id, object_id):
+        return '{}:{}'.format(content_type_id, object_id)
+
+    @classmethod
+    def _load_liked_set(cls, user_id):
+        """
+        a like committed after the DB read used to be lost: its SADD found no
+        set and did nothing, then the load wrote the set without it.
+        the loading set is created first so that likes/unlikes update it, and
+        it is watched, the load is not cached if any of them ran meanwhile
+        """
+        conn = RedisClient.get_connection()
+        key = USER_LIKES_PATTERN.format(user_id=user_id)
+        pipeline = conn.pipeline()
+        pipeline.sadd(key, LIKED_SET_LOADING)
+        pipeline.expire(key, LIKED_SET_LOADING_TTL)
+        pipeline.execute()
+
+        try:
+            pipeline.watch(key)
+            members = cls._get_liked_set_members(user_id)
+            pipeline.multi()
+            pipeline.delete(key)
+            pipeline.sadd(key, LIKED_SET_PLACEHOLDER, *members)
+            pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.execute()
+        except redis.WatchError:
+            # the loading set stays, the next read loads it again
+            pass
+        finally:
+            pipeline.reset()
+        return set(members)
+
+    @classmethod
+    def _get_liked_set_members(cls, user_id):
+        likes = Like.objects.filter(user_id=user_id).values_list(
+            'content_type_id',
+            'object_id',
+        )[:settings.REDIS_LIKED_SET_LIMIT + 1]
+        members = [
+            cls.get_liked_set_member(content_type_id, object_id)
+            for content_type_id, object_id in likes
+        ]
+        if len(members) > settings.REDIS_LIKED_SET_LIMIT:
+            return [LIKED_SET_OVERFLOW]
+        return members
+
+    @classmethod
+    def _check_liked_set(cls, user_id, members):
+        """
+        member => liked or not, from the cached liked set of the user
+        None if the set is not cached or the user has too many likes
+        """
+        conn = RedisClient.get_connection()
+        key = USER_LIKES_PATTERN.format(user_id=user_id)
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.exists(key)
+        pipeline.sismember(key, LIKED_SET_LOADING)
+        pipeline.sismember(key, LIKED_SET_OVERFLOW)
+        for member in members:
+            pipeline.sismember(key, member)
+        exists, loading, overflow, *is_members = pipeline.execute()
+
+        if not exists or loading:
+            liked_members = cls._load_liked_set(user_id)
+            if LIKED_SET_OVERFLOW in liked_members:
+                return None
+            return {member: member in liked_members for member in members}
+        if overflow:
+            return None
+        return dict(zip(members, is_members))
+
+    @classmethod
+    def add_to_liked_set(cls, like):
+        RedisClient.get_connection().eval(
+            UPDATE_LIKED_SET_SCRIPT,
+            1,
+            USER_LIKES_PATTERN.format(user_id=like.user_id),
+            'sadd',
+            cls.get_liked_set_member(like.content_type_id, like.object_id),
+            LIKED_SET_OVERFLOW,
+            LIKED_SET_LOADING,
+        )
+
+    @classmethod
+    def remove_from_liked_set(cls, like):
+        RedisClient.get_connection().eval(
+            UPDATE_LIKED_SET_SCRIPT,
+            1,
+            USER_LIKES_PATTERN.format(user_id=like.user_id),
+            'srem',
+            cls.get_liked_set_member(like.content_type_id, like.object_id),
+            LIKED_SET_OVERFLOW,
+            LIKED_SET_LOADING,
+        )
+
     @classmethod
     def has_liked(cls, user, target):
         if user.is_anonymous:
             return False
 
+        content_type = ContentType.objects.get_for_model(target.__class__)
+        member = cls.get_liked_set_member(content_type.id, target.id)
+        liked = cls._check_liked_set(user.id, [member])
+        if liked is not None:
+            return liked[member]
+
         return Like.objects.filter(
             object_id=target.id,
-            content_type=ContentType.objects.get_for_model(target.__class__),
+            content_type=content_type,
             user=user
-        ).exists()
\ No newline at end of file
+        ).exists()
+
+    @classmethod
+    def get_liked_object_ids(cls, user, content_type, object_ids):
+        # object ids (of content_type) liked by the user, read from the cached
+        # liked set, or in one IN query
+        if user.is_anonymous or not object_ids:
+            return set()
+
+        members = {
+            cls.get_liked_set_member(content_type.id, object_id): object_id
+            for object_id in object_ids
+        }
+        liked = cls._check_liked_set(user.id, list(members))
+        if liked is not None:
+            return set(
+                object_id
+                for member, object_id in members.items()
+                if liked[member]
+            )
+
+        return set(Like.objects.filter(
+            user_id=user.id,
+            content_type=content_type,
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
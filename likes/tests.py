@@ -1,3 +1,110 @@
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from likes.services import LIKED_SET_LOADING, LikeService
+from testing.testcases import TestCase
+from tweets.models import Tweet
+from twitter.cache import USER_LIKES_PATTERN
+from utils.redis_client import RedisClient
 
-# Create your tests here.
+
+class UnlikeWhileLoadingLikeService(LikeService):
+    # called between the DB read of a liked set load and its EXEC
+    unlike = None
+
+    @classmethod
+    def _get_liked_set_members(cls, user_id):
+        members = super()._get_liked_set_members(user_id)
+        cls.unlike()
+        return members
+
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        self.clear_cache()
+        self.user1 = self.create_user('testuser1')
+        self.user2 = self.create_user('testuser2')
+
+    def test_get_liked_object_ids(self):
+        tweets = [self.create_tweet(self.user1) for _ in range(3)]
+        self.create_like(self.user2, tweets[0])
+        self.create_like(self.user2, tweets[2])
+        self.create_like(self.user1, tweets[1])
+        content_type = ContentType.objects.get_for_model(Tweet)
+        tweet_ids = [tweet.id for tweet in tweets]
+
+        with self.assertNumQueries(1):
+            liked_ids = LikeService.get_liked_object_ids(self.user2, content_type, tweet_ids)
+        self.assertEqual(liked_ids, {tweets[0].id, tweets[2].id})
+        self.assertEqual(
+            LikeService.get_liked_object_ids(self.user1, content_type, tweet_ids),
+            {tweets[1].id},
+        )
+        self.assertEqual(
+            LikeService.get_liked_object_ids(AnonymousUser(), content_type, tweet_ids),
+            set(),
+        )
+
+    def test_liked_set_in_redis(self):
+        tweet = self.create_tweet(self.user1)
+        comment = self.create_comment(self.user1, tweet)
+        self.create_like(self.user2, comment)
+
+        # cache miss, loaded from DB
+        self.assertEqual(LikeService.has_liked(self.user2, comment), True)
+        ContentType.objects.get_for_model(Tweet)
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.has_liked(self.user2, tweet), False)
+
+        # the cached set is updated by the like listeners
+        like = self.create_like(self.user2, tweet)
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.has_liked(self.user2, tweet), True)
+        like.delete()
+        self.run_on_commit_callbacks()
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.has_liked(self.user2, tweet), False)
+
+        # too many likes (> 3 if TESTING), read from DB
+        for _ in range(4):
+            self.create_like(self.user1, self.create_tweet(self.user2))
+        RedisClient.clear()
+        self.assertEqual(LikeService.has_liked(self.user1, tweet), False)
+        with self.assertNumQueries(1):
+            self.assertEqual(LikeService.has_liked(self.user1, tweet), False)
+        # nothing is added to an overflowed set
+        self.create_like(self.user1, tweet)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.scard(USER_LIKES_PATTERN.format(user_id=self.user1.id)), 2)
+        self.assertEqual(LikeService.has_liked(self.user1, tweet), True)
+
+        # a set still loading is updated by likes, but is not read
+        key = USER_LIKES_PATTERN.format(user_id=self.user2.id)
+        conn.delete(key)
+        conn.sadd(key, LIKED_SET_LOADING)
+        self.create_like(self.user2, tweet)
+        self.assertEqual(conn.scard(key), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(LikeService.has_liked(self.user2, tweet), True)
+        # the load replaced it
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.has_liked(self.user2, tweet), True)
+
+    def test_unlike_while_liked_set_loads(self):
+        tweet = self.create_tweet(self.user1)
+        like = self.create_like(self.user2, tweet)
+
+        def unlike():
+            like.delete()
+            self.run_on_commit_callbacks()
+
+        # the load read the like from DB, the unlike committed after its WATCH
+        UnlikeWhileLoadingLikeService.unlike = unlike
+        self.assertEqual(UnlikeWhileLoadingLikeService.has_liked(self.user2, tweet), True)
+        # so the loaded set was not cached, the next read loads it again
+        conn = RedisClient.get_connection()
+        key = USER_LIKES_PATTERN.format(user_id=self.user2.id)
+        self.assertEqual(conn.sismember(key, LIKED_SET_LOADING), True)
+        self.assertEqual(LikeService.has_liked(self.user2, tweet), False)
+        with self.assertNumQueries(0):
+            self.assertEqual(LikeService.has_liked(self.user2, tweet), False)
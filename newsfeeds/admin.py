@@ -1,5 +1,5 @@
 from django.contrib import admin
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import NewsFeed, NewsFeedFanout
 
 
 @admin.register(NewsFeed)
@@ -9,4 +9,18 @@ class NewsFeedAdmin(admin.ModelAdmin):
         'user',
         'tweet',
         'created_at'
-    )
\ No newline at end of file
+    )
+
+
+@admin.register(NewsFeedFanout)
+class NewsFeedFanoutAdmin(admin.ModelAdmin):
+    date_hierarchy = 'created_at'
+    list_display = (
+        'tweet',
+        'user',
+        'batches_done',
+        'batches_total',
+        'followers_reached',
+        'created_at',
+        'finished_at',
+    )
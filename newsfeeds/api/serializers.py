@@ -1,11 +1,28 @@
 from newsfeeds.models import NewsFeed
 from rest_framework import serializers
 from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class NewsFeedSerializer(serializers.ModelSerializer):
+    id = serializers.SerializerMethodField()
     tweet = TweetSerializer(source='cached_tweet')
 
     class Meta:
         model = NewsFeed
-        fields = ['id', 'created_at', 'tweet']
\ No newline at end of file
+        fields = ['id', 'created_at', 'tweet']
+        list_serializer_class = PrefetchListSerializer
+
+    def get_id(self, obj):
+        # tweets pulled from popular authors are not saved as newsfeeds, the
+        # negative tweet id is unique in a newsfeed and the same on every read
+        if obj.id is None:
+            return -obj.tweet_id
+        return obj.id
+
+    def prefetch(self, instances):
+        tweets = MemcachedHelper.prefetch_objects(instances, Tweet, 'tweet_id', '_cached_tweet')
+        # the nested tweet serializer is not a list serializer
+        self.fields['tweet'].prefetch(tweets)
@@ -1,5 +1,6 @@
 from django.conf import settings
 from friendships.models import Friendship
+from newsfeeds.constants import NEWSFEED_PULL_FOLLOWER_THRESHOLD, NEWSFEED_PULL_MERGE_DEPTH
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
 from rest_framework.test import APIClient
@@ -193,4 +194,22 @@ class NewsFeedApiTest(TestCase):
 
         # cached expired
         self.clear_cache()
-        _test_newsfeeds_after_new_feed_pushed()
\ No newline at end of file
+        _test_newsfeeds_after_new_feed_pushed()
+
+    def test_pulled_newsfeeds(self):
+        # user2 has enough followers to be pulled
+        self.create_friendship(self.user1, self.user2)
+        for i in range(NEWSFEED_PULL_FOLLOWER_THRESHOLD - 1):
+            self.create_friendship(self.create_user('follower{}'.format(i)), self.user2)
+        page_size = EndlessPagination.page_size
+        for i in range(page_size + NEWSFEED_PULL_MERGE_DEPTH):
+            self.user2_client.post(POST_TWEETS_URL, {'content': 'tweet {}'.format(i)})
+        # tweets are not fanned out
+        self.assertEqual(NewsFeed.objects.filter(user=self.user1).count(), 0)
+
+        # newest tweets are merged from the user_tweets cache, the rest from DB
+        results = self._paginate_to_get_all_newsfeeds(self.user1_client)
+        tweet_ids = Tweet.objects.filter(user=self.user2).order_by('-created_at').values_list('id', flat=True)
+        self.assertEqual([result['tweet']['id'] for result in results], list(tweet_ids))
+        # pulled newsfeeds are not saved, their id is the negative tweet id
+        self.assertEqual([result['id'] for result in results], [-tweet_id for tweet_id in tweet_ids])
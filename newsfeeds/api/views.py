@@ -1,6 +1,5 @@
 from django.utils.decorators import method_decorator
 from newsfeeds.api.serializers import NewsFeedSerializer
-from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
 from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
@@ -18,12 +17,18 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds_list = self.get_queryset()
-        newsfeeds = self.paginator.paginated_cached_list_in_redis(cached_newsfeeds_list, request)
+        newsfeeds = NewsFeedService.paginate_cached_newsfeeds(
+            request.user.id,
+            self.paginator,
+            request,
+        )
         # if none, which means data is not in redis cache, then pull from DB.
         if newsfeeds is None:
-            queryset = NewsFeed.objects.filter(user=request.user)
-            newsfeeds = self.paginate_queryset(queryset)
+            newsfeeds = NewsFeedService.paginate_newsfeeds_from_db(
+                request.user.id,
+                self.paginator,
+                request,
+            )
 
         serializer = NewsFeedSerializer(
             newsfeeds,
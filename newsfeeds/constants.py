@@ -1,3 +1,30 @@
 from django.conf import settings
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+# fanouts of authors with fewer followers go to the newsfeeds queue, the
+# others to newsfeeds_large, small fanouts never wait behind a big one
+FANOUT_QUEUE = 'newsfeeds'
+FANOUT_LARGE_QUEUE = 'newsfeeds_large'
+FANOUT_LARGE_FOLLOWER_THRESHOLD = 10000 if not settings.TESTING else 4
+# batch size until a batch latency is measured
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+# batch sizes adapt to the measured latency per follower so that a batch
+# takes about this long in each queue
+FANOUT_BATCH_TARGET_SECONDS = {
+    FANOUT_QUEUE: 0.5,
+    FANOUT_LARGE_QUEUE: 2,
+}
+FANOUT_BATCH_MIN_SIZE = 100 if not settings.TESTING else 2
+FANOUT_BATCH_MAX_SIZE = 5000 if not settings.TESTING else 3
+# latencies of the recent batches kept to estimate the latency per follower
+FANOUT_BATCH_LATENCY_SAMPLES = 100
+# a failed batch is retried with exponential backoff, newsfeeds of the
+# followers it already reached are not created twice
+FANOUT_BATCH_MAX_RETRIES = 5
+# tweets of authors with this many followers are not fanned out, followers
+# pull them from the author's user_tweets cache when reading the newsfeed
+NEWSFEED_PULL_FOLLOWER_THRESHOLD = 100000 if not settings.TESTING else 5
+# newest tweets pulled from each followed author when merging a newsfeed
+NEWSFEED_PULL_MERGE_DEPTH = 50 if not settings.TESTING else 5
+# every process keeps the set of pull authors this long instead of reading
+# it from redis for each newsfeed page
+NEWSFEED_PULL_AUTHORS_CACHE_TTL = 5 if not settings.TESTING else 0  # in seconds
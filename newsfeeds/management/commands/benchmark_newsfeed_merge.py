@@ -0,0 +1,59 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
+from tweets.models import Tweet
+from utils.time_helpers import utc_now
+
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'Latency of merging pulled tweets into a cached newsfeed, by pull authors and merge depth'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--authors', type=int, nargs='+', default=[1, 10, 50, 200])
+        parser.add_argument('--depths', type=int, nargs='+', default=[20, 50, 200])
+        parser.add_argument('--calls', type=int, default=200)
+
+    def handle(self, *args, **options):
+        now = utc_now()
+        # pushed newsfeeds of the reader, newest first, nothing is saved
+        newsfeeds = [
+            NewsFeed(id=index, user_id=1, tweet_id=index, created_at=now - timedelta(minutes=index))
+            for index in range(settings.REDIS_LIST_LENGTH_LIMIT)
+        ]
+        for depth in options['depths']:
+            for authors in options['authors']:
+                tweet_lists = [
+                    self.make_tweets(author_id, depth, now)
+                    for author_id in range(authors)
+                ]
+                self.benchmark(authors, depth, newsfeeds, tweet_lists, options['calls'])
+
+    def make_tweets(self, author_id, depth, now):
+        minutes = sorted(random.sample(range(1, depth * 100), depth))
+        return [
+            Tweet(id=-(author_id * depth + index), user_id=author_id, created_at=now - timedelta(minutes=minute))
+            for index, minute in enumerate(minutes)
+        ]
+
+    def benchmark(self, authors, depth, newsfeeds, tweet_lists, calls):
+        # every source is full, nothing older than the newest of their last
+        # objects is merged, same as NewsFeedService.get_cached_newsfeeds
+        cutoff = max(objects[-1].created_at for objects in [newsfeeds] + tweet_lists)
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            merged = NewsFeedService.merge_newsfeeds(1, newsfeeds, tweet_lists, cutoff)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        self.stdout.write('{} pull authors, depth {}: {} merged, p50 {:.2f} ms, p99 {:.2f} ms'.format(
+            authors,
+            depth,
+            len(merged),
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+        ))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeedFanout
+from utils.time_helpers import utc_now
+
+
+class Command(BaseCommand):
+    help = 'Progress and throughput of the newsfeed fanouts, in flight ones by default'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='include finished fanouts')
+        parser.add_argument('--limit', type=int, default=20)
+
+    def handle(self, *args, **options):
+        fanouts = NewsFeedFanout.objects.all()
+        if not options['all']:
+            fanouts = fanouts.filter(finished_at__isnull=True)
+
+        now = utc_now()
+        for fanout in fanouts.order_by('-created_at')[:options['limit']]:
+            seconds = ((fanout.finished_at or now) - fanout.created_at).total_seconds()
+            batches_total = fanout.batches_total if fanout.batches_total is not None else '?'
+            self.stdout.write(
+                'fanout {} of tweet {} in {} ({} per batch): {}/{} batches, '
+                '{} followers in {:.1f}s, {:.0f} followers/s{}'.format(
+                    fanout.id,
+                    fanout.tweet_id,
+                    fanout.queue,
+                    fanout.batch_size,
+                    fanout.batches_done,
+                    batches_total,
+                    fanout.followers_reached,
+                    seconds,
+                    fanout.followers_reached / seconds if seconds else 0,
+                    '' if fanout.finished_at else ', in flight',
+                )
+            )
@@ -0,0 +1,47 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweets', '0004_auto_20220318_0033'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('newsfeeds', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NewsFeedFanout',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batches_total', models.IntegerField(null=True)),
+                ('batches_done', models.IntegerField(default=0)),
+                ('followers_reached', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('tweet', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='tweets.tweet')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-created_at',),
+                'index_together': {('finished_at', 'created_at')},
+            },
+        ),
+        migrations.CreateModel(
+            name='NewsFeedFanoutBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField()),
+                ('followers_count', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('fanout', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='newsfeeds.newsfeedfanout')),
+            ],
+            options={
+                'unique_together': {('fanout', 'index')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsfeeds', '0002_newsfeedfanout_newsfeedfanoutbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsfeedfanout',
+            name='batch_size',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='newsfeedfanout',
+            name='queue',
+            field=models.CharField(default='newsfeeds', max_length=32),
+        ),
+    ]
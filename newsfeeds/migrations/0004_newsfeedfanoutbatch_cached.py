@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('newsfeeds', '0003_auto_20261018_1358'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsfeedfanoutbatch',
+            name='cached',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save
+from newsfeeds.constants import FANOUT_QUEUE
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
 from newsfeeds.listeners import push_newsfeed_to_cache
@@ -22,6 +23,49 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        # set by the list serializer prefetch
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
-post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
\ No newline at end of file
+post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
+
+
+class NewsFeedFanout(models.Model):
+    # progress of fanning out a tweet to the followers of its author
+    tweet = models.ForeignKey(Tweet, on_delete=models.SET_NULL, null=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    # celery queue and size of the batches
+    queue = models.CharField(max_length=32, default=FANOUT_QUEUE)
+    batch_size = models.IntegerField(null=True)
+    # unknown until all the follower ids are read
+    batches_total = models.IntegerField(null=True)
+    batches_done = models.IntegerField(default=0)
+    followers_reached = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # null while the fanout is in flight
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (('finished_at', 'created_at'),)
+        ordering = ('-created_at', )
+
+    def __str__(self):
+        return f'{self.created_at} fanout of {self.tweet}: {self.batches_done}/{self.batches_total}'
+
+
+class NewsFeedFanoutBatch(models.Model):
+    # a finished batch, a retried batch is only counted once
+    fanout = models.ForeignKey(NewsFeedFanout, on_delete=models.CASCADE)
+    index = models.IntegerField()
+    followers_count = models.IntegerField()
+    # set once the newsfeeds are pushed to the cached lists, a retry pushes
+    # them again until then
+    cached = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('fanout', 'index'),)
+
+    def __str__(self):
+        return f'{self.created_at} batch {self.index} of {self.fanout_id}'
\ No newline at end of file
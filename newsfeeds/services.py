@@ -1,10 +1,41 @@
-from newsfeeds.models import NewsFeed
+from django.conf import settings
+from django.db.models import F
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from newsfeeds.constants import (
+    FANOUT_BATCH_LATENCY_SAMPLES,
+    FANOUT_BATCH_MAX_SIZE,
+    FANOUT_BATCH_MIN_SIZE,
+    FANOUT_BATCH_SIZE,
+    FANOUT_BATCH_TARGET_SECONDS,
+    FANOUT_LARGE_FOLLOWER_THRESHOLD,
+    FANOUT_LARGE_QUEUE,
+    FANOUT_QUEUE,
+    NEWSFEED_PULL_AUTHORS_CACHE_TTL,
+    NEWSFEED_PULL_MERGE_DEPTH,
+)
+from newsfeeds.models import NewsFeed, NewsFeedFanout, NewsFeedFanoutBatch
 from newsfeeds.tasks import fanout_newsfeeds_main_task
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    FANOUT_BATCH_LATENCY_KEY,
+    NEWSFEED_PULL_AUTHORS_KEY,
+    USER_NEWSFEEDS_PATTERN,
+    USER_NEWSFEEDS_SORTED_SET_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
+from utils.time_helpers import utc_now
+
+import heapq
+import time
 
 
 class NewsFeedService:
+    # (expire_at, pull author ids), the copy of this process
+    _pull_author_ids = (0, frozenset())
     
     @classmethod
     def fanout_to_followers(cls, tweet):
@@ -13,17 +44,275 @@ class NewsFeedService:
         # fanout_newsfeeds_main_task(tweet.id, tweet.user_id)  # synchronously
 
     @classmethod
-    def get_cached_newsfeeds(cls, user_id):
+    def get_fanout_queue(cls, follower_count):
+        if follower_count >= FANOUT_LARGE_FOLLOWER_THRESHOLD:
+            return FANOUT_LARGE_QUEUE
+        return FANOUT_QUEUE
+
+    @classmethod
+    def record_fanout_batch_latency(cls, followers_count, seconds):
+        if not followers_count:
+            return
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.lpush(FANOUT_BATCH_LATENCY_KEY, '{}:{}'.format(followers_count, seconds))
+        pipeline.ltrim(FANOUT_BATCH_LATENCY_KEY, 0, FANOUT_BATCH_LATENCY_SAMPLES - 1)
+        pipeline.execute()
+
+    @classmethod
+    def get_fanout_batch_size(cls, queue):
+        """
+        followers per batch so that a batch takes about the target seconds of
+        the queue. the seconds per follower are summed over the recent
+        batches instead of averaged, so the small last batch of a fanout,
+        where the fixed cost per batch dominates, doesn't shrink the batches
+        """
+        conn = RedisClient.get_connection()
+        samples = conn.lrange(FANOUT_BATCH_LATENCY_KEY, 0, -1)
+        if not samples:
+            return FANOUT_BATCH_SIZE
+        total_followers = 0
+        total_seconds = 0
+        for sample in samples:
+            followers_count, seconds = sample.split(b':')
+            total_followers += int(followers_count)
+            total_seconds += float(seconds)
+        if not total_seconds:
+            return FANOUT_BATCH_MAX_SIZE
+        batch_size = int(FANOUT_BATCH_TARGET_SECONDS[queue] * total_followers / total_seconds)
+        return max(FANOUT_BATCH_MIN_SIZE, min(FANOUT_BATCH_MAX_SIZE, batch_size))
+
+    @classmethod
+    def record_fanout_batch(cls, fanout_id, batch_index, followers_count):
+        # the progress is only counted by the first attempt of the batch
+        batch, created = NewsFeedFanoutBatch.objects.get_or_create(
+            fanout_id=fanout_id,
+            index=batch_index,
+            defaults={'followers_count': followers_count},
+        )
+        if created:
+            NewsFeedFanout.objects.filter(id=fanout_id).update(
+                batches_done=F('batches_done') + 1,
+                followers_reached=F('followers_reached') + followers_count,
+            )
+        return batch
+
+    @classmethod
+    def finish_fanout_if_done(cls, fanout_id):
+        # called by the main task once batches_total is known and by every
+        # batch, whichever comes last finishes the fanout
+        NewsFeedFanout.objects.filter(
+            id=fanout_id,
+            finished_at__isnull=True,
+            batches_done=F('batches_total'),
+        ).update(finished_at=utc_now())
+
+    @classmethod
+    def add_pull_author(cls, user_id):
+        # an author never leaves pull mode, the tweets that were not fanned
+        # out would disappear from the newsfeeds
+        RedisClient.get_connection().sadd(NEWSFEED_PULL_AUTHORS_KEY, user_id)
+        cls._pull_author_ids = (0, frozenset())
+
+    @classmethod
+    def get_pull_author_ids(cls):
+        # authors rarely get into pull mode, the set is read from redis at most
+        # once every NEWSFEED_PULL_AUTHORS_CACHE_TTL seconds per process
+        expire_at, pull_author_ids = cls._pull_author_ids
+        if expire_at > time.time():
+            return pull_author_ids
+        pull_author_ids = frozenset(
+            int(author_id)
+            for author_id in RedisClient.get_connection().smembers(NEWSFEED_PULL_AUTHORS_KEY)
+        )
+        cls._pull_author_ids = (time.time() + NEWSFEED_PULL_AUTHORS_CACHE_TTL, pull_author_ids)
+        return pull_author_ids
+
+    @classmethod
+    def get_followed_pull_author_ids(cls, user_id):
+        pull_author_ids = cls.get_pull_author_ids()
+        if not pull_author_ids:
+            return []
+        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            # the MySQL following set is stale once follows go to hbase, only
+            # the pull authors are looked up, in one batched get
+            followed_user_id_set = FriendshipService.get_followed_user_id_set(
+                user_id,
+                list(pull_author_ids),
+            )
+        else:
+            followed_user_id_set = FriendshipService.get_following_user_id_set(user_id)
+        return sorted(pull_author_ids & set(followed_user_id_set))
+
+    @classmethod
+    def merge_newsfeeds(cls, user_id, newsfeeds, tweet_lists, min_created_at=None):
+        """
+        k-way merge of the pushed newsfeeds and the pulled tweets by created_at,
+        newest first, stops before min_created_at. pulled tweets become unsaved
+        newsfeeds, a tweet fanned out before its author got into pull mode is
+        only kept once
+        """
+        merged = []
+        tweet_ids = set()
+        for obj in heapq.merge(
+            newsfeeds,
+            *tweet_lists,
+            key=lambda obj: obj.created_at,
+            reverse=True,
+        ):
+            if min_created_at is not None and obj.created_at < min_created_at:
+                break
+            tweet_id = obj.id if isinstance(obj, Tweet) else obj.tweet_id
+            if tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(tweet_id)
+            if isinstance(obj, Tweet):
+                # only the merged tweets are turned into newsfeeds
+                obj = NewsFeed(user_id=user_id, tweet_id=obj.id, created_at=obj.created_at)
+            merged.append(obj)
+        return merged
+
+    @classmethod
+    def _get_pushed_newsfeeds(cls, user_id):
         # queryset is lazy-loading
         queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        if cls.is_sorted_set_cache():
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=user_id)
+            newsfeed_ids, total = RedisHelper.load_ids_by_score(key, queryset)
+            return MemcachedHelper.get_objects_through_cache(NewsFeed, newsfeed_ids)
 
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
         return RedisHelper.load_objects(key, queryset)
 
+    @classmethod
+    def _get_recent_pushed_newsfeeds(cls, user_id, count):
+        # only the newest count newsfeeds are read from redis and deserialized
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        if cls.is_sorted_set_cache():
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=user_id)
+            newsfeed_ids, total = RedisHelper.load_ids_by_score(key, queryset, count=count)
+            return MemcachedHelper.get_objects_through_cache(NewsFeed, newsfeed_ids)
+
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        page = RedisHelper.load_page(key, queryset, 'first', count=count)
+        if page is None:
+            return list(queryset[:count])
+        return page[0]
+
+    @classmethod
+    def _get_cached_newsfeeds_and_cutoff(cls, user_id, pull_author_ids):
+        """
+        merged cached newsfeeds, and the created_at before which the merged
+        list may miss newsfeeds, older ones are left to DB (None if nothing
+        is missing)
+        """
+        # every source is read to the same depth, deeper pages come from DB
+        newsfeeds = cls._get_recent_pushed_newsfeeds(user_id, NEWSFEED_PULL_MERGE_DEPTH)
+        tweet_lists = [
+            TweetService.get_recent_cached_tweets(author_id, NEWSFEED_PULL_MERGE_DEPTH)
+            for author_id in pull_author_ids
+        ]
+        # a source read to the full depth may have older objects in DB only
+        cutoffs = [
+            objects[-1].created_at
+            for objects in [newsfeeds] + tweet_lists
+            if objects and len(objects) >= NEWSFEED_PULL_MERGE_DEPTH
+        ]
+        cutoff = max(cutoffs) if cutoffs else None
+        return cls.merge_newsfeeds(user_id, newsfeeds, tweet_lists, cutoff), cutoff
+
+    @classmethod
+    def get_cached_newsfeeds(cls, user_id):
+        pull_author_ids = cls.get_followed_pull_author_ids(user_id)
+        if not pull_author_ids:
+            return cls._get_pushed_newsfeeds(user_id)
+
+        newsfeeds, cutoff = cls._get_cached_newsfeeds_and_cutoff(user_id, pull_author_ids)
+        # older newsfeeds may be missing, the caller reads them from DB
+        return newsfeeds
+
+    @classmethod
+    def is_sorted_set_cache(cls):
+        return settings.REDIS_TIMELINE_CACHE_TYPES['newsfeeds'] == 'sorted_set'
+
+    @classmethod
+    def paginate_cached_newsfeeds(cls, user_id, paginator, request):
+        # only the requested page is read from redis, None if it is not cached
+        pull_author_ids = cls.get_followed_pull_author_ids(user_id)
+        if pull_author_ids:
+            return cls._paginate_merged_newsfeeds(user_id, pull_author_ids, paginator, request)
+
+        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
+        if cls.is_sorted_set_cache():
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=user_id)
+            newsfeed_ids = paginator.paginate_cached_sorted_set(key, queryset, request)
+            if newsfeed_ids is None:
+                return None
+            return MemcachedHelper.get_objects_through_cache(NewsFeed, newsfeed_ids)
+
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        return paginator.paginate_cached_list(key, queryset, request)
+
+    @classmethod
+    def _paginate_merged_newsfeeds(cls, user_id, pull_author_ids, paginator, request):
+        newsfeeds, cutoff = cls._get_cached_newsfeeds_and_cutoff(user_id, pull_author_ids)
+        page = paginator.paginate_ordered_list(newsfeeds, request)
+        if 'created_at__gt' in request.query_params or paginator.has_next_page:
+            return page
+        # the rest of the page may only be in DB
+        if cutoff is not None:
+            return None
+        return page
+
+    @classmethod
+    def paginate_newsfeeds_from_db(cls, user_id, paginator, request):
+        # the pulled tweets are merged into the DB newsfeeds page too
+        newsfeeds = list(paginator.paginate_queryset(
+            NewsFeed.objects.filter(user_id=user_id),
+            request,
+        ))
+        pull_author_ids = cls.get_followed_pull_author_ids(user_id)
+        if not pull_author_ids:
+            return newsfeeds
+
+        has_next_page = paginator.has_next_page
+        tweets = paginator.paginate_queryset(
+            Tweet.objects.filter(user_id__in=pull_author_ids),
+            request,
+        )
+        newsfeeds = cls.merge_newsfeeds(user_id, newsfeeds, [tweets])
+        if 'created_at__gt' in request.query_params:
+            return newsfeeds
+        paginator.has_next_page = (
+            has_next_page
+            or paginator.has_next_page
+            or len(newsfeeds) > paginator.page_size
+        )
+        return newsfeeds[:paginator.page_size]
+
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
         # queryset is lazy-loading
         queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
+        if cls.is_sorted_set_cache():
+            key = USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=newsfeed.user_id)
+            return RedisHelper.push_object_to_sorted_set(key, newsfeed, queryset)
+
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
 
-        return RedisHelper.push_object(key, newsfeed, queryset)
\ No newline at end of file
+        return RedisHelper.push_object(key, newsfeed, queryset)
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        # one pipeline for a fanout batch, followers without a cached
+        # newsfeed list are skipped
+        if cls.is_sorted_set_cache():
+            return RedisHelper.push_objects_to_sorted_set([
+                (USER_NEWSFEEDS_SORTED_SET_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+                for newsfeed in newsfeeds
+            ])
+
+        return RedisHelper.push_objects([
+            (USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+            for newsfeed in newsfeeds
+        ])
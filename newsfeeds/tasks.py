@@ -1,29 +1,76 @@
 from celery import shared_task
+from django.db import transaction
 from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
-from newsfeeds.models import NewsFeed
+from newsfeeds.constants import (
+    FANOUT_BATCH_MAX_RETRIES,
+    NEWSFEED_PULL_FOLLOWER_THRESHOLD,
+)
+from newsfeeds.models import NewsFeed, NewsFeedFanout, NewsFeedFanoutBatch
 from utils.time_constants import ONE_HOUR
 
+import time
+
 
 @shared_task(routing_key='default', time_limit=ONE_HOUR)
 def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
     # user can see his tweet in his newsfeeds
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
+    NewsFeed.objects.get_or_create(user_id=tweet_user_id, tweet_id=tweet_id)
+
+    # import here since there is a cycle import
+    from newsfeeds.services import NewsFeedService
+    follower_count = FriendshipService.get_follower_count(tweet_user_id)
+    if follower_count >= NEWSFEED_PULL_FOLLOWER_THRESHOLD:
+        # followers pull the tweet from the author's user_tweets cache
+        NewsFeedService.add_pull_author(tweet_user_id)
+        return '{} followers, newsfeeds will be pulled'.format(follower_count)
 
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    queue = NewsFeedService.get_fanout_queue(follower_count)
+    batch_size = NewsFeedService.get_fanout_batch_size(queue)
+    fanout = NewsFeedFanout.objects.create(
+        tweet_id=tweet_id,
+        user_id=tweet_user_id,
+        queue=queue,
+        batch_size=batch_size,
+    )
+    # batches are enqueued while the follower ids are still being read
+    follower_count = 0
+    batch_count = 0
+    batch_ids = []
+    for follower_id in FriendshipService.iter_follower_ids(tweet_user_id):
+        batch_ids.append(follower_id)
+        follower_count += 1
+        if len(batch_ids) == batch_size:
+            fanout_newsfeeds_batch_task.apply_async(
+                args=(tweet_id, batch_ids, fanout.id, batch_count),
+                routing_key=queue,
+            )
+            batch_count += 1
+            batch_ids = []
+    if batch_ids:
+        fanout_newsfeeds_batch_task.apply_async(
+            args=(tweet_id, batch_ids, fanout.id, batch_count),
+            routing_key=queue,
+        )
+        batch_count += 1
+    NewsFeedFanout.objects.filter(id=fanout.id).update(batches_total=batch_count)
+    NewsFeedService.finish_fanout_if_done(fanout.id)
 
     return '{} newsfeeds will be fanned out, {} batches created'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1
+        follower_count,
+        batch_count,
     )
 
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
+# acks_late: the batch of a worker that died is delivered again, it's safe
+# to run a batch more than once
+@shared_task(
+    routing_key='newsfeeds',
+    time_limit=ONE_HOUR,
+    acks_late=True,
+    autoretry_for=(Exception, ),
+    retry_backoff=True,
+    max_retries=FANOUT_BATCH_MAX_RETRIES,
+)
+def fanout_newsfeeds_batch_task(tweet_id, follower_ids, fanout_id=None, batch_index=None):
     # import here since there is a cycle import
     from newsfeeds.services import NewsFeedService
     newsfeeds = [
@@ -31,9 +78,38 @@ def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
         NewsFeed(user_id=follower_id, tweet_id=tweet_id)
         for follower_id in follower_ids
     ]
-    NewsFeed.objects.bulk_create(newsfeeds)
+    start = time.time()
+    batch = None
+    with transaction.atomic():
+        # newsfeeds created by an earlier attempt are skipped
+        NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
+        if fanout_id is not None:
+            batch = NewsFeedService.record_fanout_batch(
+                fanout_id,
+                batch_index,
+                len(follower_ids),
+            )
+    if fanout_id is not None:
+        NewsFeedService.finish_fanout_if_done(fanout_id)
+    if batch is not None and batch.cached:
+        return '{} newsfeeds were already created and cached.'.format(len(newsfeeds))
+    # the rows are read back so every attempt pushes the same ids and
+    # created_at, a list that already got a newsfeed skips it
+    newsfeeds = NewsFeed.objects.filter(tweet_id=tweet_id, user_id__in=follower_ids)
+    db_seconds = time.time() - start
+
     # bulk_create won't trigger post_save signal
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+    start = time.time()
+    cached_count = NewsFeedService.push_newsfeeds_to_cache(newsfeeds)
+    cache_seconds = time.time() - start
+    if batch is not None:
+        NewsFeedFanoutBatch.objects.filter(id=batch.id).update(cached=True)
+    # the next fanouts size their batches from this
+    NewsFeedService.record_fanout_batch_latency(len(follower_ids), db_seconds + cache_seconds)
 
-    return '{} newsfeeds are created.'.format(len(newsfeeds))
\ No newline at end of file
+    return '{} newsfeeds are created in {:.3f}s, {} cached lists updated in {:.3f}s.'.format(
+        len(newsfeeds),
+        db_seconds,
+        cached_count,
+        cache_seconds,
+    )
\ No newline at end of file
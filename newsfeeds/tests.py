@@ -1,9 +1,18 @@
-from newsfeeds.models import NewsFeed
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from newsfeeds.constants import (
+    FANOUT_BATCH_SIZE,
+    NEWSFEED_PULL_FOLLOWER_THRESHOLD,
+    NEWSFEED_PULL_MERGE_DEPTH,
+)
+from newsfeeds.models import NewsFeed, NewsFeedFanout, NewsFeedFanoutBatch
 from newsfeeds.services import NewsFeedService
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.tasks import fanout_newsfeeds_batch_task, fanout_newsfeeds_main_task
 from testing.testcases import TestCase
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_microseconds
 
 
 class NewsFeedServiceTests(TestCase):
@@ -49,6 +58,52 @@ class NewsFeedServiceTests(TestCase):
         self.user2.save()
         self.assertEqual(newsfeeds[0].user.username, "new_username")
 
+    def test_cached_newsfeed_page_in_redis(self):
+        newsfeeds = []
+        for i in range(3):
+            tweet = self.create_tweet(self.user1, 'content:{}'.format(i))
+            newsfeeds.append(self.create_newsfeed(self.user2, tweet))
+        newsfeeds = newsfeeds[::-1]
+        RedisClient.clear()
+
+        # cache miss, the list and its scores are loaded together
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.user2.id)
+        queryset = NewsFeed.objects.filter(user_id=self.user2.id).order_by('-created_at')
+        scores = RedisHelper.load_scores(key, queryset)
+        self.assertEqual(scores, [
+            datetime_to_microseconds(newsfeed.created_at)
+            for newsfeed in newsfeeds
+        ])
+        page = RedisHelper.load_objects_range(key, 1, 3)
+        self.assertEqual([newsfeed.id for newsfeed in page], [newsfeeds[1].id, newsfeeds[2].id])
+
+        # pushed newsfeed updates the scores as well
+        tweet = self.create_tweet(self.user1)
+        newsfeed = self.create_newsfeed(self.user2, tweet)
+        scores = RedisHelper.load_scores(key, queryset)
+        self.assertEqual(len(scores), 4)
+        self.assertEqual(scores[0], datetime_to_microseconds(newsfeed.created_at))
+        page = RedisHelper.load_objects_range(key, 0, 1)
+        self.assertEqual(page[0].id, newsfeed.id)
+
+        # a page is located and read in one script
+        newsfeeds.insert(0, newsfeed)
+        objects, length, start = RedisHelper.load_page(
+            key,
+            queryset,
+            'lt',
+            cursor=scores[1],
+            count=2,
+        )
+        self.assertEqual(length, 4)
+        self.assertEqual(start, 2)
+        self.assertEqual([obj.id for obj in objects], [newsfeeds[2].id, newsfeeds[3].id])
+        objects, length, start = RedisHelper.load_page(key, queryset, 'gt', cursor=scores[2])
+        self.assertEqual([obj.id for obj in objects], [newsfeeds[0].id, newsfeeds[1].id])
+        objects, length, start = RedisHelper.load_page(key, queryset, 'first', count=3)
+        self.assertEqual(len(objects), 3)
+
+
 class NewsFeedTaskTests(TestCase):
 
     def setUp(self):
@@ -83,8 +138,141 @@ class NewsFeedTaskTests(TestCase):
         # 4 followers now, fanout batch size = 3 if TESTING
         self.assertEqual(msg, '4 newsfeeds will be fanned out, 2 batches created')
         self.assertEqual(NewsFeed.objects.count(), 11)
+        fanout = NewsFeedFanout.objects.get(tweet=tweet)
+        # FANOUT_LARGE_FOLLOWER_THRESHOLD = 4 if TESTING
+        self.assertEqual(fanout.queue, 'newsfeeds_large')
+        self.assertEqual(fanout.batches_total, 2)
+        self.assertEqual(fanout.batches_done, 2)
+        self.assertEqual(fanout.followers_reached, 4)
+        self.assertNotEqual(fanout.finished_at, None)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user1.id)
         self.assertEqual(len(cached_list), 3)
         # user1 post 3 tweets, so user2 has 3 in newsfeeds
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user2.id)
-        self.assertEqual(len(cached_list), 3)
\ No newline at end of file
+        self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_batch_size(self):
+        self.assertEqual(NewsFeedService.get_fanout_queue(3), 'newsfeeds')
+        self.assertEqual(NewsFeedService.get_fanout_queue(4), 'newsfeeds_large')
+        # nothing measured yet
+        self.assertEqual(NewsFeedService.get_fanout_batch_size('newsfeeds'), FANOUT_BATCH_SIZE)
+
+        # fast batches, FANOUT_BATCH_MAX_SIZE = 3 if TESTING
+        for i in range(10):
+            NewsFeedService.record_fanout_batch_latency(3, 0.003)
+        self.assertEqual(NewsFeedService.get_fanout_batch_size('newsfeeds'), 3)
+
+        # slow batches, FANOUT_BATCH_MIN_SIZE = 2 if TESTING
+        for i in range(10):
+            NewsFeedService.record_fanout_batch_latency(3, 30)
+        self.assertEqual(NewsFeedService.get_fanout_batch_size('newsfeeds'), 2)
+        self.assertEqual(NewsFeedService.get_fanout_batch_size('newsfeeds_large'), 2)
+
+    def test_fanout_batch_task_runs_twice(self):
+        # user2 has a cached newsfeed list
+        self.create_newsfeed(self.user2, self.create_tweet(self.user1))
+        NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        tweet = self.create_tweet(self.user1)
+        fanout = NewsFeedFanout.objects.create(tweet=tweet, user=self.user1, batches_total=1)
+        follower_ids = [self.user2.id, self.create_user('user0').id]
+
+        fanout_newsfeeds_batch_task(tweet.id, follower_ids, fanout.id, 0)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 2)
+        self.assertEqual(len(NewsFeedService.get_cached_newsfeeds(self.user2.id)), 2)
+        fanout.refresh_from_db()
+        self.assertEqual(fanout.batches_done, 1)
+        self.assertEqual(fanout.followers_reached, 2)
+        self.assertNotEqual(fanout.finished_at, None)
+
+        # the worker died after the newsfeeds were committed, before the cache
+        # push finished, the batch is delivered again
+        NewsFeedFanoutBatch.objects.filter(fanout=fanout).update(cached=False)
+        fanout_newsfeeds_batch_task(tweet.id, follower_ids, fanout.id, 0)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 2)
+        # only counted once, and not pushed twice to the cached list
+        fanout.refresh_from_db()
+        self.assertEqual(fanout.batches_done, 1)
+        self.assertEqual(fanout.followers_reached, 2)
+        self.assertEqual(len(NewsFeedService.get_cached_newsfeeds(self.user2.id)), 2)
+        self.assertEqual(NewsFeedFanoutBatch.objects.get(fanout=fanout).cached, True)
+
+        msg = fanout_newsfeeds_batch_task(tweet.id, follower_ids, fanout.id, 0)
+        self.assertEqual(msg, '2 newsfeeds were already created and cached.')
+
+        # without a fanout record, existing newsfeeds are skipped
+        fanout_newsfeeds_batch_task(tweet.id, follower_ids)
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 2)
+        self.assertEqual(len(NewsFeedService.get_cached_newsfeeds(self.user2.id)), 2)
+
+    def test_push_newsfeeds_to_cache(self):
+        user3 = self.create_user('testuser3')
+        self.create_newsfeed(self.user2, self.create_tweet(self.user1))
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        # only user2 has a cached newsfeed list
+        NewsFeedService.get_cached_newsfeeds(self.user2.id)
+
+        # bulk_create won't push newsfeeds to cache
+        tweet = self.create_tweet(self.user1)
+        NewsFeed.objects.bulk_create([
+            NewsFeed(user=user, tweet=tweet)
+            for user in [self.user2, user3]
+        ])
+        newsfeeds = list(NewsFeed.objects.filter(tweet=tweet).order_by('user_id'))
+
+        self.assertEqual(NewsFeedService.push_newsfeeds_to_cache(newsfeeds), 1)
+        cached_list = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual(len(cached_list), 2)
+        self.assertEqual(cached_list[0].id, newsfeeds[0].id)
+        self.assertEqual(conn.exists(USER_NEWSFEEDS_PATTERN.format(user_id=user3.id)), False)
+
+    def test_pull_newsfeeds_of_popular_author(self):
+        # user2 follows user1 before user1 gets popular
+        self.create_friendship(self.user2, self.user1)
+        old_tweet = self.create_tweet(self.user1)
+        fanout_newsfeeds_main_task(old_tweet.id, self.user1.id)
+
+        for i in range(NEWSFEED_PULL_FOLLOWER_THRESHOLD - 1):
+            self.create_friendship(self.create_user('user{}'.format(i)), self.user1)
+        tweet = self.create_tweet(self.user1)
+        msg = fanout_newsfeeds_main_task(tweet.id, self.user1.id)
+        self.assertEqual(msg, '5 followers, newsfeeds will be pulled')
+        # only user1 has a newsfeed of the tweet
+        self.assertEqual(NewsFeed.objects.filter(tweet=tweet).count(), 1)
+
+        other_tweet = self.create_tweet(self.create_user('another user'))
+        other_newsfeed = self.create_newsfeed(self.user2, other_tweet)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+            [other_tweet.id, tweet.id, old_tweet.id],
+        )
+        self.assertEqual(newsfeeds[0].id, other_newsfeed.id)
+        # pulled tweet, not saved as a newsfeed
+        self.assertEqual(newsfeeds[1].id, None)
+        # the fanned out newsfeed is kept, the pulled duplicate is dropped
+        self.assertNotEqual(newsfeeds[2].id, None)
+
+        # only the newest tweets are pulled, older newsfeeds are read from DB
+        for i in range(NEWSFEED_PULL_MERGE_DEPTH):
+            self.create_tweet(self.user1)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+        self.assertEqual(len(newsfeeds), NEWSFEED_PULL_MERGE_DEPTH)
+
+    def test_followed_pull_author_ids_in_mysql(self):
+        self._test_followed_pull_author_ids()
+
+    def test_followed_pull_author_ids_in_hbase(self):
+        GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
+        self._test_followed_pull_author_ids()
+
+    def _test_followed_pull_author_ids(self):
+        user3 = self.create_user('testuser3')
+        FriendshipService.follow(self.user2.id, self.user1.id)
+        FriendshipService.follow(self.user2.id, user3.id)
+        self.assertEqual(NewsFeedService.get_followed_pull_author_ids(self.user2.id), [])
+
+        NewsFeedService.add_pull_author(self.user1.id)
+        NewsFeedService.add_pull_author(self.user2.id)
+        self.assertEqual(NewsFeedService.get_followed_pull_author_ids(self.user2.id), [self.user1.id])
+        self.assertEqual(NewsFeedService.get_followed_pull_author_ids(user3.id), [])
@@ -2,6 +2,7 @@ from comments.models import Comment
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
+from django.db import connection
 from django.test import TestCase as DjangoTestCase
 from django_hbase.models import HBaseModel
 from friendships.services import FriendshipService
@@ -37,6 +38,14 @@ class TestCase(DjangoTestCase):
         caches['testing'].clear()
         # GateKeeper.set('switch_friendship_to_hbase', 'percent', 100)
 
+    def run_on_commit_callbacks(self):
+        # the test transaction never commits, run the transaction.on_commit
+        # callbacks as if it had
+        callbacks = connection.run_on_commit
+        connection.run_on_commit = []
+        for savepoint_ids, callback in callbacks:
+            callback()
+
     @property
     def anonymous_user(self):
         if hasattr(self, '_anonymous_user'):
@@ -1,5 +1,7 @@
 from accounts.api.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from comments.api.serializers import CommentSerializer
+from django.contrib.contenttypes.models import ContentType
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
 from random import randint
@@ -9,6 +11,7 @@ from tweets.constants import TWEET_PHOTO_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
@@ -31,8 +34,24 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, instances):
+        UserService.prefetch_users(instances)
+        # has_liked of the whole page in one query
+        self._liked_object_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            ContentType.objects.get_for_model(Tweet),
+            [tweet.id for tweet in instances],
+        )
+        # photo urls of the whole page in one batch
+        self._photo_urls = TweetService.get_photo_urls_through_cache(
+            [tweet.id for tweet in instances],
+        )
 
     def get_has_liked(self, obj): # liked by current user?
+        if hasattr(self, '_liked_object_ids'):
+            return obj.id in self._liked_object_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_likes_count(self, obj):
@@ -40,9 +59,7 @@ class TweetSerializer(serializers.ModelSerializer):
         # if not equal, correct it. (count in Tweet table might be inaccurate as time going)
         if randint(0, 999) == 0:
             actual_likes_count = obj.like_set.count()
-            if obj.likes_count != actual_likes_count:
-                obj.likes_count = actual_likes_count
-                obj.save()
+            self.recount(obj, 'likes_count', actual_likes_count)
             return actual_likes_count
 
         return RedisHelper.get_count(obj, 'likes_count')
@@ -51,20 +68,29 @@ class TweetSerializer(serializers.ModelSerializer):
     def get_comments_count(self, obj):
         if randint(0, 999) == 0:
             actual_comments_count = obj.comment_set.count()
-            if obj.comments_count != actual_comments_count:
-                obj.comments_count = actual_comments_count
-                obj.save()
+            self.recount(obj, 'comments_count', actual_comments_count)
             return actual_comments_count
 
         return RedisHelper.get_count(obj, 'comments_count')
         # return obj.comment_set.count()
 
-    def get_photo_urls(self, obj):
-        photo_urls = []
-        for photo in obj.tweetphoto_set.all().order_by('order'):
-            photo_urls.append(photo.file.url)
+    def recount(self, obj, attr, actual_count):
+        # the deltas not flushed yet will still be added to the db count
+        counts = RedisHelper.read_count(obj, attr)
+        if counts is None:
+            return
+        db_count, pending = counts
+        if db_count + pending != actual_count:
+            # only if no flush changed the row since it was read, .update() so
+            # the other counts of a cached obj are not written back
+            Tweet.objects.filter(id=obj.id, **{attr: db_count}).update(
+                **{attr: actual_count - pending},
+            )
 
-        return photo_urls
+    def get_photo_urls(self, obj):
+        if hasattr(self, '_photo_urls'):
+            return self._photo_urls[obj.id]
+        return TweetService.get_photo_urls_through_cache([obj.id])[obj.id]
 
 
 class TweetSerializerForCreate(serializers.ModelSerializer):
@@ -34,8 +34,7 @@ class TweetViewSet(viewsets.GenericViewSet):
         #     return Response({'error': 'missing user_id'}, status=400)
 
         user_id = request.query_params['user_id']
-        cached_tweets_list = TweetService.get_cached_tweets(user_id)
-        tweets = self.paginator.paginated_cached_list_in_redis(cached_tweets_list, request)
+        tweets = TweetService.paginate_cached_tweets(user_id, self.paginator, request)
         if tweets is None:
             # order_by cannot add to paginate_queryset
             queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
@@ -11,4 +11,16 @@ TWEET_PHOTO_STATUS_CHOICES = (
 )
 
 # max 9 photos
-TWEET_PHOTO_UPLOAD_LIMIT = 9
\ No newline at end of file
+TWEET_PHOTO_UPLOAD_LIMIT = 9
+
+# s3 signed urls expire in 1 hour (AWS_QUERYSTRING_EXPIRE), cached urls must
+# expire before them
+TWEET_PHOTO_URLS_CACHE_TIMEOUT = 1800
+
+# write behind counts, object ids updated per transaction when flushing
+COUNT_DELTAS_FLUSH_BATCH_SIZE = 1000
+# a few times the beat interval of flush_count_deltas_task, a dead flusher
+# doesn't stop the flushes for long, a live one extends it after each batch
+COUNT_DELTAS_FLUSH_LOCK_TTL = 60
+# CountFlushBatch rows are only needed to replay the last flushes
+COUNT_FLUSH_BATCH_KEEP_DAYS = 1
@@ -1,3 +1,7 @@
+def invalidate_photo_urls_cache(sender, instance, **kwargs):
+    from tweets.services import TweetService
+    TweetService.invalidate_photo_urls_cache(instance.tweet_id)
+
 def push_tweet_to_cache(sender, instance, created, **kwargs):
     from tweets.services import TweetService
     if not created: # updates shouldn't append tweet to list
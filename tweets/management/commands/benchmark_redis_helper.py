@@ -0,0 +1,165 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from tweets.models import Tweet
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import DjangoModelSerializer
+from utils.time_helpers import datetime_to_microseconds, utc_now
+
+import itertools
+import redis
+import time
+
+KEY_PREFIX = 'benchmark_redis_helper'
+# the benchmark never runs in the db of the app, see --db
+BENCHMARK_REDIS_DB = 15
+
+
+class RoundTripCountingConnection(redis.Connection):
+    # one send_packed_command per command, or per pipeline
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        RoundTripCountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+class BenchmarkCounterObject:
+    # only used for the counter key, never refreshed from db
+    likes_count = 0
+
+    def __init__(self, id):
+        self.id = id
+
+
+def legacy_push_object(key, obj):
+    conn = RedisClient.get_connection()
+    if not conn.exists(key):
+        return
+    conn.lpush(key, DjangoModelSerializer.serialize(obj))
+    conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+
+
+def legacy_incr_count(obj, attr):
+    conn = RedisClient.get_connection()
+    key = RedisHelper.get_count_key(obj, attr)
+    if conn.exists(key):
+        return conn.incr(key)
+
+
+def legacy_get_count(obj, attr):
+    conn = RedisClient.get_connection()
+    key = RedisHelper.get_count_key(obj, attr)
+    if conn.exists(key):
+        return int(conn.get(key))
+
+
+class Command(BaseCommand):
+    help = 'Round trips and latency of the RedisHelper operations on cached keys, needs redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=2000)
+        parser.add_argument(
+            '--db',
+            type=int,
+            default=BENCHMARK_REDIS_DB,
+            help='redis db used by the benchmark, can not be the db of the app',
+        )
+
+    def handle(self, *args, **options):
+        if options['db'] == settings.REDIS_DB:
+            raise CommandError('--db {} is the redis db of the app'.format(options['db']))
+
+        parent_conn = RedisClient.conn
+        RedisClient.conn = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=RoundTripCountingConnection,
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=options['db'],
+        ))
+        # every key written by the benchmark, deleted when it ends
+        self.keys = []
+        try:
+            self.run(options['calls'])
+        finally:
+            self.cleanup()
+            RedisClient.conn = parent_conn
+
+    def cleanup(self):
+        conn = RedisClient.get_connection()
+        # SCAN does not block the server like KEYS
+        keys = set(self.keys)
+        keys.update(conn.scan_iter(match='{}*'.format(KEY_PREFIX), count=1000))
+        if keys:
+            conn.delete(*keys)
+
+    def run(self, calls):
+        conn = RedisClient.get_connection()
+        now = utc_now()
+        tweet = Tweet(id=1, user_id=1, content='benchmark tweet', created_at=now)
+        counter_object = BenchmarkCounterObject(0)
+        list_key = '{}:list'.format(KEY_PREFIX)
+        legacy_list_key = '{}:legacy_list'.format(KEY_PREFIX)
+        sorted_set_key = '{}:sorted_set'.format(KEY_PREFIX)
+        count_key = RedisHelper.get_count_key(counter_object, 'likes_count')
+        self.keys += [
+            list_key,
+            RedisHelper.get_scores_key(list_key),
+            legacy_list_key,
+            sorted_set_key,
+            count_key,
+        ]
+
+        # all keys are cached, the db is never queried
+        conn.rpush(list_key, DjangoModelSerializer.serialize(tweet))
+        conn.rpush(RedisHelper.get_scores_key(list_key), datetime_to_microseconds(now))
+        conn.rpush(legacy_list_key, DjangoModelSerializer.serialize(tweet))
+        conn.zadd(sorted_set_key, {tweet.id: datetime_to_microseconds(now)})
+        conn.set(count_key, 0)
+
+        # a new tweet per push, push_object skips a tweet already in the list
+        ids = itertools.count(2)
+
+        def new_tweet():
+            tweet_id = next(ids)
+            return Tweet(
+                id=tweet_id,
+                user_id=1,
+                content='benchmark tweet',
+                created_at=now + timedelta(microseconds=tweet_id),
+            )
+
+        operations = [
+            ('legacy push_object', lambda: legacy_push_object(legacy_list_key, new_tweet())),
+            ('push_object', lambda: RedisHelper.push_object(list_key, new_tweet(), None)),
+            ('push_object_to_sorted_set', lambda: RedisHelper.push_object_to_sorted_set(
+                sorted_set_key,
+                new_tweet(),
+                None,
+            )),
+            ('legacy incr_count', lambda: legacy_incr_count(counter_object, 'likes_count')),
+            ('incr_count', lambda: RedisHelper.incr_count(counter_object, 'likes_count')),
+            ('decr_count', lambda: RedisHelper.decr_count(counter_object, 'likes_count')),
+            ('legacy get_count', lambda: legacy_get_count(counter_object, 'likes_count')),
+            ('get_count', lambda: RedisHelper.get_count(counter_object, 'likes_count')),
+        ]
+        for name, operation in operations:
+            self.benchmark(name, operation, calls)
+
+    def benchmark(self, name, operation, calls):
+        # warm up, loads the lua scripts
+        operation()
+        RoundTripCountingConnection.round_trips = 0
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        self.stdout.write('{}: {:.1f} round trips/call, p50 {:.0f} us, p99 {:.0f} us'.format(
+            name,
+            RoundTripCountingConnection.round_trips / calls,
+            latencies[len(latencies) // 2] * 1000000,
+            latencies[int(len(latencies) * 0.99)] * 1000000,
+        ))
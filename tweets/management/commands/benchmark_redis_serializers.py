@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.models import NewsFeed
+from tweets.models import Tweet
+from utils.redis_serializers import JSONModelCodec, MsgpackModelCodec
+from utils.time_helpers import utc_now
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare size and speed of the redis model codecs, no DB or redis needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--objects', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        now = utc_now()
+        samples = [
+            ('Tweet', [
+                Tweet(id=i, user_id=i % 7, content='tweet content {}'.format(i), created_at=now)
+                for i in range(options['objects'])
+            ]),
+            ('NewsFeed', [
+                NewsFeed(id=i, user_id=i % 7, tweet_id=i, created_at=now)
+                for i in range(options['objects'])
+            ]),
+        ]
+        for name, objects in samples:
+            for codec in [JSONModelCodec, MsgpackModelCodec]:
+                self.benchmark(name, codec, objects, options['repeat'])
+
+    def benchmark(self, name, codec, objects, repeat):
+        total = len(objects) * repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            serialized_list = [codec.serialize(obj) for obj in objects]
+        serialize_us = (time.perf_counter() - start) * 1000000 / total
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for serialized_data in serialized_list:
+                codec.deserialize(serialized_data)
+        deserialize_us = (time.perf_counter() - start) * 1000000 / total
+
+        size = sum(len(serialized_data) for serialized_data in serialized_list) / len(objects)
+        self.stdout.write('{} {}: {:.0f} bytes, serialize {:.1f} us/object, deserialize {:.1f} us/object'.format(
+            name,
+            codec.__name__,
+            size,
+            serialize_us,
+            deserialize_us,
+        ))
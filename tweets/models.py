@@ -4,7 +4,7 @@ from django.db import models
 from django.db.models.signals import post_save, pre_delete
 from likes.models import Like
 from tweets.constants import TweetPhotoStatus, TWEET_PHOTO_STATUS_CHOICES
-from tweets.listeners import push_tweet_to_cache
+from tweets.listeners import invalidate_photo_urls_cache, push_tweet_to_cache
 from utils.listeners import invalidate_object_cache
 from utils.memcached_helper import MemcachedHelper
 from utils.time_helpers import utc_now
@@ -44,6 +44,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # set by the list serializer prefetch
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 class TweetPhoto(models.Model):
@@ -73,6 +76,18 @@ class TweetPhoto(models.Model):
     def __str__(self):
         return '{} {}'.format(self.tweet, self.file)
 
+class CountFlushBatch(models.Model):
+    # a batch of write behind count deltas written to db, in the same
+    # transaction, so a batch replayed after a crash is not applied twice
+    # key: '{Model}.{attr}:{flush id}:{first object id}'
+    key = models.CharField(max_length=128, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.created_at, self.key)
+
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
 post_save.connect(invalidate_object_cache, sender=Tweet)
-post_save.connect(push_tweet_to_cache, sender=Tweet)
\ No newline at end of file
+post_save.connect(push_tweet_to_cache, sender=Tweet)
+pre_delete.connect(invalidate_photo_urls_cache, sender=TweetPhoto)
+post_save.connect(invalidate_photo_urls_cache, sender=TweetPhoto)
\ No newline at end of file
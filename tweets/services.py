@@ -1,7 +1,17 @@
+from django.conf import settings
+from django.core.cache import caches
+from tweets.constants import TWEET_PHOTO_URLS_CACHE_TIMEOUT
 from tweets.models import Tweet, TweetPhoto
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import (
+    TWEET_PHOTO_URLS_PATTERN,
+    USER_TWEETS_PATTERN,
+    USER_TWEETS_SORTED_SET_PATTERN,
+)
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
 
+cache = caches['testing'] if settings.TESTING else caches['default']
+
 
 class TweetService:
 
@@ -18,6 +28,46 @@ class TweetService:
             photos.append(photo)
 
         TweetPhoto.objects.bulk_create(photos)
+        # bulk_create won't trigger post_save signal
+        cls.invalidate_photo_urls_cache(tweet.id)
+
+    @classmethod
+    def get_photo_urls_through_cache(cls, tweet_ids):
+        """
+        tweet_id => photo urls ordered by photo order, one get_many and one
+        tweet_id__in query for the cache misses
+        the urls are cached, so s3 only signs them once per cache timeout
+        """
+        keys = {
+            tweet_id: TWEET_PHOTO_URLS_PATTERN.format(tweet_id=tweet_id)
+            for tweet_id in tweet_ids
+        }
+        cached = cache.get_many(list(keys.values()))
+        photo_urls = {
+            tweet_id: cached[key]
+            for tweet_id, key in keys.items()
+            if key in cached
+        }
+
+        missing_tweet_ids = [tweet_id for tweet_id in keys if tweet_id not in photo_urls]
+        if missing_tweet_ids:
+            loaded = {tweet_id: [] for tweet_id in missing_tweet_ids}
+            photos = TweetPhoto.objects.filter(
+                tweet_id__in=missing_tweet_ids,
+            ).order_by('tweet_id', 'order')
+            for photo in photos:
+                loaded[photo.tweet_id].append(photo.file.url)
+            cache.set_many(
+                {keys[tweet_id]: urls for tweet_id, urls in loaded.items()},
+                timeout=TWEET_PHOTO_URLS_CACHE_TIMEOUT,
+            )
+            photo_urls.update(loaded)
+
+        return photo_urls
+
+    @classmethod
+    def invalidate_photo_urls_cache(cls, tweet_id):
+        cache.delete(TWEET_PHOTO_URLS_PATTERN.format(tweet_id=tweet_id))
 
     @classmethod
     def get_cached_tweets(cls, user_id):
@@ -26,9 +76,47 @@ class TweetService:
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
         return RedisHelper.load_objects(key, queryset)
 
+    @classmethod
+    def get_recent_cached_tweets(cls, user_id, count):
+        # only the newest count tweets are read from redis and deserialized
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        if cls.is_sorted_set_cache():
+            key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user_id)
+            tweet_ids, total = RedisHelper.load_ids_by_score(key, queryset, count=count)
+            return MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        page = RedisHelper.load_page(key, queryset, 'first', count=count)
+        if page is None:
+            return list(queryset[:count])
+        return page[0]
+
+    @classmethod
+    def is_sorted_set_cache(cls):
+        return settings.REDIS_TIMELINE_CACHE_TYPES['tweets'] == 'sorted_set'
+
+    @classmethod
+    def paginate_cached_tweets(cls, user_id, paginator, request):
+        # only the requested page is read from redis, None if it is not cached
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        if cls.is_sorted_set_cache():
+            key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user_id)
+            tweet_ids = paginator.paginate_cached_sorted_set(key, queryset, request)
+            if tweet_ids is None:
+                return None
+            return MemcachedHelper.get_objects_through_cache(Tweet, tweet_ids)
+
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return paginator.paginate_cached_list(key, queryset, request)
+
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         # lazy loading
         queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
+        if cls.is_sorted_set_cache():
+            key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=tweet.user_id)
+            RedisHelper.push_object_to_sorted_set(key, tweet, queryset)
+            return
+
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
         RedisHelper.push_object(key, tweet, queryset)
\ No newline at end of file
@@ -0,0 +1,104 @@
+from celery import shared_task
+from collections import defaultdict
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F
+from tweets.constants import (
+    COUNT_DELTAS_FLUSH_BATCH_SIZE,
+    COUNT_DELTAS_FLUSH_LOCK_TTL,
+    COUNT_FLUSH_BATCH_KEEP_DAYS,
+)
+from tweets.models import CountFlushBatch
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+from utils.time_helpers import utc_now
+
+import time
+import uuid
+
+COUNT_DELTAS_FLUSH_LOCK = 'count_deltas:flush_lock'
+# last flush lag of each count, in seconds
+COUNT_DELTAS_FLUSH_LAG = 'count_deltas:flush_lag'
+
+# only the owner of the lock extends or releases it, it may have expired
+# and been taken by another flush
+EXTEND_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def get_write_behind_counts():
+    # import here since there is a cycle import
+    from comments.models import Comment
+    from tweets.models import Tweet
+    return [
+        (Tweet, 'likes_count'),
+        (Tweet, 'comments_count'),
+        (Comment, 'likes_count'),
+    ]
+
+
+def flush_count_deltas(model_class, attr, lock_token=None):
+    deltas, since, flush_id = RedisHelper.pop_count_deltas(model_class, attr)
+    object_ids = sorted(deltas)
+    for index in range(0, len(object_ids), COUNT_DELTAS_FLUSH_BATCH_SIZE):
+        batch_ids = object_ids[index: index + COUNT_DELTAS_FLUSH_BATCH_SIZE]
+        # objects with the same delta are updated in one query
+        ids_by_delta = defaultdict(list)
+        for object_id in batch_ids:
+            if deltas[object_id]:
+                ids_by_delta[deltas[object_id]].append(object_id)
+        # the acked batches are gone from the flushing hash, a replayed
+        # flush rebuilds the same batch with the same first object id
+        batch_key = '{}.{}:{}:{}'.format(model_class.__name__, attr, flush_id, batch_ids[0])
+        RedisHelper.begin_count_flush(model_class, attr)
+        with transaction.atomic():
+            _, created = CountFlushBatch.objects.get_or_create(key=batch_key)
+            # created is False if the batch was written to db before a crash
+            if created:
+                for delta, ids in ids_by_delta.items():
+                    model_class.objects.filter(id__in=ids).update(**{attr: F(attr) + delta})
+        RedisHelper.ack_count_deltas(model_class, attr, batch_ids)
+        if lock_token is not None:
+            RedisHelper.run_script(
+                EXTEND_LOCK_SCRIPT,
+                keys=[COUNT_DELTAS_FLUSH_LOCK],
+                args=[lock_token, COUNT_DELTAS_FLUSH_LOCK_TTL],
+            )
+
+    lag = time.time() - since if since is not None else 0
+    return len(object_ids), lag
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_count_deltas_task():
+    conn = RedisClient.get_connection()
+    token = uuid.uuid4().hex
+    # two flushes running together would pop the same flushing hash
+    if not conn.set(COUNT_DELTAS_FLUSH_LOCK, token, nx=True, ex=COUNT_DELTAS_FLUSH_LOCK_TTL):
+        return 'another flush is running'
+
+    try:
+        messages = []
+        for model_class, attr in get_write_behind_counts():
+            count, lag = flush_count_deltas(model_class, attr, token)
+            name = '{}.{}'.format(model_class.__name__, attr)
+            conn.hset(COUNT_DELTAS_FLUSH_LAG, name, round(lag, 3))
+            messages.append('{}: {} objects, lag {:.1f}s'.format(name, count, lag))
+        CountFlushBatch.objects.filter(
+            created_at__lt=utc_now() - timedelta(days=COUNT_FLUSH_BATCH_KEEP_DAYS),
+        ).delete()
+    finally:
+        RedisHelper.run_script(RELEASE_LOCK_SCRIPT, keys=[COUNT_DELTAS_FLUSH_LOCK], args=[token])
+
+    return ', '.join(messages)
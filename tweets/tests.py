@@ -1,15 +1,19 @@
 from datetime import timedelta
 from django.contrib.auth.models import User
+from django.db.models import F
+from gatekeeper.models import GateKeeper
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
-from tweets.models import Tweet
+from tweets.models import CountFlushBatch, Tweet
 from tweets.models import TweetPhoto
 from tweets.services import TweetService
-from twitter.cache import USER_TWEETS_PATTERN
+from tweets.tasks import flush_count_deltas_task
+from twitter.cache import USER_TWEETS_PATTERN, USER_TWEETS_SORTED_SET_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 from utils.redis_serializers import DjangoModelSerializer
-from utils.time_helpers import utc_now
+from utils.time_helpers import datetime_to_microseconds, utc_now
 
 
 class TweetTests(TestCase):
@@ -43,6 +47,30 @@ class TweetTests(TestCase):
         self.assertEqual(photo.status, TweetPhotoStatus.PENDING)
         self.assertEqual(TweetPhoto.objects.count(), 1)
 
+    def test_photo_urls_through_cache(self):
+        tweet = self.create_tweet(self.user1)
+        TweetPhoto.objects.create(user=self.user1, tweet=tweet, file='b.jpeg', order=1)
+        TweetPhoto.objects.create(user=self.user1, tweet=tweet, file='a.jpeg', order=0)
+
+        # one query for all the tweets of a page
+        with self.assertNumQueries(1):
+            photo_urls = TweetService.get_photo_urls_through_cache([tweet.id, self.tweet.id])
+        self.assertEqual(len(photo_urls[tweet.id]), 2)
+        self.assertEqual(photo_urls[tweet.id][0].endswith('a.jpeg'), True)
+        self.assertEqual(photo_urls[self.tweet.id], [])
+
+        # cached
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                TweetService.get_photo_urls_through_cache([tweet.id, self.tweet.id]),
+                photo_urls,
+            )
+
+        # invalidated when the photos change
+        TweetPhoto.objects.create(user=self.user1, tweet=self.tweet, file='c.jpeg')
+        photo_urls = TweetService.get_photo_urls_through_cache([self.tweet.id])
+        self.assertEqual(len(photo_urls[self.tweet.id]), 1)
+
     def test_cached_tweet_in_redis(self):
         tweet = self.create_tweet(self.user1)
         conn = RedisClient.get_connection()
@@ -88,4 +116,109 @@ class TweetTests(TestCase):
         # username updated
         user.username = 'new_username'
         user.save()
-        self.assertEqual(tweets[0].user.username, 'new_username')
\ No newline at end of file
+        self.assertEqual(tweets[0].user.username, 'new_username')
+
+    def test_cached_tweet_sorted_set_in_redis(self):
+        user = self.create_user('user1')
+        RedisClient.clear()
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_SORTED_SET_PATTERN.format(user_id=user.id)
+
+        with self.settings(REDIS_TIMELINE_CACHE_TYPES={
+            'tweets': 'sorted_set',
+            'newsfeeds': 'list',
+        }):
+            tweet_ids = [
+                self.create_tweet(user, 'tweet {}'.format(i)).id
+                for i in range(3)
+            ][::-1]
+            queryset = Tweet.objects.filter(user_id=user.id).order_by('-created_at')
+
+            # cache miss
+            conn.delete(key)
+            ids, total = RedisHelper.load_ids_by_score(key, queryset)
+            self.assertEqual(ids, tweet_ids)
+            self.assertEqual(total, 3)
+
+            # cache hit, only ids older than the cursor
+            tweet = Tweet.objects.get(id=tweet_ids[0])
+            ids, total = RedisHelper.load_ids_by_score(
+                key,
+                queryset,
+                max_score='({}'.format(datetime_to_microseconds(tweet.created_at)),
+                count=1,
+            )
+            self.assertEqual(ids, [tweet_ids[1]])
+
+            # an older tweet is inserted by created_at, not at the head
+            old_tweet = self.create_tweet(user, 'old tweet')
+            old_tweet.created_at = utc_now() - timedelta(days=1)
+            old_tweet.save()
+            conn.zrem(key, old_tweet.id)
+            RedisHelper.push_object_to_sorted_set(key, old_tweet, queryset)
+            ids, total = RedisHelper.load_ids_by_score(key, queryset)
+            self.assertEqual(ids, tweet_ids + [old_tweet.id])
+
+            # the list api reads the page from the sorted set
+            response = APIClient().get('/api/tweets/', {'user_id': user.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [tweet['id'] for tweet in response.data['results']],
+                tweet_ids + [old_tweet.id],
+            )
+            self.assertEqual(response.data['has_next_page'], False)
+
+    def test_write_behind_counts(self):
+        GateKeeper.set('switch_count_write_behind', 'percent', 100)
+        tweet = self.create_tweet(self.user1)
+        self.create_like(self.user1, tweet)
+        self.create_like(self.user2, tweet)
+        self.create_comment(self.user2, tweet)
+
+        # only the redis counts and deltas are updated
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (0, 0))
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_pending_count_delta(tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_count_flush_lag(Tweet, 'likes_count') >= 0, True)
+
+        # an expired count is reloaded with the pending deltas
+        conn = RedisClient.get_connection()
+        conn.delete(RedisHelper.get_count_key(tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+
+        flush_count_deltas_task()
+        tweet.refresh_from_db()
+        self.assertEqual((tweet.likes_count, tweet.comments_count), (2, 1))
+        self.assertEqual(RedisHelper.get_pending_count_delta(tweet, 'likes_count'), 0)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+
+        # deltas left by a crashed flush are written before the new ones
+        self.create_like(self.user2, self.tweet)
+        RedisHelper.pop_count_deltas(Tweet, 'likes_count')
+        self.create_like(self.user1, self.tweet)
+        flush_count_deltas_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        flush_count_deltas_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+
+        # a flush that died after its db commit, before the ack, is replayed
+        # without writing the deltas twice
+        self.create_like(self.create_user('user3'), tweet)
+        deltas, since, flush_id = RedisHelper.pop_count_deltas(Tweet, 'likes_count')
+        CountFlushBatch.objects.create(key='Tweet.likes_count:{}:{}'.format(flush_id, tweet.id))
+        Tweet.objects.filter(id=tweet.id).update(likes_count=F('likes_count') + 1)
+        flush_count_deltas_task()
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 3)
+        self.assertEqual(RedisHelper.get_pending_count_delta(tweet, 'likes_count'), 0)
+
+        # a count read while a flush writes to db is not cached
+        count_key = RedisHelper.get_count_key(tweet, 'likes_count')
+        conn.delete(count_key)
+        RedisHelper.begin_count_flush(Tweet, 'likes_count')
+        self.assertEqual(RedisHelper.read_count(tweet, 'likes_count'), None)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 3)
+        self.assertEqual(conn.exists(count_key), False)
@@ -1,7 +1,17 @@
 # memcached
 FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
+TWEET_PHOTO_URLS_PATTERN = 'tweet_photo_urls:{tweet_id}'
 
 # redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# set of '{content_type_id}:{object_id}' liked by the user
+USER_LIKES_PATTERN = 'user_likes:{user_id}'
+# ids scored by created_at, used when the timeline is cached as a sorted set
+USER_TWEETS_SORTED_SET_PATTERN = 'user_tweets_zset:{user_id}'
+USER_NEWSFEEDS_SORTED_SET_PATTERN = 'user_newsfeeds_zset:{user_id}'
+# ids of the authors whose tweets are pulled instead of fanned out
+NEWSFEED_PULL_AUTHORS_KEY = 'newsfeed_pull_authors'
+# seconds per follower of the recent fanout batches, newest first
+FANOUT_BATCH_LATENCY_KEY = 'fanout_batch_latency'
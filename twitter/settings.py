@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
 from pathlib import Path
+from celery.schedules import crontab
 from kombu import Queue
 import sys
 
@@ -70,6 +71,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "debug_toolbar.middleware.DebugToolbarMiddleware",
+    'utils.middlewares.RequestCacheMiddleware',
 ]
 
 ROOT_URLCONF = 'twitter.urls'
@@ -109,6 +111,11 @@ DATABASES = {
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+# size it to the number of threads of a gunicorn / celery worker process
+HBASE_POOL_SIZE = 10
+HBASE_POOL_TIMEOUT = 3  # seconds to wait for a free connection in the pool
+HBASE_CONNECTION_TIMEOUT = 5000  # thrift socket timeout in milliseconds
+HBASE_POOL_HEALTH_CHECK_INTERVAL = 60  # ping connections idle longer than this
 
 
 # Password validation
@@ -186,6 +193,11 @@ CACHES = {
     },
 }
 
+# in-process cache in front of memcached, see utils.local_cache
+# the request cache is always on, the process cache is off when max size is 0
+LOCAL_CACHE_PROCESS_MAX_SIZE = 0
+LOCAL_CACHE_PROCESS_TTL = 5  # in seconds
+
 # redis install: sudo apt-get install redis
 # pip install redis
 REDIS_HOST = '127.0.0.1'
@@ -193,16 +205,54 @@ REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 200 if not TESTING else 20 # set limited cached size in redis to save space
+# users with more likes are not cached in redis, has_liked reads the DB
+REDIS_LIKED_SET_LIMIT = 10000 if not TESTING else 3
+
+# single flight cache fill, only the lease holder reloads a missing key
+CACHE_FILL_LEASE_MS = 3000
+CACHE_FILL_WAIT_TIME = 1  # in seconds, then load from DB without waiting
+CACHE_FILL_POLL_INTERVAL = 0.02  # in seconds
+# a count is only cached if no write behind flush ran while it was read
+COUNT_LOAD_RETRIES = 3
+COUNT_LOAD_RETRY_INTERVAL = 0.01  # in seconds
+# a flush that died while writing a batch to db stops blocking the count
+# loads after this
+COUNT_FLUSH_MARKER_TTL = 60  # in seconds
+# how each timeline is cached in redis
+# 'list': serialized objects in a list, newest first
+# 'sorted_set': ids scored by created_at, objects are loaded through memcached
+REDIS_TIMELINE_CACHE_TYPES = {
+    'tweets': 'list',
+    'newsfeeds': 'list',
+}
 
 # celery settings
 # to run celery worker => celery -A twitter worker -l INFO
 CELERY_BROKER_URL = "redis://127.0.0.1:6379/2" if TESTING else "redis://127.0.0.1:6379/0"
 CELERY_TIMEZONE = 'UTC'
 CELERY_TASK_ALWAYS_EAGER = TESTING # if true, celery will run synchronously
+# fanouts are routed by the follower count of the author, run dedicated
+# workers for the small ones so they are not queued behind a big fanout:
+# celery -A twitter worker -Q newsfeeds -l INFO
+# celery -A twitter worker -Q newsfeeds_large,newsfeeds -l INFO
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
-    Queue('newsfeeds', routing_key='newsfeeds')
+    Queue('newsfeeds', routing_key='newsfeeds'),
+    Queue('newsfeeds_large', routing_key='newsfeeds_large'),
 )
+# to run celery beat => celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    # recount hbase follower/following counters every night
+    'reconcile-friendship-counts': {
+        'task': 'friendships.tasks.reconcile_friendship_counts_main_task',
+        'schedule': crontab(hour=4, minute=0),
+    },
+    # write the likes/comments count deltas of switch_count_write_behind to db
+    'flush-count-deltas': {
+        'task': 'tweets.tasks.flush_count_deltas_task',
+        'schedule': 10.0,
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from contextvars import ContextVar
+from django.conf import settings
+
+import threading
+import time
+
+# RequestCache of the current request, None outside of a request
+_current_request_cache = ContextVar('request_cache', default=None)
+
+
+class RequestCache:
+    """
+    in-process dict cache, only lives for one request (see
+    utils.middlewares.RequestCacheMiddleware), so the same object is not
+    fetched from memcached twice in a response
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def activate(cls):
+        return _current_request_cache.set(cls())
+
+    @classmethod
+    def deactivate(cls, token):
+        _current_request_cache.reset(token)
+
+    @classmethod
+    def get_current(cls):
+        return _current_request_cache.get()
+
+
+class ProcessCache:
+    """
+    small LRU shared by all the requests of the process, objects can be up to
+    LOCAL_CACHE_PROCESS_TTL seconds stale since other processes can not
+    invalidate it, disabled when LOCAL_CACHE_PROCESS_MAX_SIZE is 0
+    """
+    # key => (expire_at, value), least recently used first
+    objects = OrderedDict()
+    lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def get(cls, key):
+        if not settings.LOCAL_CACHE_PROCESS_MAX_SIZE:
+            return None
+        with cls.lock:
+            item = cls.objects.get(key)
+            if item is None or item[0] < time.time():
+                cls.misses += 1
+                return None
+            cls.objects.move_to_end(key)
+            cls.hits += 1
+            return item[1]
+
+    @classmethod
+    def set(cls, key, value):
+        if not settings.LOCAL_CACHE_PROCESS_MAX_SIZE:
+            return
+        with cls.lock:
+            cls.objects[key] = (time.time() + settings.LOCAL_CACHE_PROCESS_TTL, value)
+            cls.objects.move_to_end(key)
+            while len(cls.objects) > settings.LOCAL_CACHE_PROCESS_MAX_SIZE:
+                cls.objects.popitem(last=False)
+
+    @classmethod
+    def delete(cls, key):
+        with cls.lock:
+            cls.objects.pop(key, None)
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.objects.clear()
+
+
+class LocalCache:
+    # request cache first, then the process cache
+
+    @classmethod
+    def get(cls, key):
+        request_cache = RequestCache.get_current()
+        if request_cache is not None:
+            if key in request_cache.objects:
+                request_cache.hits += 1
+                return request_cache.objects[key]
+            request_cache.misses += 1
+
+        value = ProcessCache.get(key)
+        if value is not None and request_cache is not None:
+            request_cache.objects[key] = value
+        return value
+
+    @classmethod
+    def get_many(cls, keys):
+        # key => value of the cached keys only
+        values = {}
+        for key in keys:
+            value = cls.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    @classmethod
+    def set(cls, key, value):
+        request_cache = RequestCache.get_current()
+        if request_cache is not None:
+            request_cache.objects[key] = value
+        ProcessCache.set(key, value)
+
+    @classmethod
+    def set_many(cls, data):
+        for key, value in data.items():
+            cls.set(key, value)
+
+    @classmethod
+    def delete(cls, key):
+        request_cache = RequestCache.get_current()
+        if request_cache is not None:
+            request_cache.objects.pop(key, None)
+        ProcessCache.delete(key)
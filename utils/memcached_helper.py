@@ -1,5 +1,7 @@
 from django.conf import settings
 from django.core.cache import caches
+from utils.local_cache import LocalCache
+from utils.single_flight import SingleFlight
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -8,21 +10,87 @@ class MemcachedHelper:
 
     @classmethod
     def get_key(cls, model_class, object_id):
-        # model_class.__class__.__name__ to get class name, Tweet =>'Tweet', User=>'User'
-        return '{}:{}'.format(model_class.__class__.__name__, object_id)
+        # model_class.__name__ to get class name, Tweet =>'Tweet', User=>'User'
+        # (model_class.__class__.__name__ is 'ModelBase' for every model)
+        return '{}:{}'.format(model_class.__name__, object_id)
 
     @classmethod
     def get_object_through_cache(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        obj = cache.get(key) # cache hit
+        # fetched before in the same request
+        obj = LocalCache.get(key)
         if obj is not None:
             return obj
 
-        obj = model_class.objects.get(id=object_id) # cache miss
-        cache.set(key, obj)
+        obj = cache.get(key) # cache hit
+        if obj is None:
+            # cache miss, only one worker loads the object from DB
+            obj = SingleFlight.get_or_fill(
+                key,
+                lambda: cache.get(key),
+                lambda: cls._load_object_to_cache(model_class, object_id),
+            )
+        LocalCache.set(key, obj)
+        return obj
+
+    @classmethod
+    def _load_object_to_cache(cls, model_class, object_id):
+        obj = model_class.objects.get(id=object_id)
+        cache.set(cls.get_key(model_class, object_id), obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        one get_many, one id__in query for the cache misses and one set_many
+        same order as object_ids, deleted objects are skipped
+        """
+        keys = {
+            object_id: cls.get_key(model_class, object_id)
+            for object_id in object_ids
+            if object_id is not None
+        }
+        cached = LocalCache.get_many(keys.values())
+        missing_keys = [key for key in keys.values() if key not in cached]
+        if missing_keys:
+            memcached = cache.get_many(missing_keys)
+            LocalCache.set_many(memcached)
+            cached.update(memcached)
+        id_to_object = {
+            object_id: cached[key]
+            for object_id, key in keys.items()
+            if key in cached
+        }
+
+        missing_ids = [object_id for object_id in keys if object_id not in id_to_object]
+        if missing_ids:
+            loaded = {obj.id: obj for obj in model_class.objects.filter(id__in=missing_ids)}
+            loaded_objects = {keys[object_id]: obj for object_id, obj in loaded.items()}
+            cache.set_many(loaded_objects)
+            LocalCache.set_many(loaded_objects)
+            id_to_object.update(loaded)
+
+        return [
+            id_to_object[object_id]
+            for object_id in object_ids
+            if object_id in id_to_object
+        ]
+
+    @classmethod
+    def prefetch_objects(cls, instances, model_class, id_attr, cache_attr):
+        # instance.<cache_attr> = model_class object of instance.<id_attr>,
+        # loaded for all the instances in one batch
+        objects = cls.get_objects_through_cache(
+            model_class,
+            [getattr(instance, id_attr) for instance in instances],
+        )
+        id_to_object = {obj.id: obj for obj in objects}
+        for instance in instances:
+            setattr(instance, cache_attr, id_to_object.get(getattr(instance, id_attr)))
+        return objects
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
+        LocalCache.delete(key)
\ No newline at end of file
@@ -0,0 +1,22 @@
+from django.conf import settings
+from utils.local_cache import RequestCache
+
+
+class RequestCacheMiddleware:
+    # objects fetched through MemcachedHelper / UserService are kept in memory
+    # until the end of the request
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = RequestCache.activate()
+        try:
+            response = self.get_response(request)
+            if settings.DEBUG:
+                request_cache = RequestCache.get_current()
+                response['X-Request-Cache-Hits'] = request_cache.hits
+                response['X-Request-Cache-Misses'] = request_cache.misses
+            return response
+        finally:
+            RequestCache.deactivate(token)
@@ -2,6 +2,8 @@ from dateutil import parser
 from django.conf import settings
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_microseconds
 
 
 # /api/tweets/?user_id=1&created_at__lt=...
@@ -65,6 +67,74 @@ class EndlessPagination(BasePagination):
         # which means maybe there is some data in DB.
         return None
 
+    def paginate_cached_list(self, key, queryset, request):
+        """
+        same result as paginated_cached_list_in_redis, but the page is located
+        on the created_at scores and only its objects are fetched from redis
+        and deserialized, in one script so a concurrent push can't shift it
+        """
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            page = RedisHelper.load_page(
+                key,
+                queryset,
+                'gt',
+                cursor=datetime_to_microseconds(created_at__gt),
+            )
+            self.has_next_page = False
+            return page[0] if page is not None else None
+
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+            page = RedisHelper.load_page(
+                key,
+                queryset,
+                'lt',
+                cursor=datetime_to_microseconds(created_at__lt),
+                count=self.page_size,
+            )
+        else:
+            page = RedisHelper.load_page(key, queryset, 'first', count=self.page_size)
+        if page is None:
+            return None
+
+        objects, length, start = page
+        self.has_next_page = length > start + self.page_size
+        # if length == settings.REDIS_LIST_LENGTH_LIMIT, the rest of the page
+        # may only be in DB
+        if not self.has_next_page and length >= settings.REDIS_LIST_LENGTH_LIMIT:
+            return None
+        return objects
+
+    def paginate_cached_sorted_set(self, key, queryset, request):
+        # ids of the page from a sorted set scored by created_at, None if the
+        # page is not complete in redis
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
+            ids, total = RedisHelper.load_ids_by_score(
+                key,
+                queryset,
+                min_score='({}'.format(datetime_to_microseconds(created_at__gt)),
+            )
+            self.has_next_page = False
+            return ids
+
+        max_score = '+inf'
+        if 'created_at__lt' in request.query_params:
+            created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+            max_score = '({}'.format(datetime_to_microseconds(created_at__lt))
+        # one more to check if there is a next page
+        ids, total = RedisHelper.load_ids_by_score(
+            key,
+            queryset,
+            max_score=max_score,
+            count=self.page_size + 1,
+        )
+        self.has_next_page = len(ids) > self.page_size
+        if not self.has_next_page and total >= settings.REDIS_LIST_LENGTH_LIMIT:
+            return None
+        return ids[:self.page_size]
+
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
@@ -1,87 +1,546 @@
 from django.conf import settings
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
+from utils.redis_serializers import DjangoModelSerializer, StaleSerializedDataError
+from utils.single_flight import SingleFlight
+from utils.time_helpers import datetime_to_microseconds
+
+import time
+
+# check-then-act sequences run as lua scripts, atomic and in one round trip
+# KEYS: list, scores list | ARGV: serialized object, score, last index to keep
+# an object already in the list (same score and same data) is not pushed
+# again, so a retried push is safe
+PUSH_OBJECT_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+local scores = redis.call('lrange', KEYS[2], 0, -1)
+for index, score in ipairs(scores) do
+    if score == ARGV[2] and redis.call('lindex', KEYS[1], index - 1) == ARGV[1] then
+        return 1
+    end
+end
+redis.call('lpush', KEYS[1], ARGV[1])
+redis.call('lpush', KEYS[2], ARGV[2])
+redis.call('ltrim', KEYS[1], 0, ARGV[3])
+redis.call('ltrim', KEYS[2], 0, ARGV[3])
+return 1
+"""
+# KEYS: list, scores list | ARGV: 'gt', 'lt' or 'first', cursor score, count
+# locates the page on the scores and reads it in the same script, a push in
+# between can't shift the indexes. returns {list length, start, objects},
+# false if the list (or its scores) is not cached
+LOAD_PAGE_SCRIPT = """
+local length = redis.call('llen', KEYS[1])
+if length == 0 or redis.call('llen', KEYS[2]) ~= length then
+    return false
+end
+local cursor = tonumber(ARGV[2])
+-- scores are newest first, binary search of the first index whose score is
+-- not above the cursor (or below it if strict), with LINDEX probes
+local function first_index(strict)
+    local low = 0
+    local high = length
+    while low < high do
+        local mid = math.floor((low + high) / 2)
+        local score = tonumber(redis.call('lindex', KEYS[2], mid))
+        if score < cursor or (not strict and score == cursor) then
+            high = mid
+        else
+            low = mid + 1
+        end
+    end
+    return low
+end
+local start = 0
+local stop = 0
+if ARGV[1] == 'gt' then
+    -- every object newer than the cursor, at the head of the list
+    stop = first_index(false)
+else
+    if ARGV[1] == 'lt' then
+        start = first_index(true)
+    end
+    stop = math.min(start + tonumber(ARGV[3]), length)
+end
+if start >= stop then
+    return {length, start, {}}
+end
+return {length, start, redis.call('lrange', KEYS[1], start, stop - 1)}
+"""
+# KEYS: sorted set | ARGV: score, member, number of members to keep
+PUSH_TO_SORTED_SET_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[1], ARGV[2])
+redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+return 1
+"""
+# KEYS: counter | ARGV: delta, nil if the counter is not cached
+INCRBY_IF_EXISTS_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('incrby', KEYS[1], ARGV[1])
+end
+return false
+"""
+# KEYS: deltas, flushing deltas, since, flushing since, flush sequence,
+# flushing id
+# a flushing hash left by a crashed flush is returned again (with the same
+# flush id) before new deltas
+POP_COUNT_DELTAS_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 0 and redis.call('exists', KEYS[1]) == 1 then
+    redis.call('rename', KEYS[1], KEYS[2])
+    if redis.call('exists', KEYS[3]) == 1 then
+        redis.call('rename', KEYS[3], KEYS[4])
+    end
+    redis.call('set', KEYS[6], redis.call('incr', KEYS[5]))
+end
+return {
+    redis.call('hgetall', KEYS[2]),
+    redis.call('get', KEYS[4]) or '',
+    redis.call('get', KEYS[6]) or '',
+}
+"""
+# KEYS: flushing deltas, flushing since, flushing id, generation, flush marker
+# ARGV: object ids written to db
+ACK_COUNT_DELTAS_SCRIPT = """
+redis.call('hdel', KEYS[1], unpack(ARGV))
+if redis.call('hlen', KEYS[1]) == 0 then
+    redis.call('del', KEYS[2], KEYS[3])
+end
+redis.call('incr', KEYS[4])
+redis.call('del', KEYS[5])
+return 1
+"""
 
 
 class RedisHelper:
+    # lua script => redis Script, the sha1 is only computed once
+    _scripts = {}
+
+    @classmethod
+    def get_script(cls, script):
+        if script not in cls._scripts:
+            cls._scripts[script] = RedisClient.get_connection().register_script(script)
+        return cls._scripts[script]
+
+    @classmethod
+    def run_script(cls, script, keys, args):
+        conn = RedisClient.get_connection()
+        # EVALSHA, falls back to EVAL (and caches the script) on NOSCRIPT
+        return cls.get_script(script)(keys=keys, args=args, client=conn)
+
+    @classmethod
+    def get_scores_key(cls, key):
+        # created_at (in microseconds) of every object in the cached list, same
+        # order, so a page can be located without deserializing the objects
+        return '{}:scores'.format(key)
 
     @classmethod
     def _load_objects_to_cache(cls, key, queryset):
         conn = RedisClient.get_connection()
-        serialized_list = []
         # redis only save up to REDIS_LIST_LENGTH_LIMIT data
-        for obj in queryset[:settings.REDIS_LIST_LENGTH_LIMIT]:
-            serialized_data = DjangoModelSerializer.serialize(obj)
-            serialized_list.append(serialized_data)
+        objects = list(queryset[:settings.REDIS_LIST_LENGTH_LIMIT])
+        serialized_list = [DjangoModelSerializer.serialize(obj) for obj in objects]
+        scores = [datetime_to_microseconds(obj.created_at) for obj in objects]
 
         if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            scores_key = cls.get_scores_key(key)
+            # MULTI/EXEC, the list and its scores are always updated together
+            pipeline = conn.pipeline()
+            pipeline.delete(key, scores_key)
+            pipeline.rpush(key, *serialized_list)
+            pipeline.rpush(scores_key, *scores)
+            pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.expire(scores_key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.execute()
+        return scores
 
     @classmethod
-    def load_objects(cls, key, queryset):
+    def _get_cached_objects(cls, key):
+        # None if not cached
         conn = RedisClient.get_connection()
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
+        # lists are never empty in redis, no need to check exists first
+        serialized_list = conn.lrange(key, 0, -1)
+        if not serialized_list:
+            return None
+        try:
+            return [
+                DjangoModelSerializer.deserialize(serialized_data)
+                for serialized_data in serialized_list
+            ]
+        except StaleSerializedDataError:
+            # cached before a model change, reload it from DB
+            conn.delete(key)
+            return None
+
+    @classmethod
+    def load_objects(cls, key, queryset):
+        objects = cls._get_cached_objects(key)
+        if objects is not None:
             return objects
 
-        cls._load_objects_to_cache(key, queryset)
+        def fill():
+            cls._load_objects_to_cache(key, queryset)
+            return list(queryset)
 
-        return list(queryset)
+        # only one worker reloads the key, the others wait for it
+        return SingleFlight.get_or_fill(key, lambda: cls._get_cached_objects(key), fill)
 
     @classmethod
-    def push_object(cls, key, obj, queryset):
+    def _get_cached_scores(cls, key):
+        # None if not cached, or cached before the scores were kept along the list
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.lrange(cls.get_scores_key(key), 0, -1)
+        pipeline.llen(key)
+        scores, length = pipeline.execute()
+        if scores and len(scores) == length:
+            return [int(score) for score in scores]
+        return None
+
+    @classmethod
+    def load_scores(cls, key, queryset):
+        # created_at of the cached objects, in list order (newest first)
+        scores = cls._get_cached_scores(key)
+        if scores is not None:
+            return scores
+
+        return SingleFlight.get_or_fill(
+            key,
+            lambda: cls._get_cached_scores(key),
+            lambda: cls._load_objects_to_cache(key, queryset),
+        )
+
+    @classmethod
+    def load_objects_range(cls, key, start, stop):
+        # only deserialize cached_list[start:stop], None if it can't be used
+        if start >= stop:
+            return []
         conn = RedisClient.get_connection()
-        if not conn.exists(key):
+        serialized_list = conn.lrange(key, start, stop - 1)
+        try:
+            return [
+                DjangoModelSerializer.deserialize(serialized_data)
+                for serialized_data in serialized_list
+            ]
+        except StaleSerializedDataError:
+            conn.delete(key, cls.get_scores_key(key))
+            return None
+
+    @classmethod
+    def load_page(cls, key, queryset, mode, cursor=0, count=0):
+        """
+        the objects of a page of the cached list, located and read atomically
+        - mode 'gt': all the objects newer than cursor (in microseconds)
+        - mode 'lt': count objects older than cursor
+        - mode 'first': the first count objects
+        returns (objects, list length, start index), None if the cached data
+        can't be used
+        """
+        def get_cached():
+            return cls.run_script(
+                LOAD_PAGE_SCRIPT,
+                keys=[key, cls.get_scores_key(key)],
+                args=[mode, cursor, count],
+            )
+
+        def fill():
             cls._load_objects_to_cache(key, queryset)
-            return
+            # nothing is cached for an empty queryset
+            return get_cached() or [0, 0, []]
+
+        page = get_cached()
+        if page is None:
+            page = SingleFlight.get_or_fill(key, get_cached, fill)
+        length, start, serialized_list = page
+        try:
+            objects = [
+                DjangoModelSerializer.deserialize(serialized_data)
+                for serialized_data in serialized_list
+            ]
+        except StaleSerializedDataError:
+            RedisClient.get_connection().delete(key, cls.get_scores_key(key))
+            return None
+        return objects, length, start
 
-        serialized_data = DjangoModelSerializer.serialize(obj)
-        conn.lpush(key, serialized_data)
+    @classmethod
+    def push_object(cls, key, obj, queryset):
         # ensure redis only has up to settings.REDIS_LIST_LENGTH_LIMIT data
-        conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        pushed = cls.run_script(
+            PUSH_OBJECT_SCRIPT,
+            keys=[key, cls.get_scores_key(key)],
+            args=[
+                DjangoModelSerializer.serialize(obj),
+                datetime_to_microseconds(obj.created_at),
+                settings.REDIS_LIST_LENGTH_LIMIT - 1,
+            ],
+        )
+        if not pushed:
+            cls._load_objects_to_cache(key, queryset)
+
+    @classmethod
+    def _load_ids_to_sorted_set(cls, key, queryset):
+        conn = RedisClient.get_connection()
+        # member => id, score => created_at in microseconds
+        mapping = {
+            obj_id: datetime_to_microseconds(created_at)
+            for obj_id, created_at in queryset.values_list(
+                'id',
+                'created_at',
+            )[:settings.REDIS_LIST_LENGTH_LIMIT]
+        }
+        if mapping:
+            pipeline = conn.pipeline()
+            pipeline.delete(key)
+            pipeline.zadd(key, mapping)
+            pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.execute()
+
+    @classmethod
+    def load_ids_by_score(cls, key, queryset, max_score='+inf', min_score='-inf', count=None):
+        """
+        ZREVRANGEBYSCORE key max_score min_score LIMIT 0 count
+        returns (ids newest first, number of ids in the sorted set)
+        """
+        def get_cached():
+            conn = RedisClient.get_connection()
+            start = 0 if count is not None else None
+            pipeline = conn.pipeline(transaction=False)
+            pipeline.zrevrangebyscore(key, max_score, min_score, start=start, num=count)
+            pipeline.zcard(key)
+            ids, total = pipeline.execute()
+            # sorted sets are never empty in redis, 0 means not cached
+            if not total:
+                return None
+            return [int(obj_id) for obj_id in ids], total
+
+        def fill():
+            cls._load_ids_to_sorted_set(key, queryset)
+            return get_cached() or ([], 0)
+
+        cached = get_cached()
+        if cached is not None:
+            return cached
+        return SingleFlight.get_or_fill(key, get_cached, fill)
+
+    @classmethod
+    def push_object_to_sorted_set(cls, key, obj, queryset):
+        # inserted by created_at, a late fanout does not jump to the head
+        # only the newest settings.REDIS_LIST_LENGTH_LIMIT ids are kept
+        pushed = cls.run_script(
+            PUSH_TO_SORTED_SET_SCRIPT,
+            keys=[key],
+            args=[
+                datetime_to_microseconds(obj.created_at),
+                obj.id,
+                settings.REDIS_LIST_LENGTH_LIMIT,
+            ],
+        )
+        if not pushed:
+            cls._load_ids_to_sorted_set(key, queryset)
+
+    @classmethod
+    def push_objects(cls, key_object_pairs):
+        """
+        push_object for many (key, obj) in one pipeline, the lists that are
+        not cached are skipped instead of loaded from DB (the objects are
+        already in DB, they will be read with the rest of the list)
+        returns the number of lists updated
+        """
+        conn = RedisClient.get_connection()
+        script = cls.get_script(PUSH_OBJECT_SCRIPT)
+        pipeline = conn.pipeline(transaction=False)
+        # the same object pushed to many lists is serialized once
+        serialized_hash = {}
+        for key, obj in key_object_pairs:
+            if id(obj) not in serialized_hash:
+                serialized_hash[id(obj)] = DjangoModelSerializer.serialize(obj)
+            script(
+                keys=[key, cls.get_scores_key(key)],
+                args=[
+                    serialized_hash[id(obj)],
+                    datetime_to_microseconds(obj.created_at),
+                    settings.REDIS_LIST_LENGTH_LIMIT - 1,
+                ],
+                client=pipeline,
+            )
+        return sum(pipeline.execute())
+
+    @classmethod
+    def push_objects_to_sorted_set(cls, key_object_pairs):
+        # same as push_objects, for timelines cached as sorted sets
+        conn = RedisClient.get_connection()
+        script = cls.get_script(PUSH_TO_SORTED_SET_SCRIPT)
+        pipeline = conn.pipeline(transaction=False)
+        for key, obj in key_object_pairs:
+            script(
+                keys=[key],
+                args=[
+                    datetime_to_microseconds(obj.created_at),
+                    obj.id,
+                    settings.REDIS_LIST_LENGTH_LIMIT,
+                ],
+                client=pipeline,
+            )
+        return sum(pipeline.execute())
 
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
     @classmethod
-    def incr_count(cls, obj, attr):
+    def read_count(cls, obj, attr):
+        """
+        (db count, pending delta) read while no flush wrote deltas to db,
+        None if flushes kept running
+        a flush moves a delta from the flushing hash to the db row between
+        begin_count_flush and ack_count_deltas, a read overlapping that would
+        miss the delta or count it twice
+        """
+        conn = RedisClient.get_connection()
+        key = cls.get_count_deltas_key(obj.__class__, attr)
+        state_keys = ['{}:generation'.format(key), '{}:flush_marker'.format(key)]
+        for _ in range(settings.COUNT_LOAD_RETRIES):
+            state = conn.mget(state_keys)
+            obj.refresh_from_db(fields=[attr])
+            pending = cls.get_pending_count_delta(obj, attr)
+            # no flush in progress, and none started or finished meanwhile
+            if state[1] is None and conn.mget(state_keys) == state:
+                return getattr(obj, attr), pending
+            time.sleep(settings.COUNT_LOAD_RETRY_INTERVAL)
+        return None
+
+    @classmethod
+    def _load_count_to_cache(cls, obj, attr):
         conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.incr(key) # increase count by 1 and return
+        # the db count is already updated by the listener, plus the deltas
+        # not flushed to db yet in write behind mode
+        counts = cls.read_count(obj, attr)
+        if counts is None:
+            # not cached, the next read tries again once the flush is done
+            obj.refresh_from_db(fields=[attr])
+            return getattr(obj, attr) + cls.get_pending_count_delta(obj, attr)
+        count = sum(counts)
+        # SET with EX, the key never exists without a ttl
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME)
+        return count
 
-        # refresh from db, don't need to add 1 before set key value
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr)) # getattr(obj, attr) => tweet.likes_count
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+    @classmethod
+    def incr_count(cls, obj, attr):
+        key = cls.get_count_key(obj, attr)
+        # INCR only if the key exists, otherwise a key expired right before
+        # the INCR would restart the count from 1
+        count = cls.run_script(INCRBY_IF_EXISTS_SCRIPT, keys=[key], args=[1])
+        if count is not None:
+            return count
+
+        return cls._load_count_to_cache(obj, attr)
 
     @classmethod
     def decr_count(cls, obj, attr):
-        conn = RedisClient.get_connection()
         key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return conn.decr(key)
+        count = cls.run_script(INCRBY_IF_EXISTS_SCRIPT, keys=[key], args=[-1])
+        if count is not None:
+            return count
 
-        # refresh from db, don't need to minus 1 before set key value
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))  # getattr(obj, attr) => tweet.likes_count
-        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-        return getattr(obj, attr)
+        return cls._load_count_to_cache(obj, attr)
 
     @classmethod
     def get_count(cls, obj, attr):
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        if conn.exists(key):
-            return int(conn.get(key)) # use int(), otherwise, return b'1'
+        count = conn.get(cls.get_count_key(obj, attr))
+        if count is not None:
+            return int(count) # use int(), otherwise, return b'1'
+
+        return cls._load_count_to_cache(obj, attr)
 
-        obj.refresh_from_db()
-        conn.set(key, getattr(obj, attr))
-        return getattr(obj, attr)
+    @classmethod
+    def get_count_deltas_key(cls, model_class, attr):
+        # object id => count changes not written to db yet (write behind mode)
+        return 'count_deltas:{}.{}'.format(model_class.__name__, attr)
+
+    @classmethod
+    def incr_count_delta(cls, model_class, object_id, attr, delta):
+        conn = RedisClient.get_connection()
+        key = cls.get_count_deltas_key(model_class, attr)
+        pipeline = conn.pipeline()
+        pipeline.hincrby(key, object_id, delta)
+        # when the oldest delta not flushed yet was added, for the flush lag
+        pipeline.set('{}:since'.format(key), time.time(), nx=True)
+        pipeline.execute()
+
+    @classmethod
+    def get_pending_count_delta(cls, obj, attr):
+        conn = RedisClient.get_connection()
+        key = cls.get_count_deltas_key(obj.__class__, attr)
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.hget(key, obj.id)
+        pipeline.hget('{}:flushing'.format(key), obj.id)
+        return sum(int(delta) for delta in pipeline.execute() if delta is not None)
+
+    @classmethod
+    def pop_count_deltas(cls, model_class, attr):
+        """
+        moves the deltas to a flushing hash, returns
+        ({object_id: delta}, when the oldest delta was added, flush id)
+        the flushing hash is only deleted by ack_count_deltas, once the deltas
+        are written to db, so a crashed flush loses nothing
+        """
+        key = cls.get_count_deltas_key(model_class, attr)
+        flat_deltas, since, flush_id = cls.run_script(
+            POP_COUNT_DELTAS_SCRIPT,
+            keys=[
+                key,
+                '{}:flushing'.format(key),
+                '{}:since'.format(key),
+                '{}:flushing:since'.format(key),
+                '{}:flush_seq'.format(key),
+                '{}:flushing:id'.format(key),
+            ],
+            args=[],
+        )
+        deltas = {
+            int(flat_deltas[index]): int(flat_deltas[index + 1])
+            for index in range(0, len(flat_deltas), 2)
+        }
+        return deltas, float(since) if since else None, int(flush_id) if flush_id else None
+
+    @classmethod
+    def begin_count_flush(cls, model_class, attr):
+        # count loads wait until ack_count_deltas, the marker expires if the
+        # flush dies in between
+        conn = RedisClient.get_connection()
+        key = cls.get_count_deltas_key(model_class, attr)
+        conn.set('{}:flush_marker'.format(key), 1, ex=settings.COUNT_FLUSH_MARKER_TTL)
+
+    @classmethod
+    def ack_count_deltas(cls, model_class, attr, object_ids):
+        key = cls.get_count_deltas_key(model_class, attr)
+        cls.run_script(
+            ACK_COUNT_DELTAS_SCRIPT,
+            keys=[
+                '{}:flushing'.format(key),
+                '{}:flushing:since'.format(key),
+                '{}:flushing:id'.format(key),
+                '{}:generation'.format(key),
+                '{}:flush_marker'.format(key),
+            ],
+            args=object_ids,
+        )
+
+    @classmethod
+    def get_count_flush_lag(cls, model_class, attr):
+        # seconds since the oldest delta not written to db was added
+        conn = RedisClient.get_connection()
+        key = cls.get_count_deltas_key(model_class, attr)
+        since_list = [
+            float(since)
+            for since in conn.mget('{}:flushing:since'.format(key), '{}:since'.format(key))
+            if since is not None
+        ]
+        if not since_list:
+            return 0
+        return time.time() - min(since_list)
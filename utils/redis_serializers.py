@@ -1,8 +1,18 @@
+from django.apps import apps
 from django.core import serializers
 from utils.json_encoder import JSONEncoder
 
+import msgpack
+import zlib
 
-class DjangoModelSerializer:
+
+class StaleSerializedDataError(Exception):
+    # the model fields changed since the object was cached
+    pass
+
+
+class JSONModelCodec:
+    # the original format, entries cached before the version byte start with '['
 
     @classmethod
     def serialize(cls, instance):
@@ -12,4 +22,72 @@ class DjangoModelSerializer:
     @classmethod
     def deserialize(cls, serialized_data):
         # to get original instance => [instance][0]
-        return list(serializers.deserialize('json', serialized_data))[0].object
\ No newline at end of file
+        return list(serializers.deserialize('json', serialized_data))[0].object
+
+
+class MsgpackModelCodec:
+    """
+    version byte + msgpack([model label, schema, [concrete field values]])
+    the values are passed positionally to Model(), no field by field to_python
+    """
+    version = b'\x01'
+    # model label => (model_class, schema)
+    _model_hash = {}
+
+    @classmethod
+    def get_schema(cls, model_class):
+        attnames = ','.join(field.attname for field in model_class._meta.concrete_fields)
+        return zlib.crc32(attnames.encode('utf-8'))
+
+    @classmethod
+    def get_model(cls, label):
+        if label not in cls._model_hash:
+            model_class = apps.get_model(label)
+            cls._model_hash[label] = (model_class, cls.get_schema(model_class))
+        return cls._model_hash[label]
+
+    @classmethod
+    def serialize(cls, instance):
+        label = instance._meta.label_lower
+        model_class, schema = cls.get_model(label)
+        values = [
+            getattr(instance, field.attname)
+            for field in model_class._meta.concrete_fields
+        ]
+        # datetime=True packs aware datetimes as msgpack timestamps
+        return cls.version + msgpack.packb([label, schema, values], datetime=True)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        # timestamp=3 unpacks msgpack timestamps to aware datetimes (UTC)
+        label, schema, values = msgpack.unpackb(serialized_data[1:], timestamp=3)
+        model_class, current_schema = cls.get_model(label)
+        if schema != current_schema:
+            raise StaleSerializedDataError(label)
+        return model_class(*values)
+
+
+class DjangoModelSerializer:
+    # first byte of the serialized data => codec
+    codecs = {
+        MsgpackModelCodec.version: MsgpackModelCodec,
+    }
+    # model class => codec used to serialize, MsgpackModelCodec by default
+    model_codecs = {}
+    default_codec = MsgpackModelCodec
+
+    @classmethod
+    def register(cls, model_class, codec):
+        cls.model_codecs[model_class] = codec
+
+    @classmethod
+    def serialize(cls, instance):
+        codec = cls.model_codecs.get(instance.__class__, cls.default_codec)
+        return codec.serialize(instance)
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        if isinstance(serialized_data, str):
+            serialized_data = serialized_data.encode('utf-8')
+        codec = cls.codecs.get(serialized_data[:1], JSONModelCodec)
+        return codec.deserialize(serialized_data)
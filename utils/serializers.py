@@ -0,0 +1,16 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    Meta.list_serializer_class of serializers with a prefetch(instances)
+    method, the related objects of a whole page are loaded in one batch
+    before any instance is serialized
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        self.child.prefetch(instances)
+        return super().to_representation(instances)
@@ -0,0 +1,70 @@
+from django.conf import settings
+from utils.redis_client import RedisClient
+
+import time
+import uuid
+
+# only delete the lease if it is still ours, it may have expired and been
+# taken by another worker
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    when a cached key is missing, only the worker holding the lease of the key
+    reloads it from DB, the others poll the cache until it is filled
+    """
+
+    @classmethod
+    def get_lease_key(cls, key):
+        return 'lease:{}'.format(key)
+
+    @classmethod
+    def acquire(cls, key):
+        conn = RedisClient.get_connection()
+        token = uuid.uuid4().hex
+        # SET NX PX, the lease expires by itself if the holder dies
+        if conn.set(cls.get_lease_key(key), token, nx=True, px=settings.CACHE_FILL_LEASE_MS):
+            return token
+        return None
+
+    @classmethod
+    def release(cls, key, token):
+        conn = RedisClient.get_connection()
+        conn.eval(RELEASE_LEASE_SCRIPT, 1, cls.get_lease_key(key), token)
+
+    @classmethod
+    def get_or_fill(cls, key, get_cached, fill):
+        """
+        get_cached() returns the cached value or None on a cache miss
+        fill() loads the value from DB to the cache and returns it
+        """
+        token = cls.acquire(key)
+        if token is not None:
+            try:
+                # filled by the previous lease holder after our cache miss
+                value = get_cached()
+                if value is not None:
+                    return value
+                return fill()
+            finally:
+                cls.release(key, token)
+
+        conn = RedisClient.get_connection()
+        deadline = time.time() + settings.CACHE_FILL_WAIT_TIME
+        while time.time() < deadline:
+            time.sleep(settings.CACHE_FILL_POLL_INTERVAL)
+            value = get_cached()
+            if value is not None:
+                return value
+            # lease released but nothing cached (e.g. empty queryset)
+            if not conn.exists(cls.get_lease_key(key)):
+                break
+
+        # the lease holder is too slow, don't wait any longer
+        return fill()
@@ -1,5 +1,13 @@
+from accounts.services import UserService
+from django.contrib.auth.models import User
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.local_cache import ProcessCache, RequestCache
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import DjangoModelSerializer, JSONModelCodec, MsgpackModelCodec
+from utils.single_flight import SingleFlight
 
 
 class UtilsTest(TestCase):
@@ -15,3 +23,138 @@ class UtilsTest(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('test_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_redis_serializers(self):
+        user = self.create_user('testuser')
+        tweet = self.create_tweet(user, 'serialized content')
+
+        serialized_data = DjangoModelSerializer.serialize(tweet)
+        self.assertEqual(serialized_data[:1], MsgpackModelCodec.version)
+        obj = DjangoModelSerializer.deserialize(serialized_data)
+        self.assertEqual(obj.id, tweet.id)
+        self.assertEqual(obj.user_id, user.id)
+        self.assertEqual(obj.content, 'serialized content')
+        self.assertEqual(obj.created_at, tweet.created_at)
+
+        # entries cached in json before the version byte are still readable
+        obj = DjangoModelSerializer.deserialize(JSONModelCodec.serialize(tweet).encode('utf-8'))
+        self.assertEqual(obj.id, tweet.id)
+        self.assertEqual(obj.created_at, tweet.created_at)
+
+    def test_redis_helper_counts(self):
+        user = self.create_user('testuser')
+        tweet = self.create_tweet(user)
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweet, 'likes_count')
+
+        # cache miss loads the db count, with a ttl
+        conn.delete(key)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 0)
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # cache hit only changes the cached count
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.decr_count(tweet, 'likes_count'), 1)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 1)
+
+        # an expired key is reloaded from db instead of restarting from 1
+        conn.delete(key)
+        Tweet.objects.filter(id=tweet.id).update(likes_count=5)
+        self.assertEqual(RedisHelper.incr_count(tweet, 'likes_count'), 5)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 5)
+
+    def test_single_flight(self):
+        fills = []
+
+        def fill():
+            fills.append(1)
+            return 'from db'
+
+        # lease holder fills the cache
+        self.assertEqual(SingleFlight.get_or_fill('key', lambda: None, fill), 'from db')
+        self.assertEqual(len(fills), 1)
+        # lease is released after the fill
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.exists(SingleFlight.get_lease_key('key')), False)
+
+        # another worker holds the lease, wait for the cache instead of filling
+        token = SingleFlight.acquire('key')
+        self.assertEqual(SingleFlight.acquire('key'), None)
+        cached = iter([None, 'from cache'])
+        self.assertEqual(SingleFlight.get_or_fill('key', lambda: next(cached), fill), 'from cache')
+        self.assertEqual(len(fills), 1)
+
+        # lease released but nothing cached, fill without waiting any longer
+        SingleFlight.release('key', token)
+        token = SingleFlight.acquire('key')
+        get_cached_calls = []
+
+        def get_cached():
+            get_cached_calls.append(1)
+            SingleFlight.release('key', token)
+            return None
+
+        self.assertEqual(SingleFlight.get_or_fill('key', get_cached, fill), 'from db')
+        self.assertEqual(len(fills), 2)
+        self.assertEqual(len(get_cached_calls), 1)
+
+    def test_get_objects_through_cache(self):
+        user1 = self.create_user('testuser1')
+        user2 = self.create_user('testuser2')
+        self.clear_cache()
+
+        # one query for all the cache misses, deleted objects are skipped
+        with self.assertNumQueries(1):
+            users = MemcachedHelper.get_objects_through_cache(User, [user2.id, -1, user1.id])
+        self.assertEqual([user.id for user in users], [user2.id, user1.id])
+
+        # all cached now
+        with self.assertNumQueries(0):
+            users = MemcachedHelper.get_objects_through_cache(User, [user1.id, user2.id])
+        self.assertEqual([user.id for user in users], [user1.id, user2.id])
+
+        # list serializers prefetch the users of the whole page
+        tweets = [self.create_tweet(user1), self.create_tweet(user2)]
+        UserService.prefetch_users(tweets)
+        self.assertEqual(tweets[0].cached_user.id, user1.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(tweets[1].cached_user.profile.user_id, user2.id)
+
+    def test_local_cache(self):
+        user = self.create_user('testuser')
+        self.clear_cache()
+
+        # no request cache outside of a request
+        self.assertEqual(RequestCache.get_current(), None)
+        first = MemcachedHelper.get_object_through_cache(User, user.id)
+        second = MemcachedHelper.get_object_through_cache(User, user.id)
+        self.assertEqual(first is second, False)
+
+        token = RequestCache.activate()
+        try:
+            request_cache = RequestCache.get_current()
+            first = MemcachedHelper.get_object_through_cache(User, user.id)
+            second = MemcachedHelper.get_object_through_cache(User, user.id)
+            self.assertEqual(first is second, True)
+            self.assertEqual((request_cache.hits, request_cache.misses), (1, 1))
+
+            # invalidated with memcached
+            user.save()
+            third = MemcachedHelper.get_object_through_cache(User, user.id)
+            self.assertEqual(third is first, False)
+            self.assertEqual((request_cache.hits, request_cache.misses), (1, 2))
+        finally:
+            RequestCache.deactivate(token)
+        self.assertEqual(RequestCache.get_current(), None)
+
+        # least recently used keys are evicted from the process cache
+        with self.settings(LOCAL_CACHE_PROCESS_MAX_SIZE=2):
+            ProcessCache.set('key1', 1)
+            ProcessCache.set('key2', 2)
+            self.assertEqual(ProcessCache.get('key1'), 1)
+            ProcessCache.set('key3', 3)
+            self.assertEqual(ProcessCache.get('key2'), None)
+            self.assertEqual(ProcessCache.get('key1'), 1)
+            self.assertEqual(ProcessCache.get('key3'), 3)
+            ProcessCache.clear()
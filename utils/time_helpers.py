@@ -1,5 +1,13 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 def utc_now():
-    return datetime.now().replace(tzinfo=pytz.utc)
\ No newline at end of file
+    return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_microseconds(dt):
+    # integer arithmetic, dt.timestamp() * 1000000 loses precision as a float
+    return (dt - EPOCH) // timedelta(microseconds=1)